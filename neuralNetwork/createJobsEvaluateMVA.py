@@ -3,6 +3,12 @@ import ROOT as r
 from array import array
 import optparse
 
+#Stamps of the files already evaluated, completion manifests of the outputs and bundling of the small files
+import runMVA, evaluationStamp, manifest, jobCost
+
+#Input directories of each year and cached listings
+import datasetCatalog
+
 templateCONDOR = """#!/bin/bash
 pushd CMSSWRELEASE/src
 eval `scramv1 runtime -sh`
@@ -21,9 +27,20 @@ if __name__ == "__main__":
     parser.add_option('-m', '--massPoints', action='store', type=str, dest='massPoints', default="scalar_LO_Mchi_1_Mphi_100") #Mass points training to be read (comma separated string)
     parser.add_option('-y', '--year', action='store', type=int, dest='year', default=2018)
     parser.add_option('-d', '--data', action='store_true', dest='data') #Process a data file or background/signal?
+    parser.add_option('-B', '--batch', action='store_true', dest='batch') #Evaluate the network on chunks of events instead of event by event
+    parser.add_option('-N', '--numpy', action='store_true', dest='numpy') #Evaluate on chunks of events with the exported NumPy models, without Keras
+    parser.add_option('-k', '--folds', action='store', type=int, dest='folds', default=0) #Evaluate the models of a k-fold training, each event with the model not trained on it
+    parser.add_option('-P', '--parametrized', action='store_true', dest='parametrized') #Evaluate the parametrized network for each mass point instead of one network per mass point
     parser.add_option('-q', '--query', action='store', type=str, dest='query', default="*") #String to be matched when searching for the files (do not use the nanoLatino prefix!)
 
-    parser.add_option('-r', '--resubmit', action='store_true', dest='resubmit') #Resubmit only files that failed based on the log files and missing Tree events
+    parser.add_option('--catalog', action='store', type=str, dest='catalog', default="") #JSON file overriding the input directories of the dataset catalog (see datasetCatalog.py)
+    parser.add_option('--stageDir', action='store', type=str, dest='stageDir', default="") #Local directory of the worker nodes where the jobs copy their inputs before reading them (not staged if empty)
+    parser.add_option('--stageSize', action='store', type=float, dest='stageSize', default=20.) #Size in GB of the staging directory, the least recently used copies being removed first
+    parser.add_option('--prefetch', action='store', type=int, dest='prefetch', default=2) #Number of the next inputs of a bundled job staged in the background while the current one is evaluated (needs stageDir)
+    parser.add_option('-u', '--bundleSize', action='store', type=float, dest='bundleSize', default=0.) #Size in MB of the files evaluated by the same job (0: one file per job)
+    parser.add_option('-F', '--force', action='store_true', dest='force') #Create the jobs of all the files, even the ones already evaluated with the same input, models and variables
+    parser.add_option('-r', '--resubmit', action='store_true', dest='resubmit') #Resubmit only the files whose output has no valid completion manifest
+    parser.add_option('--verifyOutputs', action='store_true', dest='verifyOutputs', default=False) #With the resubmit option, also compare the checksum of each output with its manifest
     parser.add_option('-t', '--test', action='store_true', dest='test') #Only process a few files and a few events, for testing purposes
     parser.add_option('-v', '--verbose', action='store_true', dest='verbose')
     (opts, args) = parser.parse_args()
@@ -33,6 +50,13 @@ if __name__ == "__main__":
     year = opts.year
     data = opts.data
     query = opts.query
+    batch = opts.batch
+    numpyModels = opts.numpy
+    parametrized = opts.parametrized
+    folds = opts.folds
+    force = opts.force
+    bundleSize = opts.bundleSize
+    catalog = datasetCatalog.DatasetCatalog(opts.catalog)
 
     test = opts.test
     resubmit = opts.resubmit
@@ -46,61 +70,56 @@ if __name__ == "__main__":
         print("Mass points: " + str(massPoints))
         print("Year: " + str(year))
         print("Query: " + str(query))
+        print("Batch: " + str(batch))
+        print("NumPy models: " + str(numpyModels))
+        print("Parametrized: " + str(parametrized))
+        print("Folds: " + str(folds))
         print("Test: " + str(test))
-        print("Resubmit: " + str(resubmit))
+        print("Resubmit: " + str(resubmit) + (" (checksums verified)" if opts.verifyOutputs else ""))
+        print("Force: " + str(force))
+        print("Bundle size: " + str(bundleSize) + " MB")
+        print("Catalog: " + str(opts.catalog if opts.catalog != "" else "default directories"))
+        print("Staging directory: " + str(opts.stageDir) + " (" + str(opts.stageSize) + " GB, prefetch: " + str(opts.prefetch) + ")")
         print("=================================================")
 
     baseDir = os.getcwd() + "/"
  
-    if year == 2018:
-        if data:
-            inputDir = "/eos/user/c/cprieels/work/TopPlusDMRunIILegacyRootfiles/Run2018_102X_nAODv6_Full2018v6/DATAl1loose2018v6__l2loose__l2tightOR2018v6/"
-        else:
-            inputDir = "/eos/user/c/cprieels/work/TopPlusDMRunIILegacyRootfiles/Autumn18_102X_nAODv6_Full2018v6/MCl1loose2018v6__MCCorr2018v6__l2loose__l2tightOR2018v6/"
-                    
-    elif year == 2017:
-        if data:
-            inputDir = "/eos/user/c/cprieels/work/TopPlusDMRunIILegacyRootfiles/Run2017_102X_nAODv5_Full2017v6/DATAl1loose2017v6__l2loose__l2tightOR2017v6/"
-        else:
-            inputDir = "/eos/user/c/cprieels/work/TopPlusDMRunIILegacyRootfiles/Fall2017_102X_nAODv5_Full2017v6/MCl1loose2017v6__MCCorr2017v6__l2loose__l2tightOR2017v6/"
-
-    elif year == 2016:
-        if data:
-            inputDir = "/eos/user/c/cprieels/work/TopPlusDMRunIILegacyRootfiles/Run2016_102X_nAODv5_Full2016v6/DATAl1loose2016v6__l2loose__l2tightOR2016v6/"
-        else:            
-            inputDir = "/eos/user/c/cprieels/work/TopPlusDMRunIILegacyRootfiles/Summer16_102X_nAODv5_Full2016v6/MCl1loose2016v6__MCCorr2016v6__l2loose__l2tightOR2016v6/" 
-
-    else:
-        inputDir = ""
+    inputDir = catalog.directory(year, "trees", datasetCatalog.fileKind(data = data))
+    if inputDir == "":
         print("The year option has to be used, and the year should be 2016, 2017 or 2018.")
     outputDir = inputDir[:-1] + "_weighted/"
 
     filesToProcess = []
     if inputDir != "":
-        filesToProcess = fnmatch.filter(os.listdir(inputDir), 'nanoLatino*' + query + '*')
+        filesToProcess = catalog.files(year, "trees", datasetCatalog.fileKind(data = data), query)
 
     #Resubmit only the files that ran into an error previously
     if resubmit:
         filesToResubmit = []
 
-        print("The resubmit process might take a while in order to open each output file and check that the tree Events is present.")
         for fileToProcess in filesToProcess:
 
-            #Check if the file is missing in the output directory
-            if not os.path.exists(outputDir + fileToProcess): 
+            #Check if the output is missing, incomplete (no manifest, fewer events than its input) or modified since its manifest was written
+            if not manifest.isComplete(outputDir + fileToProcess, fileToProcess, verify = opts.verifyOutputs):
                 filesToResubmit.append(fileToProcess)
-            else: #If the file exists, check if the tree Events has been created successfully
-                print("  --> Opening " + fileToProcess + " to check for the presence of the Events tree.")
-                try:
-                    f = r.TFile.Open(outputDir + fileToProcess)
-                    tree = f.Get("Events")
-                    if not f.GetListOfKeys().Contains("Events"):
-                        filesToResubmit.append(fileToProcess)
-                except:
-                    filesToResubmit.append(fileToProcess)
 
         filesToProcess = filesToResubmit
 
+    #Skip the files whose output has been stamped with the same input file, models, variables and options
+    if not force and not test and len(filesToProcess) > 0:
+        massPointsList = [str(item) for item in massPoints.split(",")]
+        options = runMVA.evaluationOptions(massPointsList, batch, numpyModels, parametrized, folds)
+        try:
+            hashes = evaluationStamp.modelHashes(runMVA.modelFiles(baseDir, year, massPointsList, options))
+        except (IOError, OSError) as e:
+            hashes = None
+            print("The models could not be read (" + str(e) + "), no file is skipped.")
+
+        if hashes is not None:
+            filesToEvaluate = [fileToProcess for fileToProcess in filesToProcess if not evaluationStamp.isUpToDate(outputDir + fileToProcess, inputDir + fileToProcess, hashes, runMVA.variables, options)]
+            print(str(len(filesToProcess) - len(filesToEvaluate)) + " file(s) already evaluated with the same inputs and models are skipped.")
+            filesToProcess = filesToEvaluate
+
     if test: #If the test option is used, then only process a single file
         try:
             filesToProcess = [filesToProcess[0]]
@@ -113,20 +132,38 @@ if __name__ == "__main__":
     except:
         pass #Directory already exists, this is fine
 
-    for i in filesToProcess:
+    #Bundle the small files in the same job, so that the models are loaded only once
+    bundles = [[fileToProcess] for fileToProcess in filesToProcess]
+    if bundleSize > 0:
+        bundles = jobCost.packJobs(filesToProcess, [os.path.getsize(inputDir + fileToProcess)/1e6 for fileToProcess in filesToProcess], bundleSize)
+
+    for bundle in bundles:
 
-        executable = baseDir + "/runMVA.py -e -f " + i + " -i " + inputDir + " -d " + baseDir + " -m " + massPoints
+        executable = baseDir + "/runMVA.py -e -f " + ",".join(bundle) + " -i " + inputDir + " -d " + baseDir + " -m " + massPoints
+        jobName = bundle[0].replace('.root', '') + ("__bundle" + str(len(bundle)) if len(bundle) > 1 else "")
         
         if test:
             executable = executable + " -t"
+        if batch:
+            executable = executable + " -B"
+        if numpyModels:
+            executable = executable + " -N"
+        if parametrized:
+            executable = executable + " -P"
+        if folds > 0:
+            executable = executable + " -k " + str(folds)
+        if opts.stageDir != "":
+            executable = executable + " --stageDir " + opts.stageDir + " --stageSize " + str(opts.stageSize) + " --prefetch " + str(opts.prefetch)
 
         template = templateCONDOR
         template = template.replace('CMSSWRELEASE', cmssw)
         template = template.replace('EXENAME', executable) 
 
-        f = open('sh/send_' + i.replace('.root', '') + '.sh', 'w')
+        f = open('sh/send_' + jobName + '.sh', 'w')
         f.write(template)
         f.close()
-        os.chmod('sh/send_' + i.replace('.root', '') + '.sh', 0755)     
+        os.chmod('sh/send_' + jobName + '.sh', 0755)     
 
+    if bundleSize > 0:
+        print(str(len(filesToProcess)) + " file(s) bundled in " + str(len(bundles)) + " job(s).")
     print(str(len(filesToProcess)) + " file(s) matching the requirements have been found.")
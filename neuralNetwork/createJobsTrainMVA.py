@@ -4,6 +4,9 @@ from array import array
 import random
 import optparse
 
+#Input directories of each year and cached listings
+import datasetCatalog
+
 templateCONDOR = """#!/bin/bash
 pushd CMSSWRELEASE/src
 eval `scramv1 runtime -sh`
@@ -28,6 +31,14 @@ if __name__ == "__main__":
     parser.add_option('-b', '--backgroundQuery', action='store', type=str, dest='backgroundQuery', default="TTTo2L2Nu__part,ST_s-channel_ext1,ST_t-channel_antitop,ST_t-channel_top,ST_tW_antitop_ext1,ST_tW_top_ext1") #Comma separated string to be matched when searching for the files
 
     #Additional options
+    parser.add_option('-k', '--folds', action='store', type=int, dest='folds', default=0) #Number of folds of a k-fold training by event number, trained in parallel (needs the D option)
+    parser.add_option('-P', '--parametrized', action='store_true', dest='parametrized') #Train a single network for all the signal mass points, with their masses as inputs (needs the D option)
+    parser.add_option('-S', '--streaming', action='store_true', dest='streaming') #Train on all the events, streamed by mini-batches, balancing the processes with weights (needs the D option)
+    parser.add_option('-D', '--datasetDir', action='store', type=str, dest='datasetDir', default="") #Directory of the cached training datasets, training directly with Keras instead of the TMVA dataloader if set
+    parser.add_option('--catalog', action='store', type=str, dest='catalog', default="") #JSON file overriding the input directories of the dataset catalog (see datasetCatalog.py)
+    parser.add_option('--stageDir', action='store', type=str, dest='stageDir', default="") #Local directory of the worker node where the files of the training dataset are copied before being read (not staged if empty)
+    parser.add_option('--stageSize', action='store', type=float, dest='stageSize', default=20.) #Size in GB of the staging directory, the least recently used copies being removed first
+    parser.add_option('--prefetch', action='store', type=int, dest='prefetch', default=2) #Number of the next files staged in the background while the current one is read (needs stageDir)
     parser.add_option('-t', '--test', action='store_true', dest='test')
     parser.add_option('-v', '--verbose', action='store_true', dest='verbose')
     (opts, args) = parser.parse_args()
@@ -37,7 +48,12 @@ if __name__ == "__main__":
     signalQuery = opts.signalQuery
     backgroundQuery = opts.backgroundQuery
     test = opts.test
+    datasetDir = opts.datasetDir
+    streaming = opts.streaming
+    parametrized = opts.parametrized
+    folds = opts.folds
     verbose = opts.verbose
+    catalog = datasetCatalog.DatasetCatalog(opts.catalog)
 
     if verbose:
         print("=================================================")
@@ -46,18 +62,15 @@ if __name__ == "__main__":
         print("Year: " + str(year))
         print("Signal query: " + str(signalQuery))
         print("Background query: " + str(backgroundQuery))
+        print("Dataset directory: " + str(datasetDir))
+        print("Catalog: " + str(opts.catalog if opts.catalog != "" else "default directories"))
+        print("Staging directory: " + str(opts.stageDir) + " (" + str(opts.stageSize) + " GB, prefetch: " + str(opts.prefetch) + ")")
         print("=================================================")
 
     baseDir = os.getcwd() + "/"
  
-    if year == 2018:
-        inputDir = "/eos/user/c/cprieels/work/TopPlusDMRunIILegacyRootfiles/Autumn18_102X_nAODv6_Full2018v6/MCl1loose2018v6__MCCorr2018v6__l2loose__l2tightOR2018v6/"
-    elif year == 2017:
-        inputDir = "/eos/user/c/cprieels/work/TopPlusDMRunIILegacyRootfiles/Fall2017_102X_nAODv5_Full2017v6/MCl1loose2017v6__MCCorr2017v6__l2loose__l2tightOR2017v6/"
-    elif year == 2016:
-        inputDir = "/eos/user/c/cprieels/work/TopPlusDMRunIILegacyRootfiles/Summer16_102X_nAODv5_Full2016v6/MCl1loose2016v6__MCCorr2016v6__l2loose__l2tightOR2016v6/" 
-    else:
-        inputDir = ""
+    inputDir = catalog.directory(year, "trees", "mc")
+    if inputDir == "":
         print("The year option has to be used, and the year should be 2016, 2017 or 2018.")
     #Watch out! The files in these directories will be overwritten when using the evaluate option
 
@@ -73,9 +86,9 @@ if __name__ == "__main__":
             maxFiles = 50
 
         for i, signalProcess in enumerate(signalProcesses):
-            signalFilesToProcess.append(','.join(fnmatch.filter(os.listdir(inputDir), 'nanoLatino*' + signalProcess + '*'))) #For now we keep all the signal files as then have less stat
+            signalFilesToProcess.append(','.join(catalog.files(year, "trees", "signal", signalProcess))) #For now we keep all the signal files as then have less stat
         for i, backgroundProcess in enumerate(backgroundProcesses):
-            backgroundFilesToProcess.append(','.join(fnmatch.filter(os.listdir(inputDir), 'nanoLatino*' + backgroundProcess + '*')[:maxFiles])) 
+            backgroundFilesToProcess.append(','.join(catalog.files(year, "trees", "mc", backgroundProcess)[:maxFiles])) 
         
     try:
         #shutil.rmtree('sh')
@@ -90,6 +103,16 @@ if __name__ == "__main__":
     executable = executable + " -s " + ','.join(signalFilesToProcess)
     executable = executable + " -b " + ','.join(backgroundFilesToProcess)
     executable = executable + " -y " + str(year)
+    if datasetDir != "":
+        executable = executable + " -D " + datasetDir
+    if streaming:
+        executable = executable + " -S"
+    if parametrized:
+        executable = executable + " -P"
+    if folds > 0:
+        executable = executable + " -k " + str(folds)
+    if opts.stageDir != "":
+        executable = executable + " --stageDir " + opts.stageDir + " --stageSize " + str(opts.stageSize) + " --prefetch " + str(opts.prefetch)
 
     template = templateCONDOR
     template = template.replace('CMSSWRELEASE', cmssw)
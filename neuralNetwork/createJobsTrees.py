@@ -1,8 +1,15 @@
-import os, sys, stat, fnmatch, shutil
+import os, sys, stat, fnmatch, shutil, time
 import ROOT as r
 from array import array
 import optparse, re
 
+#Cached metadata of the input and output files, and cost model of the jobs
+import fileIndex, jobCost, manifest
+import json
+
+#Input directories of each year and cached listings
+import datasetCatalog
+
 templateCONDOR = """#!/bin/bash
 pushd CMSSWRELEASE/src
 eval `scramv1 runtime -sh`
@@ -24,9 +31,32 @@ if __name__ == "__main__":
     parser.add_option('-o', '--outputDir', action='store', type=str, dest='outputDir', default="/eos/user/c/cprieels/work/TopPlusDMRunIILegacyRootfiles/") #Output directory where to keep the output files
     parser.add_option('-q', '--query', action='store', type=str, dest='query', default="*") #String to be matched when searching for the files (without the nanoLatino prefix)
     parser.add_option('-p', '--split', action='store', type=int, dest='split', default=1) #Do we want to divide the input file to speed up the process?
+    parser.add_option('-w', '--targetTime', action='store', type=float, dest='targetTime', default=0.) #Wall time in seconds targeted by each job, the files being split according to the cost of their sample instead of the split option (0: not used)
+    parser.add_option('--defaultEventCost', action='store', type=float, dest='defaultEventCost', default=0.05) #Time per event in seconds assumed when no timing summary is available
+    parser.add_option('--jobOverhead', action='store', type=float, dest='jobOverhead', default=60.) #Startup time in seconds of a job (CMSSW environment, imports), not measured by the timing summaries
+    parser.add_option('--calibrationEvents', action='store', type=int, dest='calibrationEvents', default=0) #Run createTrees.py locally on this number of events of one file of each sample without timing summary (0: no calibration)
+    parser.add_option('--jobPlan', action='store', type=str, dest='jobPlan', default="jobPlan.json") #File keeping the event ranges of each input file (by full path), reused by the resubmit option
+    parser.add_option('-u', '--bundleSize', action='store', type=float, dest='bundleSize', default=0.) #Size in MB of the inputs bundled in the same job, small files and event ranges being processed one after the other (0: one input per job)
+    parser.add_option('-T', '--timingBranches', action='store_true', dest='timingBranches', default=False) #Keep the time spent in each step of createTrees.py for each event
+    parser.add_option('-k', '--recoCache', action='store', type=str, dest='recoCache', default="") #Directory of the ttbar reconstruction cache shared by the jobs, not used if empty
+    parser.add_option('--maxEventTime', action='store', type=float, dest='maxEventTime', default=0.) #Wall time in seconds allowed for the reconstruction of one event (0: no limit)
+    parser.add_option('--mvaDir', action='store', type=str, dest='mvaDir', default="") #Base directory of the exported NumPy networks, evaluated by createTrees.py in the same pass if set
+    parser.add_option('--mvaMassPoints', action='store', type=str, dest='mvaMassPoints', default="scalar_LO_Mchi_1_Mphi_100") #Comma separated mass points to be evaluated
+    parser.add_option('--mvaParametrized', action='store_true', dest='mvaParametrized', default=False) #Evaluate the parametrized network for each mass point
+    parser.add_option('--mvaFolds', action='store', type=int, dest='mvaFolds', default=0) #Number of folds of a k-fold training (0: no k-fold)
+    parser.add_option('--maxEventIterations', action='store', type=int, dest='maxEventIterations', default=0) #Reconstruction attempts allowed for one event (0: no limit)
+
+    parser.add_option('--fileIndex', action='store', type=str, dest='fileIndex', default="fileIndex.json") #File where the metadata of the input and output files are cached, not cached if empty
+    parser.add_option('--indexThreads', action='store', type=int, dest='indexThreads', default=16) #Number of files opened at the same time to read their metadata
+    parser.add_option('--catalog', action='store', type=str, dest='catalog', default="") #JSON file overriding the input directories of the dataset catalog (see datasetCatalog.py)
+    parser.add_option('--stageDir', action='store', type=str, dest='stageDir', default="") #Local directory of the worker nodes where the jobs copy their inputs before reading them (not staged if empty)
+    parser.add_option('--stageSize', action='store', type=float, dest='stageSize', default=20.) #Size in GB of the staging directory, the least recently used copies being removed first
+    parser.add_option('--prefetch', action='store', type=int, dest='prefetch', default=2) #Number of the next inputs of a bundled job staged in the background while the current one is processed (needs stageDir)
+    parser.add_option('--heartbeatDir', action='store', type=str, dest='heartbeatDir', default="") #Shared directory where the jobs write their progress, read by monitorJobs.py to run a copy of the stragglers (not used if empty)
 
     parser.add_option('-t', '--test', action='store_true', dest='test') #Only process a few files and a few events, for testing purposes
-    parser.add_option('-r', '--resubmit', action='store_true', dest='resubmit') #Resubmit only files that failed based on the log files and missing Tree events
+    parser.add_option('-r', '--resubmit', action='store_true', dest='resubmit') #Resubmit only the jobs whose output has no valid completion manifest
+    parser.add_option('--verifyOutputs', action='store_true', dest='verifyOutputs', default=False) #With the resubmit option, also compare the checksum of each output with its manifest
     parser.add_option('-v', '--verbose', action='store_true', dest='verbose')
     (opts, args) = parser.parse_args()
 
@@ -37,6 +67,15 @@ if __name__ == "__main__":
     outputDir = opts.outputDir
     query = opts.query
     split = opts.split
+    recoCache = opts.recoCache
+    timingBranches = opts.timingBranches
+    maxEventTime = opts.maxEventTime
+    maxEventIterations = opts.maxEventIterations
+    mvaDir = opts.mvaDir
+    index = fileIndex.FileIndex(opts.fileIndex, opts.indexThreads)
+    catalog = datasetCatalog.DatasetCatalog(opts.catalog)
+    targetTime = opts.targetTime
+    bundleSize = opts.bundleSize
 
     test = opts.test
     resubmit = opts.resubmit
@@ -56,35 +95,23 @@ if __name__ == "__main__":
         print("Test: " + str(test))
         print("Query: " + str(query))
         print("Split: " + str(split))
-        print("Resubmit: " + str(resubmit))
+        print("Target time per job: " + str(targetTime) + " s")
+        print("Bundle size: " + str(bundleSize) + " MB")
+        print("Reconstruction cache: " + str(recoCache))
+        print("Event budget: " + str(maxEventTime) + " s, " + str(maxEventIterations) + " iterations")
+        print("MVA directory: " + str(mvaDir))
+        print("File index: " + str(opts.fileIndex) + " (" + str(opts.indexThreads) + " threads)")
+        print("Catalog: " + str(opts.catalog if opts.catalog != "" else "default directories"))
+        print("Staging directory: " + str(opts.stageDir) + " (" + str(opts.stageSize) + " GB, prefetch: " + str(opts.prefetch) + ")")
+        print("Heartbeat directory: " + str(opts.heartbeatDir))
+        print("Resubmit: " + str(resubmit) + (" (checksums verified)" if opts.verifyOutputs else ""))
         print("=================================================")
 
     #Three different directories are used: the inputDir, where the original latino files are, the outputDir, where to keep the output, and baseDir, the current path where the distributions.root file is.
     baseDir = os.getcwd() + "/"
  
-    if year == 2018:
-        if signal:
-            inputDir = "/eos/user/c/cprieels/work/SignalsPostProcessing/Pablo/Autumn18_102X_nAODv6_Full2018v6/MCl1loose2018v6__MCCorr2018v6__l2loose__l2tightOR2018v6/"
-        elif data:
-            inputDir = "/eos/cms/store/group/phys_higgs/cmshww/amassiro/HWWNano/Run2018_102X_nAODv6_Full2018v6/DATAl1loose2018v6__l2loose__l2tightOR2018v6/"
-        else:
-            inputDir = "/eos/cms/store/group/phys_higgs/cmshww/amassiro/HWWNano/Autumn18_102X_nAODv6_Full2018v6/MCl1loose2018v6__MCCorr2018v6__l2loose__l2tightOR2018v6/"
-    elif year == 2017:
-        if signal:
-            inputDir = "/eos/user/c/cprieels/work/SignalsPostProcessing/Pablo/Fall2017_102X_nAODv5_Full2017v6/MCl1loose2017v6__MCCorr2017v6__l2loose__l2tightOR2017v6/"
-        elif data:
-            inputDir = "/eos/cms/store/group/phys_higgs/cmshww/amassiro/HWWNano/Run2017_102X_nAODv5_Full2017v6/DATAl1loose2017v6__l2loose__l2tightOR2017v6/"
-        else:
-            inputDir = "/eos/cms/store/group/phys_higgs/cmshww/amassiro/HWWNano/Fall2017_102X_nAODv5_Full2017v6/MCl1loose2017v6__MCCorr2017v6__l2loose__l2tightOR2017v6/"
-    elif year == 2016:
-        if signal:
-            inputDir = "/eos/user/c/cprieels/work/SignalsPostProcessing/Pablo/Summer16_102X_nAODv5_Full2016v6/MCl1loose2016v6__MCCorr2016v6__l2loose__l2tightOR2016v6/" 
-        elif data:
-            inputDir = "/eos/cms/store/group/phys_higgs/cmshww/amassiro/HWWNano/Run2016_102X_nAODv5_Full2016v6/DATAl1loose2016v6__l2loose__l2tightOR2016v6/"
-        else:
-            inputDir = "/eos/cms/store/group/phys_higgs/cmshww/amassiro/HWWNano/Summer16_102X_nAODv5_Full2016v6/MCl1loose2016v6__MCCorr2016v6__l2loose__l2tightOR2016v6/"
-    else:
-        inputDir = ""
+    inputDir = catalog.directory(year, "latino", datasetCatalog.fileKind(signal, data))
+    if inputDir == "":
         print("The year option has to be used, and the year should be 2016, 2017 or 2018.")
 
     productionName = "/".join(inputDir.split('/')[-3:])
@@ -99,12 +126,79 @@ if __name__ == "__main__":
     filesToProcess = []
 
     if inputDir != "":
-        matchingFilesFound = fnmatch.filter(os.listdir(inputDir), 'nanoLatino*' + query + '*')
+        matchingFilesFound = catalog.files(year, "latino", datasetCatalog.fileKind(signal, data), query)
+        if split != 1 or targetTime > 0 or bundleSize > 0:
+            inputMetadata = index.scan([inputDir + matchingFileFound for matchingFileFound in matchingFilesFound])
+
+        if targetTime > 0:
+            #Cost per event of each sample, from the timing summaries of the previous productions and of the calibration runs
+            timingDirs = [outputDir + "/" + productionName, baseDir + "calibration/" + productionName]
+            costModel = jobCost.CostModel(jobCost.readTimings(timingDirs), opts.defaultEventCost, opts.jobOverhead)
+
+            if opts.calibrationEvents > 0:
+                toCalibrate = {}
+                for matchingFileFound in matchingFilesFound:
+                    if not costModel.isKnown(matchingFileFound):
+                        toCalibrate.setdefault(jobCost.sampleName(matchingFileFound), matchingFileFound)
+                if len(toCalibrate) > 0:
+                    calibrationOptions = ""
+                    if maxEventTime > 0:
+                        calibrationOptions = calibrationOptions + " --maxEventTime " + str(maxEventTime)
+                    if maxEventIterations > 0:
+                        calibrationOptions = calibrationOptions + " --maxEventIterations " + str(maxEventIterations)
+                    if mvaDir != "":
+                        calibrationOptions = calibrationOptions + " --mvaDir " + mvaDir + " --mvaMassPoints " + opts.mvaMassPoints + " --mvaYear " + str(year) + " --mvaFolds " + str(opts.mvaFolds)
+                        if opts.mvaParametrized:
+                            calibrationOptions = calibrationOptions + " --mvaParametrized"
+                    failed = jobCost.calibrate(sorted(toCalibrate.values()), inputDir, baseDir + "calibration/", baseDir, opts.calibrationEvents, calibrationOptions)
+                    if len(failed) > 0:
+                        print("The calibration failed for " + ", ".join(failed) + ", the default cost is used for their samples.")
+                    costModel = jobCost.CostModel(jobCost.readTimings(timingDirs), opts.defaultEventCost, opts.jobOverhead)
+
+            if verbose:
+                for sample in sorted(set([jobCost.sampleName(matchingFileFound) for matchingFileFound in matchingFilesFound])):
+                    print("  " + sample + ": " + str(round(costModel.eventCost(sample), 4)) + " s/event" + ("" if costModel.isKnown(sample) else " (default)"))
+
+            #Event ranges of the previous job creations, kept for the resubmission so that the outputs match
+            plan = {}
+            if os.path.exists(opts.jobPlan):
+                f = open(opts.jobPlan)
+                plan = json.load(f)
+                f.close()
+
         for matchingFileFound in matchingFilesFound:
 
-            if split != 1:
-                f = r.TFile.Open(inputDir + "/" + matchingFileFound)
-                nEvents = f.Get("Events").GetEntries()/split
+            if targetTime > 0:
+                metadata = inputMetadata[inputDir + matchingFileFound]
+                if not fileIndex.hasTree(metadata):
+                    print("  --> " + matchingFileFound + " can not be read or has no Events tree, it is skipped.")
+                    continue
+
+                #Keyed by the full path, the same latino file names being used by the productions of each year
+                if resubmit and inputDir + matchingFileFound in plan:
+                    ranges = plan[inputDir + matchingFileFound]
+                else:
+                    ranges = costModel.splitRanges(matchingFileFound, metadata["entries"], targetTime, metadata["clusters"])
+                    plan[inputDir + matchingFileFound] = ranges
+
+                if len(ranges) <= 1: #Short enough (or empty) to be processed in a single job
+                    ranges = [(-1, -1)]
+                for splitNumber, (firstEvent, lastEvent) in enumerate(ranges):
+                    fileToProcess = {
+                        "inputName": matchingFileFound,
+                        "outputName": matchingFileFound.replace('.root', '') + "_" + str(splitNumber) + '.root' if len(ranges) > 1 else matchingFileFound,
+                        "firstEvent": firstEvent,
+                        "lastEvent": lastEvent,
+                        "splitNumber": splitNumber if len(ranges) > 1 else -1
+                    }
+                    filesToProcess.append(fileToProcess)
+
+            elif split != 1:
+                metadata = inputMetadata[inputDir + matchingFileFound]
+                if not fileIndex.hasTree(metadata):
+                    print("  --> " + matchingFileFound + " can not be read or has no Events tree, it is skipped.")
+                    continue
+                nEvents = metadata["entries"]/split
 
                 for splitNumber in range(split):
                     firstEvent = (splitNumber * nEvents) + 1
@@ -127,26 +221,29 @@ if __name__ == "__main__":
                     }
                 filesToProcess.append(fileToProcess)
 
-    #Resubmit only the files that ran into an error previously
+        if targetTime > 0:
+            f = open(opts.jobPlan, "w")
+            json.dump(plan, f, indent = 2, sort_keys = True)
+            f.close()
+
+            totalTime = 0.
+            for fileToProcess in filesToProcess:
+                if fileToProcess['firstEvent'] == -1:
+                    nEvents = inputMetadata[inputDir + fileToProcess['inputName']]["entries"]
+                else:
+                    nEvents = fileToProcess['lastEvent'] - fileToProcess['firstEvent'] + 1
+                totalTime = totalTime + costModel.jobTime(fileToProcess['inputName'], nEvents)
+            print("Expected total time: " + str(round(totalTime/3600., 1)) + " h in " + str(len(filesToProcess)) + " job(s).")
+
+    #Resubmit only the files that ran into an error previously: the outputs without a manifest for the same event range (the job failed,
+    #was stopped or is still running), or modified since their manifest was written
     if resubmit:
         filesToResubmit = []
 
-        print("The resubmit process might take a while in order to open each output file and check that the tree Events is present.")
         for fileToProcess in filesToProcess:
-
-            #Check if the file is missing in the output directory
-            if not os.path.exists(outputDir + "/" + productionName + fileToProcess['outputName']): 
-                #filesToResubmit.append(fileToProcess)
-                pass
-            else: #If the file exists, check if the tree Events has been created successfully
-                print("  --> Opening " + fileToProcess['outputName'] + " to check for the presence of the Events tree.")
-                try:
-                    f = r.TFile.Open(outputDir + "/" + productionName + fileToProcess['outputName'])
-                    tree = f.Get("Events")
-                    if not f.GetListOfKeys().Contains("Events"):
-                        filesToResubmit.append(fileToProcess)
-                except:
-                    filesToResubmit.append(fileToProcess)
+            if not manifest.isComplete(outputDir + "/" + productionName + fileToProcess['outputName'], fileToProcess['inputName'],
+                                       fileToProcess['firstEvent'], fileToProcess['lastEvent'], opts.verifyOutputs):
+                filesToResubmit.append(fileToProcess)
     
         filesToProcess = filesToResubmit
 
@@ -157,11 +254,57 @@ if __name__ == "__main__":
         except:
             print("No file matching the requirements has been found.")
 
-    #Write the executable needed for each file to process
-    for fileToProcess in filesToProcess:
+    #Bundle the small inputs in the same job, up to bundleSize MB of input (and up to the target time if the cost model is used)
+    bundles = [[fileToProcess] for fileToProcess in filesToProcess]
+    if bundleSize > 0 and len(filesToProcess) > 0:
+        sizes, times = [], []
+        for fileToProcess in filesToProcess:
+            metadata = inputMetadata[inputDir + fileToProcess['inputName']]
+            if not fileIndex.hasTree(metadata): #Unreadable file, left alone in its job
+                sizes.append(bundleSize)
+                times.append(targetTime)
+                continue
+            if fileToProcess['firstEvent'] == -1 or metadata["entries"] <= 0:
+                fraction, nEvents = 1., metadata["entries"]
+            else:
+                nEvents = fileToProcess['lastEvent'] - fileToProcess['firstEvent'] + 1
+                fraction = nEvents/float(metadata["entries"])
+            sizes.append(fraction*metadata["size"]/1e6)
+            if targetTime > 0:
+                times.append(costModel.jobTime(fileToProcess['inputName'], nEvents) - opts.jobOverhead) #The startup is paid once per bundle
+        bundles = jobCost.packJobs(filesToProcess, sizes, bundleSize, times if targetTime > 0 else None, targetTime)
+
+    #Write the executable needed for each job, the copies of a job started by monitorJobs.py sharing the token of this job creation
+    jobToken = str(int(time.time()))
+    for bundle in bundles:
+
+        fileToProcess = bundle[0]
+        if len(bundle) == 1:
+            executable = baseDir + "/createTrees.py -f " + fileToProcess['inputName'] + " -i " + inputDir + " -o " + outputDir + " -b " + baseDir             
+            executable = executable + " --splitNumber " + str(fileToProcess['splitNumber']) + " --firstEvent " + str(fileToProcess['firstEvent']) + " --lastEvent " + str(fileToProcess['lastEvent'])
+            jobName = fileToProcess['outputName'].replace('.root', '')
+        else:
+            inputs = [item['inputName'] + ":" + str(item['firstEvent']) + ":" + str(item['lastEvent']) + ":" + str(item['splitNumber']) for item in bundle]
+            executable = baseDir + "/createTrees.py --files " + ",".join(inputs) + " -i " + inputDir + " -o " + outputDir + " -b " + baseDir
+            jobName = fileToProcess['outputName'].replace('.root', '') + "__bundle" + str(len(bundle))
+
+        if recoCache != "":
+            executable = executable + " --recoCache " + recoCache
+        if timingBranches:
+            executable = executable + " --timingBranches"
+        if maxEventTime > 0:
+            executable = executable + " --maxEventTime " + str(maxEventTime)
+        if maxEventIterations > 0:
+            executable = executable + " --maxEventIterations " + str(maxEventIterations)
+        if mvaDir != "":
+            executable = executable + " --mvaDir " + mvaDir + " --mvaMassPoints " + opts.mvaMassPoints + " --mvaYear " + str(year) + " --mvaFolds " + str(opts.mvaFolds)
+            if opts.mvaParametrized:
+                executable = executable + " --mvaParametrized"
 
-        executable = baseDir + "/createTrees.py -f " + fileToProcess['inputName'] + " -i " + inputDir + " -o " + outputDir + " -b " + baseDir             
-        executable = executable + " --splitNumber " + str(fileToProcess['splitNumber']) + " --firstEvent " + str(fileToProcess['firstEvent']) + " --lastEvent " + str(fileToProcess['lastEvent'])
+        if opts.stageDir != "":
+            executable = executable + " --stageDir " + opts.stageDir + " --stageSize " + str(opts.stageSize) + " --prefetch " + str(opts.prefetch)
+        if opts.heartbeatDir != "":
+            executable = executable + " --heartbeatDir " + os.path.abspath(opts.heartbeatDir) + " --jobName send_" + jobName + " --jobToken " + jobToken
 
         if verbose:
             executable = executable + " -v"
@@ -170,9 +313,11 @@ if __name__ == "__main__":
         template = template.replace('EXENAME', executable) 
         template = template.replace('CMSSWRELEASE', cmssw)
 
-        f = open('sh/send_' + fileToProcess['outputName'].replace('.root', '') + '.sh', 'w')
+        f = open('sh/send_' + jobName + '.sh', 'w')
         f.write(template)
         f.close()
-        os.chmod('sh/send_' + fileToProcess['outputName'].replace('.root', '') + '.sh', 0755)     
+        os.chmod('sh/send_' + jobName + '.sh', 0755)     
 
+    if bundleSize > 0:
+        print(str(len(filesToProcess)) + " input(s) bundled in " + str(len(bundles)) + " job(s).")
     print(str(len(filesToProcess)) + " file(s) matching the requirements have been found.")
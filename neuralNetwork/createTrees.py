@@ -2,16 +2,47 @@
 import ROOT as r
 from array import array
 import optparse
-import os, sys, fnmatch, math, time
+import os, sys, fnmatch, math, time, re, traceback
 from copy import deepcopy
+import numpy as np
 
 #Class for the ttbar reconstruction
 from ttbarReco.eventKinematic import EventKinematic
+from ttbarReco.nuSolutions import batchSingleNeutrinoSolutions
+
+#Cache of the reconstruction outputs
+import recoCache
+
+#Timers and counters of the different steps
+from stageTimer import StageTimer, timingPath
+
+#Progress heartbeats, for the speculative copies of the slow jobs
+from heartbeat import Heartbeat
+
+#Completion manifests of the outputs, read by the job creators to find the jobs to resubmit
+import manifest
+
+#Evaluation of the exported networks, in the same pass as the creation of the trees
+import runMVA, mvaInference, datasetCache
+
+#Local copies of the input files
+from stagingCache import StagingCache, Prefetcher, openStaged
 
 #Smearing parameters
 runSmearing = True
 runSmearingNumber = 100
 
+#Loose deepCSV working point used to define the b-jets
+bTagThreshold = 0.2217
+
+#Number of lepton+jets candidates solved at once by the batched reconstruction
+singleLeptonBatchSize = 100000
+
+#Staging cache of the input files, set by the --stageDir option (read from their directory if None), and prefetcher of the next
+#inputs of a job processing several of them (--prefetch option)
+staging = None
+prefetcher = None
+
 #=========================================================================================================
 # HELPERS
 #=========================================================================================================
@@ -35,49 +66,10 @@ def updateProgress(progress):
     sys.stdout.write(text)
     sys.stdout.flush()
 
-#=========================================================================================================
-# TREE CREATION
-#=========================================================================================================
-def createTree(inputDir, outputDir, baseDir, filename, firstEvent, lastEvent, splitNumber):
-    #===================================================
-    #Global setup
-    #===================================================
-
-    print("Filename:"+filename)
-    start_time = time.time()
-    
-    #First, let's open the mlb histogram we are going to need
-    distFile = r.TFile(baseDir+"distributions.root", "r")
-    distributions = {
-        "mlb": distFile.Get("mlb"),
-        "bw": distFile.Get("bw"),
-        "jer": distFile.Get("jer"),
-        "ler": distFile.Get("ler"),
-        "jphat": distFile.Get("jphat"),
-        "lphat": distFile.Get("lphat")
-    }
-
-    inputFile = r.TFile.Open(inputDir+filename, "r")
-    inputTree = inputFile.Get("Events")
-
-    #Create a directory to keep the files if it does not already exist
-    outputDirProduction = "/".join(inputDir.split('/')[-3:-1])+"/"
-    outputDir = outputDir + outputDirProduction #Add a final name to distinguish between 2016, 2017 and 2018 files
-    try:
-        os.stat(outputDir)
-    except:
-        os.makedirs(outputDir)
-
-    if splitNumber != -1:
-        outputFile = r.TFile.Open(outputDir + filename.replace('.root', '') + '_' + str(splitNumber) + ".root", "recreate")
-    else:
-        outputFile = r.TFile.Open(outputDir + filename, "recreate")
-
-    outputTree = inputTree.CloneTree(0)
-
-    #===================================================
-    #Select the branches we want to keep
-    #===================================================
+def keepBranches(outputTree):
+    """
+    Select the branches of the input latino trees we want to keep in the output trees.
+    """
 
     outputTree.SetBranchStatus("*", 0);
 
@@ -151,42 +143,406 @@ def createTree(inputDir, outputDir, baseDir, filename, firstEvent, lastEvent, sp
     outputTree.SetBranchStatus("PhotonGen_pt", 1);
     outputTree.SetBranchStatus("PhotonGen_eta", 1);
 
-    #New variables
-    nbJet = array("i", [0])
-    outputTree.Branch("nbJet", nbJet, "nbJet/I")
-    bJetsIdx = array("i", 10*[0])
-    outputTree.Branch("bJetsIdx", bJetsIdx, "bJetsIdx[nbJet]/I")
-
-    mt2ll = array("f", [0.])
-    outputTree.Branch("mt2ll", mt2ll, "mt2ll/F")
-    mt2bl = array("f", [0.])
-    outputTree.Branch("mt2bl", mt2bl, "mt2bl/F")
-    mblt = array("f", [0.])
-    outputTree.Branch("mblt", mblt, "mblt/F")
-
-    reco_weight = array("f", [0.])
-    outputTree.Branch("reco_weight", reco_weight, "reco_weight/F")
-    dark_pt = array("f", [0.])
-    outputTree.Branch("dark_pt", dark_pt, "dark_pt/F")
-    overlapping_factor = array("f", [0.])
-    outputTree.Branch("overlapping_factor", overlapping_factor, "overlapping_factor/F")
-
-    totalET = array("f", [0.])
-    outputTree.Branch("totalET", totalET, "totalET/F")
-    costhetall = array("f", [0.])
-    outputTree.Branch("costhetall", costhetall, "costhetall/F")
-    costhetal1b1 = array("f", [0.])
-    outputTree.Branch("costhetal1b1", costhetal1b1, "costhetal1b1/F")
-    costhetal2b2 = array("f", [0.])
-    outputTree.Branch("costhetal2b2", costhetal2b2, "costhetal2b2/F")
-    cosphill = array("f", [0.])
-    outputTree.Branch("cosphill", cosphill, "cosphill/F")
+def outputPath(inputDir, outputDir, filename, splitNumber):
+    """
+    Path of the output file, in a directory named after the production of the input file.
+    """
+
+    #Create a directory to keep the files if it does not already exist
+    outputDirProduction = "/".join(inputDir.split('/')[-3:-1])+"/"
+    outputDir = outputDir + outputDirProduction #Add a final name to distinguish between 2016, 2017 and 2018 files
+    try:
+        os.stat(outputDir)
+    except:
+        os.makedirs(outputDir)
+
+    if splitNumber != -1:
+        return outputDir + filename.replace('.root', '') + '_' + str(splitNumber) + ".root"
+    else:
+        return outputDir + filename
+
+def eventRange(tree, firstEvent, lastEvent):
+    """
+    Entries firstEvent to lastEvent (included, -1 for the whole tree) of a tree, the entries before the range not being read at all.
+    """
+
+    last = tree.GetEntries() - 1 if lastEvent == -1 else min(lastEvent, tree.GetEntries() - 1)
+    for index in xrange(max(firstEvent, 0), last + 1):
+        tree.GetEntry(index)
+        yield index, tree
+
+def openInput(path):
+    if prefetcher is not None:
+        local = prefetcher.get(path)
+    else:
+        local = staging.stage(path) if staging is not None else path
+    return openStaged(lambda p: r.TFile.Open(p, "r"), local, path)
+
+def temporaryOutput(path):
+    #Hidden and without the .root extension, so that the job creators listing the trees never take a partial output for a tree
+    return os.path.join(os.path.dirname(path), "." + os.path.basename(path) + '.tmp' + str(os.getpid()))
+
+def removeTemporaryOutput(path):
+    try:
+        os.remove(temporaryOutput(path))
+    except OSError:
+        pass #Not created yet, or already committed
+
+def createOutputFile(inputDir, outputDir, filename, splitNumber):
+    """
+    Open the output file under a temporary name, moved to its final name by commitOutput once complete.
+    """
+
+    return r.TFile.Open(temporaryOutput(outputPath(inputDir, outputDir, filename, splitNumber)), "recreate")
+
+def commitOutput(path, heartbeat = None):
+    """
+    Move the closed temporary output to its final name, so that a job stopped in the middle never leaves a partial file behind.
+    With speculative copies of the job, only the first copy to finish keeps its output: return False for the other ones.
+    """
+
+    if heartbeat is not None and not heartbeat.claim(path):
+        os.remove(temporaryOutput(path))
+        return False
+    manifest.removeManifest(path) #Written again once the new output is in place
+    os.rename(temporaryOutput(path), path)
+    return True
+
+#New float variables, in the order they are booked in the output trees
+newFloatBranches = ["mt2ll", "mt2bl", "mblt", "reco_weight", "dark_pt", "overlapping_factor", "totalET", "costhetall", "costhetal1b1", "costhetal2b2", "cosphill"]
+
+def bookNewBranches(outputTree):
+    """
+    Book the new variables in the output tree and return their buffers, by branch name.
+    """
+
+    newBranches = {}
+    newBranches["nbJet"] = array("i", [0])
+    outputTree.Branch("nbJet", newBranches["nbJet"], "nbJet/I")
+    newBranches["bJetsIdx"] = array("i", 10*[0])
+    outputTree.Branch("bJetsIdx", newBranches["bJetsIdx"], "bJetsIdx[nbJet]/I")
+    newBranches["reco_truncated"] = array("i", [0])
+    outputTree.Branch("reco_truncated", newBranches["reco_truncated"], "reco_truncated/I")
+
+    for name in newFloatBranches:
+        newBranches[name] = array("f", [0.])
+        outputTree.Branch(name, newBranches[name], name + "/F")
+
+    return newBranches
+
+class CandidateBranches():
+    """
+    Optional jagged branches keeping every lepton/b-jet candidate tried by the reconstruction (and every smeared candidate with solutions,
+    whatever its weight) and every solution of each candidate, so that the best solution can be chosen again with another criteria (see rerankSolutions.py) without running the reconstruction.
+    """
+
+    maxCandidates = 3*runSmearingNumber + 100 #Enough for the smearing of a b-jet pair without solution (2*runSmearingNumber candidates) and of the best one
+    maxSolutions = 4*maxCandidates #At most 4 intersections of the ellipses per candidate
+
+    candidateIntBranches = ["Candidate_jet1", "Candidate_jet2", "Candidate_inverseOrder", "Candidate_smeared", "Candidate_isBest", "Candidate_nSolution", "Candidate_firstSolution"]
+    candidateFloatBranches = ["Candidate_weight", "Candidate_dark_pt", "Candidate_overlapping_factor", "Candidate_mlb1", "Candidate_mlb2"]
+    solutionFloatBranches = ["Solution_nu1_px", "Solution_nu1_py", "Solution_nu1_pz", "Solution_nu2_px", "Solution_nu2_py", "Solution_nu2_pz", "Solution_mW1", "Solution_mW2", "Solution_mt1", "Solution_mt2"]
+
+    def __init__(self, outputTree):
+        self.branches = {}
+
+        self.branches["nCandidate"] = array("i", [0])
+        outputTree.Branch("nCandidate", self.branches["nCandidate"], "nCandidate/I")
+        for name in self.candidateIntBranches:
+            self.branches[name] = array("i", self.maxCandidates*[0])
+            outputTree.Branch(name, self.branches[name], name + "[nCandidate]/I")
+        for name in self.candidateFloatBranches:
+            self.branches[name] = array("f", self.maxCandidates*[0.])
+            outputTree.Branch(name, self.branches[name], name + "[nCandidate]/F")
+
+        self.branches["nSolution"] = array("i", [0])
+        outputTree.Branch("nSolution", self.branches["nSolution"], "nSolution/I")
+        self.branches["Solution_candidateIdx"] = array("i", self.maxSolutions*[0])
+        outputTree.Branch("Solution_candidateIdx", self.branches["Solution_candidateIdx"], "Solution_candidateIdx[nSolution]/I")
+        for name in self.solutionFloatBranches:
+            self.branches[name] = array("f", self.maxSolutions*[0.])
+            outputTree.Branch(name, self.branches[name], name + "[nSolution]/F")
+
+        self.kinematics = [] #Objects already recorded for the current event, to flag the best one
+
+    def reset(self):
+        self.branches["nCandidate"][0] = 0
+        self.branches["nSolution"][0] = 0
+        self.kinematics = []
+
+    def add(self, kinematic, jet1, jet2, inverseOrder, smeared):
+        """
+        Record a candidate (an EventKinematic after runReco and findBestSolution) and all its solutions.
+        """
+
+        c = self.branches["nCandidate"][0]
+        allSolutions = kinematic.allSolutions()
+        if c == self.maxCandidates or self.branches["nSolution"][0] + len(allSolutions) > self.maxSolutions:
+            return
+
+        self.branches["Candidate_jet1"][c] = jet1
+        self.branches["Candidate_jet2"][c] = jet2
+        self.branches["Candidate_inverseOrder"][c] = int(inverseOrder)
+        self.branches["Candidate_smeared"][c] = int(smeared)
+        self.branches["Candidate_isBest"][c] = 0
+        self.branches["Candidate_nSolution"][c] = len(allSolutions)
+        self.branches["Candidate_firstSolution"][c] = self.branches["nSolution"][0]
+        self.branches["Candidate_weight"][c] = kinematic.weight
+        self.branches["Candidate_dark_pt"][c] = kinematic.dark_pt
+        self.branches["Candidate_overlapping_factor"][c] = kinematic.overlapping_factor
+        self.branches["Candidate_mlb1"][c] = (kinematic.Tlep1 + kinematic.Tb1).M()
+        self.branches["Candidate_mlb2"][c] = (kinematic.Tlep2 + kinematic.Tb2).M()
+
+        for Tnu1, Tnu2 in allSolutions:
+            s = self.branches["nSolution"][0]
+            self.branches["Solution_candidateIdx"][s] = c
+            self.branches["Solution_nu1_px"][s] = Tnu1.Px()
+            self.branches["Solution_nu1_py"][s] = Tnu1.Py()
+            self.branches["Solution_nu1_pz"][s] = Tnu1.Pz()
+            self.branches["Solution_nu2_px"][s] = Tnu2.Px()
+            self.branches["Solution_nu2_py"][s] = Tnu2.Py()
+            self.branches["Solution_nu2_pz"][s] = Tnu2.Pz()
+            self.branches["Solution_mW1"][s] = (kinematic.Tlep1 + Tnu1).M()
+            self.branches["Solution_mW2"][s] = (kinematic.Tlep2 + Tnu2).M()
+            self.branches["Solution_mt1"][s] = (kinematic.Tlep1 + kinematic.Tb1 + Tnu1).M()
+            self.branches["Solution_mt2"][s] = (kinematic.Tlep2 + kinematic.Tb2 + Tnu2).M()
+            self.branches["nSolution"][0] = s + 1
+
+        self.branches["nCandidate"][0] = c + 1
+        self.kinematics.append(kinematic)
+
+    def setBest(self, kinematic):
+        for c, recorded in enumerate(self.kinematics):
+            self.branches["Candidate_isBest"][c] = int(recorded is kinematic)
+
+class EventBudgetExceeded(Exception):
+    pass
+
+class EventBudget():
+    """
+    Wall time (in seconds) and number of reconstruction attempts allowed for the reconstruction of one event, 0 meaning no limit.
+    """
+
+    def __init__(self, maxTime = 0., maxIterations = 0):
+        self.maxTime = maxTime
+        self.maxIterations = maxIterations
+        self.start()
+
+    def start(self):
+        self.startTime = time.time()
+        self.iterations = 0
+
+    def spend(self):
+        """
+        Count one reconstruction attempt, raising EventBudgetExceeded once the budget is exceeded (the maxIterations-th attempt is still allowed).
+        """
+
+        self.iterations = self.iterations + 1
+        if self.maxIterations > 0 and self.iterations > self.maxIterations:
+            raise EventBudgetExceeded()
+        if self.maxTime > 0 and time.time() - self.startTime > self.maxTime:
+            raise EventBudgetExceeded()
+
+class RecoResult():
+    """
+    Outputs of the ttbar reconstruction of an event needed to compute the new variables, as kept in the reconstruction cache.
+    """
+
+    vectors = ["Tlep1", "Tlep2", "Tb1", "Tb2", "Tnu1", "Tnu2", "TMET", "Ttop1", "Ttop2"]
+
+    def __init__(self, bestReconstructedKinematic = None, inverseOrder = False, weights = [], top1Pts = [], top2Pts = []):
+        self.inverseOrder = inverseOrder
+        self.recoWorked = bestReconstructedKinematic is not None and bestReconstructedKinematic.weight > 0
+        self.truncated = False #Reconstruction stopped because the event budget was exhausted
+        self.weight = -99.0
+        self.dark_pt = -99.0
+        self.overlapping_factor = -99.0
+        self.sharesLeptons = False #Whether Tlep1 and Tlep2 are the lepton vectors of the event itself (see reconstructEvent)
+        for name in self.vectors:
+            setattr(self, name, None)
+
+        if self.recoWorked:
+            self.weight = bestReconstructedKinematic.weight
+            self.dark_pt = bestReconstructedKinematic.dark_pt
+            self.overlapping_factor = bestReconstructedKinematic.overlapping_factor
+
+            #Not copied: the leptons boosted to compute cosphill are also the ones used afterwards for mblt when the best kinematic
+            #is not a smeared copy, and mblt has always been computed this way
+            for name in self.vectors:
+                setattr(self, name, getattr(bestReconstructedKinematic, name))
+
+            #Top quarks averaged over the smeared solutions, using their weights
+            Tnum1 = r.TLorentzVector()
+            Tnum2 = r.TLorentzVector()
+            for Ttop1, Ttop2, weight in zip(top1Pts, top2Pts, weights): #Unfortunately, in Pyroot the sum() function does not work
+                Tnum1 += Ttop1 * weight
+                Tnum2 += Ttop2 * weight
+            if len(weights) > 0:
+                self.Ttop1 = Tnum1 * (1./sum(weights))
+                self.Ttop2 = Tnum2 * (1./sum(weights))
+
+    def toDict(self):
+        result = {"inverseOrder": self.inverseOrder, "recoWorked": self.recoWorked, "weight": self.weight, "dark_pt": self.dark_pt, "overlapping_factor": self.overlapping_factor,
+                  "sharesLeptons": self.sharesLeptons}
+        for name in self.vectors:
+            vector = getattr(self, name)
+            result[name] = None if vector is None else [vector.Px(), vector.Py(), vector.Pz(), vector.E()]
+        return result
+
+    @classmethod
+    def fromDict(cls, cached):
+        result = cls(None, cached["inverseOrder"])
+        result.recoWorked = cached["recoWorked"]
+        for name in ["weight", "dark_pt", "overlapping_factor", "sharesLeptons"]:
+            setattr(result, name, cached[name])
+        for name in cls.vectors:
+            if cached[name] is not None:
+                setattr(result, name, r.TLorentzVector(*cached[name]))
+        return result
+
+#=========================================================================================================
+# TREE CREATION
+#=========================================================================================================
+class MVAScorer():
+    """
+    Scores of the NumPy networks exported after the training, computed for each event from the variables in memory and written in the
+    same branches as runMVA.py -e, so that the trees do not have to be read and written again to be evaluated.
+    """
+
+    def __init__(self, outputTree, mvaDir, year, massPoints, parametrized = False, folds = 0):
+        self.massPoints = massPoints
+        self.models, self.hypotheses, self.outputs = {}, {}, {}
+        for massPoint in massPoints:
+            self.models[massPoint] = runMVA.loadNumpyModels(mvaDir, year, "parametrized" if parametrized else massPoint, folds)
+            if parametrized:
+                masses = datasetCache.massParameters(massPoint)
+                if masses is None:
+                    raise ValueError("No Mchi and Mphi found in the mass point " + massPoint)
+                self.hypotheses[massPoint] = dict(zip(datasetCache.massParameterNames, masses))
+            self.outputs[massPoint] = runMVA.bookOutputBranches(outputTree, runMVA.outputPrefix(massPoint, massPoints))
+
+    @staticmethod
+    def value(ev, newBranches, variable):
+        """
+        Value of an input variable: a new branch, an input branch or an element of an input array branch (Lepton_pt[0]).
+        """
+
+        if variable in newBranches:
+            return newBranches[variable][0]
+        match = re.match(r"(\w+)\[(\d+)\]$", variable)
+        if match is not None:
+            return getattr(ev, match.group(1))[int(match.group(2))]
+        return getattr(ev, variable)
+
+    def fill(self, ev, newBranches):
+        for massPoint in self.massPoints:
+            models = self.models[massPoint]
+            hypothesis = self.hypotheses.get(massPoint, {})
+            inputs = np.array([[hypothesis[variable] if variable in hypothesis else self.value(ev, newBranches, variable) for variable in models[0].variables]])
+
+            #With k folds, the model not trained on this event
+            scores = models[ev.event % len(models)].predict(inputs)
+            output = self.outputs[massPoint]
+            output["signal0"][0] = scores[0, 0]
+            output["signal1"][0] = scores[0, 1]
+            output["bkg"][0] = scores[0, 2]
+            output["category"][0] = int(mvaInference.categories(scores)[0])
+
+#distributions.root is opened once per process, even when several files are processed by the same job
+openedDistributions = {}
+
+def openDistributions(baseDir):
+    if baseDir not in openedDistributions:
+        openedDistributions[baseDir] = r.TFile(baseDir+"distributions.root", "r")
+    return openedDistributions[baseDir]
+
+def recoConfigHash(baseDir):
+    """
+    Hash of everything the ttbar reconstruction results depend on, apart from the event itself.
+    """
+
+    return recoCache.configHash({
+        "runSmearing": runSmearing,
+        "runSmearingNumber": runSmearingNumber,
+        "bTagThreshold": bTagThreshold,
+        "distributions": recoCache.fileHash(baseDir+"distributions.root")
+    })
+
+def recoInputHash(ev, bJetCandidateIndexes):
+    """
+    Hash of the inputs of the ttbar reconstruction of an event.
+    """
+
+    values = [ev.MET_pt, ev.MET_phi]
+    for l in range(2):
+        values = values + [ev.Lepton_pt[l], ev.Lepton_eta[l], ev.Lepton_phi[l], ev.Lepton_pdgId[l]]
+    for jet in bJetCandidateIndexes:
+        values = values + [jet, ev.CleanJet_pt[jet], ev.CleanJet_eta[jet], ev.CleanJet_phi[jet], ev.Jet_mass[ev.CleanJet_jetIdx[jet]]]
+    return recoCache.inputHash(values)
+
+def createTree(inputDir, outputDir, baseDir, filename, firstEvent, lastEvent, splitNumber, allSolutions = False, recoCacheDir = "", timingBranches = False, budget = None, mva = None, heartbeat = None):
+    #===================================================
+    #Global setup
+    #===================================================
+
+    print("Filename:"+filename)
+    start_time = time.time()
+    
+    #First, let's open the mlb histogram we are going to need
+    distFile = openDistributions(baseDir)
+    distributions = {
+        "mlb": distFile.Get("mlb"),
+        "bw": distFile.Get("bw"),
+        "jer": distFile.Get("jer"),
+        "ler": distFile.Get("ler"),
+        "jphat": distFile.Get("jphat"),
+        "lphat": distFile.Get("lphat")
+    }
+
+    inputFile = openInput(inputDir+filename)
+    inputTree = inputFile.Get("Events")
+
+    outputFile = createOutputFile(inputDir, outputDir, filename, splitNumber)
+    outputTree = inputTree.CloneTree(0)
+
+    #===================================================
+    #Select the branches we want to keep
+    #===================================================
+
+    keepBranches(outputTree)
+    newBranches = bookNewBranches(outputTree)
+    nbJet, bJetsIdx = newBranches["nbJet"], newBranches["bJetsIdx"]
+    mt2ll, mt2bl, mblt = newBranches["mt2ll"], newBranches["mt2bl"], newBranches["mblt"]
+    reco_weight, dark_pt, overlapping_factor = newBranches["reco_weight"], newBranches["dark_pt"], newBranches["overlapping_factor"]
+    totalET, costhetall, costhetal1b1 = newBranches["totalET"], newBranches["costhetall"], newBranches["costhetal1b1"]
+    costhetal2b2, cosphill = newBranches["costhetal2b2"], newBranches["cosphill"]
+    reco_truncated = newBranches["reco_truncated"]
+
+    candidateBranches = CandidateBranches(outputTree) if allSolutions else None
+
+    #Scores of the networks computed in the same pass, if a dictionary with the MVAScorer arguments is given
+    scorer = MVAScorer(outputTree, **mva) if mva is not None else None
+
+    #Per event time spent in each step, if needed
+    timer = StageTimer()
+    timeBranches = {}
+    if timingBranches:
+        for stage in timer.stages:
+            timeBranches[stage] = array("f", [0.])
+            outputTree.Branch("time_" + stage, timeBranches[stage], "time_" + stage + "/F")
+
+    #The candidates are not kept in the cache, so it can not be used when they are needed
+    cache = None
+    if recoCacheDir != "" and not allSolutions:
+        cache = recoCache.RecoCache(recoCacheDir, filename, firstEvent, lastEvent, recoConfigHash(baseDir))
 
     nEvents = inputFile.Events.GetEntries()
     if test:
         nEvents = 500
     if lastEvent != -1:
         nEvents = lastEvent - firstEvent
+    if heartbeat is not None:
+        heartbeat.setTotal(nEvents)
 
     nAttempts, nWorked = 0, 0
 
@@ -197,22 +553,25 @@ def createTree(inputDir, outputDir, baseDir, filename, firstEvent, lastEvent, sp
     except:
         pass
 
-    for index, ev in enumerate(inputFile.Events):
-
-        #Only consider events between first and lastEvent
-        if (index < firstEvent):
-            continue
-
-        if (lastEvent != -1 and index > lastEvent):
-            break
+    timer.nextEvent()
+    for index, ev in eventRange(inputTree, firstEvent, lastEvent): #Only the events between first and lastEvent
 
         if (index % 10 == 0 and test) or (index % 1000 == 0 and not test): #Update the loading bar
             updateProgress(round(index/float(nEvents), 2))
             
         if test and index == nEvents:
             break #for testing only
+
+        if heartbeat is not None and index % 100 == 0 and not heartbeat.beat(index - max(firstEvent, 0)):
+            print '\nAnother copy of this job already finished ' + filename + ', stopping'
+            inputFile.Close()
+            outputFile.Close()
+            os.remove(temporaryOutput(outputPath(inputDir, outputDir, filename, splitNumber)))
+            return
         
         event_start_time = time.time()
+        timer.stage("preselection")
+        timer.count("events")
 
         #===================================================
         #Skimming and preselection
@@ -224,12 +583,18 @@ def createTree(inputDir, outputDir, baseDir, filename, firstEvent, lastEvent, sp
             pt3 = 0.
 
         if ev.Lepton_pt[0] < 25. or ev.Lepton_pt[1] < 20. or pt3 > 10.: #Exactly two leptons
+            timer.nextEvent()
             continue
+        timer.count("passTwoLeptons")
         if ev.Lepton_pdgId[0]*ev.Lepton_pdgId[1] >= 0: #Opposite sign leptons only
+            timer.nextEvent()
             continue
+        timer.count("passOppositeSign")
 
         if ev.mll < 20.:
+            timer.nextEvent()
             continue
+        timer.count("passMll")
 
         #The jet does not always exist, so let's check if it does exist
         try:
@@ -243,13 +608,16 @@ def createTree(inputDir, outputDir, baseDir, filename, firstEvent, lastEvent, sp
             jetpt2 = 0.
 
         if jetpt1 < 30. or jetpt2 < 30.: #At least two jets with pt > 30 GeV
+            timer.nextEvent()
             continue
+        timer.count("passTwoJets")
 
         #Additional cut removing events having less than one b-jet performed later, once the b-jets have been computed
 
         #===================================================
         #b-jets collection creation
         #===================================================
+        timer.stage("bJets")
         jetIndexes = []
         bJetIndexes = [] #Instead of keeping all the b-jets in a new collection, let's just keep in the trees their indexes to save memory
 
@@ -261,7 +629,7 @@ def createTree(inputDir, outputDir, baseDir, filename, firstEvent, lastEvent, sp
             maxBWeight = -10.0
 
             jetIndexes.append(j)
-            if ev.Jet_btagDeepB[ev.CleanJet_jetIdx[j]] > 0.2217:
+            if ev.Jet_btagDeepB[ev.CleanJet_jetIdx[j]] > bTagThreshold:
                 bJetIndexes.append(j) #Variable to use for the ttbar reco
                 bJetsIdx[ibjet] = j #Variable to keep in the tree
                 ibjet = ibjet + 1
@@ -277,7 +645,9 @@ def createTree(inputDir, outputDir, baseDir, filename, firstEvent, lastEvent, sp
         nbJet[0] = len(bJetIndexes)
 
         if len(bJetIndexes) == 0: #We don't consider events having less than 1 b-jet
+            timer.nextEvent()
             continue 
+        timer.count("passBJet")
 
         #===================================================
         #Kinematics definition
@@ -310,100 +680,57 @@ def createTree(inputDir, outputDir, baseDir, filename, firstEvent, lastEvent, sp
         #Remove the duplicates to avoid counting the same jet twice
         bJetCandidateIndexes = list(set(bJetCandidateIndexes))
 
-        maxWeight = 0.0 #Criteria to know which b-jet/lepton combination to keep
-        bestReconstructedKinematic = None
-        inverseOrder = False #Keep track of the b-jet/lepton combination used
-
         if len(bJetCandidateIndexes) < 2:
+            timer.nextEvent()
             continue
+        timer.count("passCandidates")
+
+        timer.stage("reco")
+        result = None
+        if cache is not None:
+            eventHash = recoInputHash(ev, bJetCandidateIndexes)
+            cached = cache.lookup(ev.run, ev.luminosityBlock, ev.event, eventHash)
+            if cached is not None:
+                result = RecoResult.fromDict(cached)
+                if result.sharesLeptons: #Same vectors as a fresh reconstruction, so that the variables computed afterwards are identical
+                    result.Tlep1, result.Tlep2 = (Tlep2, Tlep1) if result.inverseOrder else (Tlep1, Tlep2)
+
+        if result is None:
+            try:
+                result = reconstructEvent(ev, Tlep1, Tlep2, TMET, bJetCandidateIndexes, distributions, candidateBranches, timer, budget)
+                if cache is not None:
+                    cache.store(ev.run, ev.luminosityBlock, ev.event, eventHash, result.toDict())
+            except EventBudgetExceeded: #Pathological event, it gets the default values of a failed reconstruction
+                timer.count("truncated")
+                if candidateBranches is not None:
+                    candidateBranches.setBest(None)
+                result = RecoResult()
+                result.truncated = True
+        timer.stage("kinematics")
+        reco_truncated[0] = int(result.truncated)
 
-        for j, jet in enumerate(bJetCandidateIndexes):
-
-            if j == 0:
-                #By construction, we know that the first element of bJetCandidateIndexes is a b-jet
-                Tb1.SetPtEtaPhiM(ev.CleanJet_pt[jet], ev.CleanJet_eta[jet], ev.CleanJet_phi[jet], ev.Jet_mass[ev.CleanJet_jetIdx[jet]])
-            else:
-                Tb2.SetPtEtaPhiM(ev.CleanJet_pt[jet], ev.CleanJet_eta[jet], ev.CleanJet_phi[jet], ev.Jet_mass[ev.CleanJet_jetIdx[jet]])
-
-                eventKinematic1 = EventKinematic(Tlep1, Tlep2, Tb1, Tb2, Tnu1, Tnu2, TMET)
-                eventKinematic1Original = deepcopy(eventKinematic1)
-                eventKinematic2 = EventKinematic(Tlep2, Tlep1, Tb1, Tb2, Tnu1, Tnu2, TMET)
-                eventKinematic2Original = deepcopy(eventKinematic2)
-
-                #Perform first of all the reco without smearing
-                eventKinematic1.runReco()
-                eventKinematic1.findBestSolution(distributions["mlb"])
-                if eventKinematic1.weight > maxWeight:
-                    bestReconstructedKinematic = eventKinematic1
-                    inverseOrder = False
-                    maxWeight = eventKinematic1.weight
-
-                eventKinematic2.runReco()
-                eventKinematic2.findBestSolution(distributions["mlb"])
-                if eventKinematic2.weight > maxWeight:
-                    bestReconstructedKinematic = eventKinematic2
-                    inverseOrder = True
-                    maxWeight = eventKinematic2.weight
-
-                if bestReconstructedKinematic is None: #Try to perform the smearing until reaching a solution
-                    if runSmearing:
-                        for i in range(runSmearingNumber): 
-                            smearedEventKinematic1 = deepcopy(eventKinematic1Original).runSmearingOnce(distributions) #Get a new object by copying the original one
-                            #Keep the solution that has the higher weight
-                            if smearedEventKinematic1 is not None and smearedEventKinematic1.weight > maxWeight:
-                                bestReconstructedKinematic = smearedEventKinematic1
-                                inverseOrder = False
-                                maxWeight = smearedEventKinematic1.weight
-                                break
-
-                            #Do the same by reversing the leptons
-                            smearedEventKinematic2 = deepcopy(eventKinematic2Original).runSmearingOnce(distributions)
-                            #Keep the solution that has the higher weight
-                            if smearedEventKinematic2 is not None and smearedEventKinematic2.weight > maxWeight:
-                                bestReconstructedKinematic = smearedEventKinematic2
-                                inverseOrder = True
-                                maxWeight = smearedEventKinematic2.weight
-                                break
-
-
-        #Keep track of all the weights needed to computed the top quark pt later on
-        weights = []
-        top1Pts = [] #Top 1 pts given by the combination using the correct lepton/b-jet combination
-        top2Pts = []
-
-        #Run the smearing if needed
-        if runSmearing and bestReconstructedKinematic is not None:
-            for i in range(runSmearingNumber): 
-                smearedEventKinematic = deepcopy(bestReconstructedKinematic).runSmearingOnce(distributions) #Get a new object by copying the original one
-                #Keep the solution that has the higher weight
-                if smearedEventKinematic is not None and smearedEventKinematic.weight > maxWeight:
-                    bestReconstructedKinematic = smearedEventKinematic
-                    inverseOrder = False
-                    weights.append(smearedEventKinematic.weight)
-                    top1Pts.append(smearedEventKinematic.Ttop1)
-                    top2Pts.append(smearedEventKinematic.Ttop2)
-                    maxWeight = smearedEventKinematic.weight
-
-        recoWorked = False
         nAttempts = nAttempts + 1 #Count the number of event for which the reco worked
-        if bestReconstructedKinematic is not None:
-            if bestReconstructedKinematic.weight > 0:
-                recoWorked = True
-                nWorked = nWorked + 1
-
-        if inverseOrder:
-            eventKinematic = eventKinematic2
+        recoWorked = result.recoWorked
+        if recoWorked:
+            nWorked = nWorked + 1
+            timer.count("recoWorked")
+
+        #Last b-jet/lepton combination considered, used if the reco failed
+        Tb1.SetPtEtaPhiM(ev.CleanJet_pt[bJetCandidateIndexes[0]], ev.CleanJet_eta[bJetCandidateIndexes[0]], ev.CleanJet_phi[bJetCandidateIndexes[0]], ev.Jet_mass[ev.CleanJet_jetIdx[bJetCandidateIndexes[0]]])
+        Tb2.SetPtEtaPhiM(ev.CleanJet_pt[bJetCandidateIndexes[-1]], ev.CleanJet_eta[bJetCandidateIndexes[-1]], ev.CleanJet_phi[bJetCandidateIndexes[-1]], ev.Jet_mass[ev.CleanJet_jetIdx[bJetCandidateIndexes[-1]]])
+        if result.inverseOrder:
+            eventKinematic = EventKinematic(Tlep2, Tlep1, Tb1, Tb2, Tnu1, Tnu2, TMET)
         else:
-            eventKinematic = eventKinematic1
+            eventKinematic = EventKinematic(Tlep1, Tlep2, Tb1, Tb2, Tnu1, Tnu2, TMET)
 
         #===================================================
         #Dark pt and overlapping factor
         #===================================================
 
         if recoWorked:
-            reco_weight[0] = bestReconstructedKinematic.weight
-            dark_pt[0] = bestReconstructedKinematic.dark_pt
-            overlapping_factor[0] = bestReconstructedKinematic.overlapping_factor
+            reco_weight[0] = result.weight
+            dark_pt[0] = result.dark_pt
+            overlapping_factor[0] = result.overlapping_factor
         else:
             reco_weight[0] = -99.0
             dark_pt[0] = -99.0
@@ -412,10 +739,11 @@ def createTree(inputDir, outputDir, baseDir, filename, firstEvent, lastEvent, sp
         #===================================================
         #MT2 computation
         #===================================================
+        timer.stage("mt2")
 
         if recoWorked:
-            mt2ll[0] = computeMT2(bestReconstructedKinematic.Tlep1, bestReconstructedKinematic.Tlep2, bestReconstructedKinematic.TMET) 
-            mt2bl[0] = computeMT2(bestReconstructedKinematic.Tlep1 + bestReconstructedKinematic.Tb1, bestReconstructedKinematic.Tlep2 + bestReconstructedKinematic.Tb2, bestReconstructedKinematic.TMET) 
+            mt2ll[0] = computeMT2(result.Tlep1, result.Tlep2, result.TMET) 
+            mt2bl[0] = computeMT2(result.Tlep1 + result.Tb1, result.Tlep2 + result.Tb2, result.TMET) 
         else: #TOCHECK: put default value instead?
             mt2ll[0] = computeMT2(eventKinematic.Tlep1, eventKinematic.Tlep2, eventKinematic.TMET) 
             mt2bl[0] = computeMT2(eventKinematic.Tlep1 + eventKinematic.Tb1, eventKinematic.Tlep2 + eventKinematic.Tb2, eventKinematic.TMET) 
@@ -423,32 +751,21 @@ def createTree(inputDir, outputDir, baseDir, filename, firstEvent, lastEvent, sp
         #===================================================
         #Additional variables computation
         #===================================================
+        timer.stage("variables")
        
         #Variables bases on DESY's AN2016-240-v10
         if recoWorked:
-            totalET[0] = ev.PuppiMET_sumEt + bestReconstructedKinematic.Tb1.Pt() + bestReconstructedKinematic.Tb2.Pt() + bestReconstructedKinematic.Tlep1.Pt() + bestReconstructedKinematic.Tlep2.Pt()
-            costhetall[0] = bestReconstructedKinematic.Tlep1.CosTheta() * bestReconstructedKinematic.Tlep2.CosTheta()
-            costhetal1b1[0] = bestReconstructedKinematic.Tlep1.CosTheta() * bestReconstructedKinematic.Tb1.CosTheta()
-            costhetal2b2[0] = bestReconstructedKinematic.Tlep2.CosTheta() * bestReconstructedKinematic.Tb2.CosTheta()
+            totalET[0] = ev.PuppiMET_sumEt + result.Tb1.Pt() + result.Tb2.Pt() + result.Tlep1.Pt() + result.Tlep2.Pt()
+            costhetall[0] = result.Tlep1.CosTheta() * result.Tlep2.CosTheta()
+            costhetal1b1[0] = result.Tlep1.CosTheta() * result.Tb1.CosTheta()
+            costhetal2b2[0] = result.Tlep2.CosTheta() * result.Tb2.CosTheta()
 
             #cos(phi) in the parent rest frame
             try:
           
-                Ttop1 = bestReconstructedKinematic.Ttop1
-                Ttop2 = bestReconstructedKinematic.Ttop2
-
-                num1 = [a * b for a, b in zip(top1Pts, weights)]
-                Tnum1 = r.TLorentzVector()
-                for vec in num1: #Unfortunately, in Pyroot the sum() function does not work
-                    Tnum1 += vec
-                    Ttop1 = Tnum1 * (1./sum(weights))
-
-                num2 = [a * b for a, b in zip(top2Pts, weights)]
-                Tnum2 = r.TLorentzVector()
-                for vec in num2: 
-                    Tnum2 += vec
-                    Ttop2 = Tnum2 * (1./sum(weights))
-                
+                Ttop1 = r.TLorentzVector(result.Ttop1)
+                Ttop2 = r.TLorentzVector(result.Ttop2)
+
                 #First boost
                 boostvectorTT = (Ttop1 + Ttop2).BoostVector()
                 Ttop1.Boost(-boostvectorTT)
@@ -456,25 +773,25 @@ def createTree(inputDir, outputDir, baseDir, filename, firstEvent, lastEvent, sp
 
                 #Second boost
                 boostvector = Ttop1.BoostVector()
-                bestReconstructedKinematic.Tlep1.Boost(-boostvectorTT)
-                bestReconstructedKinematic.Tlep1.Boost(-boostvector)
+                result.Tlep1.Boost(-boostvectorTT)
+                result.Tlep1.Boost(-boostvector)
 
-                #bestReconstructedKinematic.Tb1.Boost(-boostvectorTT)
-                #bestReconstructedKinematic.Tb1.Boost(-boostvector)
-                #bestReconstructedKinematic.Tnu1.Boost(-boostvectorTT)
-                #bestReconstructedKinematic.Tnu1.Boost(-boostvector)
+                #result.Tb1.Boost(-boostvectorTT)
+                #result.Tb1.Boost(-boostvector)
+                #result.Tnu1.Boost(-boostvectorTT)
+                #result.Tnu1.Boost(-boostvector)
 
                 boostvector = Ttop2.BoostVector()
-                bestReconstructedKinematic.Tlep2.Boost(-boostvectorTT)
-                bestReconstructedKinematic.Tlep2.Boost(-boostvector)
+                result.Tlep2.Boost(-boostvectorTT)
+                result.Tlep2.Boost(-boostvector)
 
-                #bestReconstructedKinematic.Tb2.Boost(-boostvectorTT)
-                #bestReconstructedKinematic.Tb2.Boost(-boostvector)
-                #bestReconstructedKinematic.Tnu2.Boost(-boostvectorTT)
-                #bestReconstructedKinematic.Tnu2.Boost(-boostvector)
-                #print("Momentum: " + str((bestReconstructedKinematic.Tlep1+bestReconstructedKinematic.Tb1+bestReconstructedKinematic.Tnu1).P()))
+                #result.Tb2.Boost(-boostvectorTT)
+                #result.Tb2.Boost(-boostvector)
+                #result.Tnu2.Boost(-boostvectorTT)
+                #result.Tnu2.Boost(-boostvector)
+                #print("Momentum: " + str((result.Tlep1+result.Tb1+result.Tnu1).P()))
 
-                cosphill[0] = (bestReconstructedKinematic.Tlep1.Vect().Unit().Dot(bestReconstructedKinematic.Tlep2.Vect().Unit()))
+                cosphill[0] = (result.Tlep1.Vect().Unit().Dot(result.Tlep2.Vect().Unit()))
             except Exception as e:
                 print(e)
                 cosphill[0] = -49.0
@@ -490,6 +807,7 @@ def createTree(inputDir, outputDir, baseDir, filename, firstEvent, lastEvent, sp
         #===================================================
         #Compute the mblt variable as in https://arxiv.org/pdf/1812.00694.pdf (6.1)
         #===================================================
+        timer.stage("mblt")
 
         TmbltJet1 = r.TLorentzVector()
         TmbltJet2 = r.TLorentzVector()
@@ -505,7 +823,15 @@ def createTree(inputDir, outputDir, baseDir, filename, firstEvent, lastEvent, sp
 
         mblt[0] = min(mbltPossibilities)
 
+        if scorer is not None:
+            timer.stage("mva")
+            scorer.fill(ev, newBranches)
+
+        timer.stage("fill")
+        for stage in timeBranches:
+            timeBranches[stage][0] = timer.eventTimes[stage]
         outputTree.Fill()
+        timer.nextEvent()
 
     try:
         print '\nThe ttbar reconstruction worked for ' + str(round((nWorked/float(nAttempts))*100, 2)) + '% of the events considered'
@@ -514,11 +840,353 @@ def createTree(inputDir, outputDir, baseDir, filename, firstEvent, lastEvent, sp
     except:
         print 'Done!'
 
+    if cache is not None:
+        print 'Reconstruction cache: ' + str(cache.hits) + ' events reused, ' + str(cache.misses) + ' events reconstructed'
+        cache.write()
+
+    path = outputPath(inputDir, outputDir, filename, splitNumber)
+    eventsFilled = int(outputTree.GetEntries())
+
+    timer.stage("io")
+    outputFile.cd()
+    outputTree.Write()
+    inputFile.Close()
+    outputFile.Close()
+    timer.stage(None)
+
+    if not commitOutput(path, heartbeat):
+        print 'Another copy of this job already finished ' + filename + ', this output is dropped'
+        return
+    if not test:
+        manifest.writeManifest(path, filename, firstEvent, lastEvent, eventsFilled, start_time, splitNumber = splitNumber, eventsRead = nEvents)
+
+    #Summary of the time spent in each step, next to the output file
+    timer.printSummary()
+    timer.writeSummary(timingPath(path), filename = filename, splitNumber = splitNumber, firstEvent = firstEvent, lastEvent = lastEvent,
+                       nEvents = nEvents, eventsFilled = eventsFilled, recoAttempts = nAttempts, recoWorked = nWorked)
+
+def createTreeSingleLepton(inputDir, outputDir, baseDir, filename, firstEvent, lastEvent, splitNumber):
+    """
+    Lepton+jets version of createTree: the candidates of all the selected events are reconstructed at once using nuSolutions.batchSingleNeutrinoSolutions,
+    the best lepton/b-jet combination being the one with the smallest chi2. The output trees have the same branches as the dileptonic ones.
+    """
+
+    print("Filename:"+filename)
+    start_time = time.time()
+
+    timer = StageTimer()
+
+    distFile = openDistributions(baseDir)
+    mlbHist = distFile.Get("mlb")
+
+    inputFile = openInput(inputDir+filename)
+    inputTree = inputFile.Get("Events")
+
+    outputFile = createOutputFile(inputDir, outputDir, filename, splitNumber)
+    outputTree = inputTree.CloneTree(0)
+    keepBranches(outputTree)
+    newBranches = bookNewBranches(outputTree)
+
+    nEvents = inputTree.GetEntries()
+    if test:
+        nEvents = 500
+    if lastEvent != -1:
+        nEvents = lastEvent - firstEvent
+
+    #===================================================
+    #First pass: preselection and candidates
+    #===================================================
+
+    selectedEntries = [] #Entries of the input tree passing the preselection
+    selectedBJets = [] #b-jets indexes of the selected events, to be kept in the trees
+    selectedPuppiMETSumEt = []
+    candidateEvents = [] #For each lepton/b-jet candidate, index of the event in selectedEntries
+    candidateBJets, candidateLeptons, candidateMET, candidateSigma2 = [], [], [], []
+
+    Tlep = r.TLorentzVector()
+    Tb = r.TLorentzVector()
+
+    timer.nextEvent()
+    for index, ev in eventRange(inputTree, firstEvent, lastEvent): #Only the events between first and lastEvent
+
+        if (index % 10 == 0 and test) or (index % 1000 == 0 and not test): #Update the loading bar
+            updateProgress(round(index/float(nEvents), 2))
+
+        if test and index == nEvents:
+            break #for testing only
+
+        timer.stage("preselection")
+        timer.count("events")
+
+        try: #The second lepton is not always defined
+            pt2 = ev.Lepton_pt[1]
+        except:
+            pt2 = 0.
+
+        if ev.Lepton_pt[0] < 30. or pt2 > 10.: #Exactly one lepton
+            timer.nextEvent()
+            continue
+        timer.count("passOneLepton")
+
+        #The jets do not always exist, so let's check if they do exist
+        try:
+            jetpt4 = ev.CleanJet_pt[3]
+        except:
+            jetpt4 = 0.
+
+        if jetpt4 < 30.: #At least four jets with pt > 30 GeV for the lepton+jets topology
+            timer.nextEvent()
+            continue
+        timer.count("passFourJets")
+
+        bJetIndexes = [j for j in range(len(ev.CleanJet_pt)) if ev.Jet_btagDeepB[ev.CleanJet_jetIdx[j]] > bTagThreshold]
+        if len(bJetIndexes) == 0: #We don't consider events having less than 1 b-jet
+            timer.nextEvent()
+            continue
+        timer.count("passBJet")
+
+        Tlep.SetPtEtaPhiM(ev.Lepton_pt[0], ev.Lepton_eta[0], ev.Lepton_phi[0], 0.000511 if (abs(ev.Lepton_pdgId[0]) == 11) else 0.106)
+        for jet in bJetIndexes: #Any b-jet can come from the leptonic top
+            Tb.SetPtEtaPhiM(ev.CleanJet_pt[jet], ev.CleanJet_eta[jet], ev.CleanJet_phi[jet], ev.Jet_mass[ev.CleanJet_jetIdx[jet]])
+            candidateEvents.append(len(selectedEntries))
+            candidateBJets.append([Tb.Px(), Tb.Py(), Tb.Pz(), Tb.E()])
+            candidateLeptons.append([Tlep.Px(), Tlep.Py(), Tlep.Pz(), Tlep.E()])
+            candidateMET.append([ev.MET_pt * math.cos(ev.MET_phi), ev.MET_pt * math.sin(ev.MET_phi)])
+            candidateSigma2.append([[ev.MET_covXX, ev.MET_covXY], [ev.MET_covXY, ev.MET_covYY]])
+
+        selectedEntries.append(index)
+        selectedBJets.append(bJetIndexes)
+        selectedPuppiMETSumEt.append(ev.PuppiMET_sumEt)
+        timer.nextEvent()
+
+    #===================================================
+    #Batched ttbar reconstruction
+    #===================================================
+    timer.stage("reco")
+
+    candidateEvents = np.array(candidateEvents, dtype=int)
+    candidateBJets = np.array(candidateBJets).reshape(-1, 4)
+    candidateLeptons = np.array(candidateLeptons).reshape(-1, 4)
+    candidateMET = np.array(candidateMET).reshape(-1, 2)
+    candidateSigma2 = np.array(candidateSigma2).reshape(-1, 2, 2)
+
+    chi2 = np.empty(len(candidateEvents))
+    for first in range(0, len(candidateEvents), singleLeptonBatchSize):
+        batch = slice(first, first + singleLeptonBatchSize)
+        solutions = batchSingleNeutrinoSolutions(candidateBJets[batch], candidateLeptons[batch], candidateMET[batch, 0], candidateMET[batch, 1], candidateSigma2[batch])
+        chi2[batch] = solutions.chi2
+    timer.count("recoAttempts", len(candidateEvents))
+
+    #Keep the candidate with the smallest chi2 for each event
+    order = np.lexsort((chi2, candidateEvents))
+    best = order[np.r_[True, candidateEvents[order][1:] != candidateEvents[order][:-1]]] if len(order) else order
+    recoWorked = np.isfinite(chi2[best])
+    timer.count("recoWorked", int(np.count_nonzero(recoWorked)))
+
+    timer.stage("variables")
+    #Same weight as for the dileptonic reconstruction, using the mlb of the leptonic top only
+    Tmlb = candidateLeptons[best] + candidateBJets[best]
+    mlb = np.sqrt(np.maximum(0, Tmlb[:, 3]**2 - (Tmlb[:, :3]**2).sum(axis=1)))
+    truemlb = histogramContents(mlbHist, mlb)
+    weights = np.where(truemlb > 0, np.log(np.where(truemlb > 0, truemlb, 1) * 1000), -49.0)
+    weights = np.where(recoWorked, weights, -99.0)
+
+    pt = lambda p: np.sqrt(p[:, 0]**2 + p[:, 1]**2)
+    cosTheta = lambda p: p[:, 2] / np.sqrt((p[:, :3]**2).sum(axis=1))
+    totalETs = np.array(selectedPuppiMETSumEt) + pt(candidateBJets[best]) + pt(candidateLeptons[best])
+    costhetal1b1s = np.where(recoWorked, cosTheta(candidateLeptons[best]) * cosTheta(candidateBJets[best]), -99.0)
+
+    #===================================================
+    #Second pass: fill the output tree
+    #===================================================
+
+    for name in ["mt2ll", "mt2bl", "mblt", "dark_pt", "overlapping_factor", "costhetall", "costhetal2b2", "cosphill"]:
+        newBranches[name][0] = -99.0 #Variables needing the second lepton/neutrino
+
+    for i, index in enumerate(selectedEntries):
+        timer.stage("io")
+        inputTree.GetEntry(index)
+
+        timer.stage("fill")
+        newBranches["nbJet"][0] = len(selectedBJets[i])
+        for ibjet, jet in enumerate(selectedBJets[i]):
+            newBranches["bJetsIdx"][ibjet] = jet
+
+        newBranches["reco_weight"][0] = weights[i]
+        newBranches["totalET"][0] = totalETs[i]
+        newBranches["costhetal1b1"][0] = costhetal1b1s[i]
+
+        outputTree.Fill()
+
+    try:
+        print '\nThe ttbar reconstruction worked for ' + str(round((np.count_nonzero(recoWorked)/float(len(recoWorked)))*100, 2)) + '% of the events considered'
+        print 'Total execution time: ' + str(time.time() - start_time) + ' seconds'
+        print 'Mean execution time: ' + str(round(((time.time() - start_time)/nEvents), 2)) + ' seconds/event'
+    except:
+        print 'Done!'
+
+    path = outputPath(inputDir, outputDir, filename, splitNumber)
+    eventsFilled = int(outputTree.GetEntries())
+
+    timer.stage("io")
     outputFile.cd()
     outputTree.Write()
     inputFile.Close()
     outputFile.Close()
-    distFile.Close()
+    timer.stage(None)
+
+    commitOutput(path)
+    if not test:
+        manifest.writeManifest(path, filename, firstEvent, lastEvent, eventsFilled, start_time, splitNumber = splitNumber, eventsRead = nEvents)
+
+    #Summary of the time spent in each step, next to the output file
+    timer.printSummary()
+    timer.writeSummary(timingPath(path), filename = filename, splitNumber = splitNumber, firstEvent = firstEvent, lastEvent = lastEvent,
+                       nEvents = nEvents, eventsFilled = eventsFilled, recoAttempts = len(selectedEntries), recoWorked = int(np.count_nonzero(recoWorked)))
+
+def histogramContents(hist, values):
+    """
+    Vectorized equivalent of hist.GetBinContent(hist.FindBin(value)) for an array of values.
+    """
+
+    nBins = hist.GetNbinsX()
+    edges = np.array([hist.GetXaxis().GetBinLowEdge(b) for b in range(1, nBins + 2)])
+    contents = np.array([hist.GetBinContent(b) for b in range(nBins + 2)]) #Including underflow and overflow
+    return contents[np.searchsorted(edges, values, side='right')]
+
+def reconstructEvent(ev, Tlep1, Tlep2, TMET, bJetCandidateIndexes, distributions, candidateBranches = None, timer = None, budget = None):
+    """
+    Run the ttbar reconstruction for all the lepton/b-jet combinations of an event, with smearing if needed, and return the RecoResult of the best one.
+    Raise EventBudgetExceeded if the budget of the event is exhausted before the end.
+    """
+
+    if timer is None:
+        timer = StageTimer()
+    if budget is None:
+        budget = EventBudget()
+    budget.start()
+
+    Tb1 = r.TLorentzVector()
+    Tb2 = r.TLorentzVector()
+    Tnu1  = r.TLorentzVector()
+    Tnu2  = r.TLorentzVector()
+
+    if candidateBranches is not None:
+        candidateBranches.reset()
+
+    maxWeight = 0.0 #Criteria to know which b-jet/lepton combination to keep
+    bestReconstructedKinematic = None
+    inverseOrder = False #Keep track of the b-jet/lepton combination used
+    bestJet = -1
+
+    for j, jet in enumerate(bJetCandidateIndexes):
+
+        if j == 0:
+            #By construction, we know that the first element of bJetCandidateIndexes is a b-jet
+            Tb1.SetPtEtaPhiM(ev.CleanJet_pt[jet], ev.CleanJet_eta[jet], ev.CleanJet_phi[jet], ev.Jet_mass[ev.CleanJet_jetIdx[jet]])
+        else:
+            Tb2.SetPtEtaPhiM(ev.CleanJet_pt[jet], ev.CleanJet_eta[jet], ev.CleanJet_phi[jet], ev.Jet_mass[ev.CleanJet_jetIdx[jet]])
+
+            eventKinematic1 = EventKinematic(Tlep1, Tlep2, Tb1, Tb2, Tnu1, Tnu2, TMET)
+            eventKinematic1Original = deepcopy(eventKinematic1)
+            eventKinematic2 = EventKinematic(Tlep2, Tlep1, Tb1, Tb2, Tnu1, Tnu2, TMET)
+            eventKinematic2Original = deepcopy(eventKinematic2)
+
+            #Perform first of all the reco without smearing
+            timer.stage("reco")
+            eventKinematic1.runReco()
+            eventKinematic1.findBestSolution(distributions["mlb"])
+            countReco(timer, budget, eventKinematic1)
+            if candidateBranches is not None:
+                candidateBranches.add(eventKinematic1, bJetCandidateIndexes[0], jet, False, False)
+            if eventKinematic1.weight > maxWeight:
+                bestReconstructedKinematic = eventKinematic1
+                inverseOrder = False
+                bestJet = jet
+                maxWeight = eventKinematic1.weight
+
+            eventKinematic2.runReco()
+            eventKinematic2.findBestSolution(distributions["mlb"])
+            countReco(timer, budget, eventKinematic2)
+            if candidateBranches is not None:
+                candidateBranches.add(eventKinematic2, bJetCandidateIndexes[0], jet, True, False)
+            if eventKinematic2.weight > maxWeight:
+                bestReconstructedKinematic = eventKinematic2
+                inverseOrder = True
+                bestJet = jet
+                maxWeight = eventKinematic2.weight
+
+            if bestReconstructedKinematic is None: #Try to perform the smearing until reaching a solution
+                if runSmearing:
+                    timer.stage("smearing")
+                    for i in range(runSmearingNumber): 
+                        smearedEventKinematic1 = deepcopy(eventKinematic1Original).runSmearingOnce(distributions) #Get a new object by copying the original one
+                        countReco(timer, budget, smearedEventKinematic1, True)
+                        if candidateBranches is not None and smearedEventKinematic1 is not None and len(smearedEventKinematic1.solutions) > 0:
+                            candidateBranches.add(smearedEventKinematic1, bJetCandidateIndexes[0], jet, False, True)
+                        #Keep the solution that has the higher weight
+                        if smearedEventKinematic1 is not None and smearedEventKinematic1.weight > maxWeight:
+                            bestReconstructedKinematic = smearedEventKinematic1
+                            inverseOrder = False
+                            bestJet = jet
+                            maxWeight = smearedEventKinematic1.weight
+                            break
+
+                        #Do the same by reversing the leptons
+                        smearedEventKinematic2 = deepcopy(eventKinematic2Original).runSmearingOnce(distributions)
+                        countReco(timer, budget, smearedEventKinematic2, True)
+                        if candidateBranches is not None and smearedEventKinematic2 is not None and len(smearedEventKinematic2.solutions) > 0:
+                            candidateBranches.add(smearedEventKinematic2, bJetCandidateIndexes[0], jet, True, True)
+                        #Keep the solution that has the higher weight
+                        if smearedEventKinematic2 is not None and smearedEventKinematic2.weight > maxWeight:
+                            bestReconstructedKinematic = smearedEventKinematic2
+                            inverseOrder = True
+                            bestJet = jet
+                            maxWeight = smearedEventKinematic2.weight
+                            break
+
+
+    #Keep track of all the weights needed to computed the top quark pt later on
+    weights = []
+    top1Pts = [] #Top 1 pts given by the combination using the correct lepton/b-jet combination
+    top2Pts = []
+
+    #Run the smearing if needed
+    if runSmearing and bestReconstructedKinematic is not None:
+        timer.stage("smearing")
+        bestInverseOrder = inverseOrder
+        for i in range(runSmearingNumber): 
+            smearedEventKinematic = deepcopy(bestReconstructedKinematic).runSmearingOnce(distributions) #Get a new object by copying the original one
+            countReco(timer, budget, smearedEventKinematic, True)
+            if candidateBranches is not None and smearedEventKinematic is not None and len(smearedEventKinematic.solutions) > 0:
+                candidateBranches.add(smearedEventKinematic, bJetCandidateIndexes[0], bestJet, bestInverseOrder, True)
+            #Keep the solution that has the higher weight
+            if smearedEventKinematic is not None and smearedEventKinematic.weight > maxWeight:
+                bestReconstructedKinematic = smearedEventKinematic
+                inverseOrder = False
+                weights.append(smearedEventKinematic.weight)
+                top1Pts.append(smearedEventKinematic.Ttop1)
+                top2Pts.append(smearedEventKinematic.Ttop2)
+                maxWeight = smearedEventKinematic.weight
+
+    if candidateBranches is not None:
+        candidateBranches.setBest(bestReconstructedKinematic)
+
+    result = RecoResult(bestReconstructedKinematic, inverseOrder, weights, top1Pts, top2Pts)
+    result.sharesLeptons = bestReconstructedKinematic is not None and (bestReconstructedKinematic.Tlep1 is Tlep1 or bestReconstructedKinematic.Tlep1 is Tlep2)
+    return result
+
+def countReco(timer, budget, kinematic, smeared = False):
+    """
+    Count the reconstruction attempts, smearing iterations and exceptions raised by the solver, and spend the event budget.
+    """
+
+    timer.count("recoAttempts")
+    if smeared:
+        timer.count("smearingIterations")
+    if kinematic.recoException is not None:
+        timer.countException(kinematic.recoException)
+    budget.spend()
 
 def computeMT2(VisibleA, VisibleB, Invisible, MT2Type = 0, MT2Precision = 0) :
 
@@ -603,10 +1271,29 @@ if __name__ == "__main__":
     parser.add_option('-i', '--inputDir', action='store', type=str, dest='inputDir', default="")
     parser.add_option('-o', '--outputDir', action='store', type=str, dest='outputDir', default="/eos/user/c/cprieels/work/TopPlusDMRunIILegacyRootfiles/")
     parser.add_option('-b', '--baseDir', action='store', type=str, dest='baseDir', default="/afs/cern.ch/user/c/cprieels/work/public/TopPlusDMRunIILegacy/CMSSW_10_4_0/src/neuralNetwork/")
+    parser.add_option('--stageDir', action='store', type=str, dest='stageDir', default="") #Local directory where the input files are copied before being read, shared by the jobs of the node (not staged if empty)
+    parser.add_option('--stageSize', action='store', type=float, dest='stageSize', default=20.) #Size in GB of the staging directory, the least recently used copies being removed first
+    parser.add_option('--prefetch', action='store', type=int, dest='prefetch', default=2) #Number of the next inputs of the job staged in the background while the current one is processed (needs stageDir, 0: no prefetching)
+    parser.add_option('-F', '--files', action='store', type=str, dest='files', default="") #Comma separated filename:firstEvent:lastEvent:splitNumber inputs processed one after the other by the same job, instead of -f
+    parser.add_option('--heartbeatDir', action='store', type=str, dest='heartbeatDir', default="") #Directory where the progress of the job is written regularly, for the straggler monitor (not written if empty)
+    parser.add_option('--jobName', action='store', type=str, dest='jobName', default="") #Name of the job in the heartbeats, shared by its speculative copies
+    parser.add_option('--jobToken', action='store', type=str, dest='jobToken', default="") #Token shared by the copies of the job, only the first copy to finish an output keeps it
     parser.add_option('-x', '--splitNumber', action='store', type=int, dest='splitNumber', default=-1)
     parser.add_option('-y', '--firstEvent', action='store', type=int, dest='firstEvent', default=0)
     parser.add_option('-z', '--lastEvent', action='store', type=int, dest='lastEvent', default=0)
 
+    parser.add_option('-l', '--singleLepton', action='store_true', dest='singleLepton') #Lepton+jets control region instead of the dileptonic selection
+    parser.add_option('-a', '--allSolutions', action='store_true', dest='allSolutions', default=False) #Keep all the candidates and solutions of the reconstruction in jagged branches
+    parser.add_option('-k', '--recoCache', action='store', type=str, dest='recoCache', default="") #Directory of the reconstruction cache, not used if empty
+    parser.add_option('-T', '--timingBranches', action='store_true', dest='timingBranches', default=False) #Keep the time spent in each step for each event in time_* branches
+    parser.add_option('--maxEventTime', action='store', type=float, dest='maxEventTime', default=0.) #Wall time in seconds allowed for the reconstruction of one event (0: no limit)
+    parser.add_option('--maxEventIterations', action='store', type=int, dest='maxEventIterations', default=0) #Reconstruction attempts, smearing included, allowed for one event (0: no limit)
+
+    parser.add_option('--mvaDir', action='store', type=str, dest='mvaDir', default="") #Base directory of the exported NumPy networks, evaluated in the same pass if set (see runMVA.py)
+    parser.add_option('--mvaMassPoints', action='store', type=str, dest='mvaMassPoints', default="scalar_LO_Mchi_1_Mphi_100") #Comma separated mass points to be evaluated
+    parser.add_option('--mvaYear', action='store', type=int, dest='mvaYear', default=2018) #Year of the training
+    parser.add_option('--mvaParametrized', action='store_true', dest='mvaParametrized', default=False) #Evaluate the parametrized network for each mass point
+    parser.add_option('--mvaFolds', action='store', type=int, dest='mvaFolds', default=0) #Number of folds of a k-fold training (0: no k-fold)
     parser.add_option('-t', '--test', action='store_true', dest='test')
     parser.add_option('-v', '--verbose', action='store_true', dest='verbose')
     (opts, args) = parser.parse_args()
@@ -618,10 +1305,65 @@ if __name__ == "__main__":
     splitNumber = opts.splitNumber
     firstEvent = opts.firstEvent
     lastEvent = opts.lastEvent
+    singleLepton = opts.singleLepton
+    allSolutions = opts.allSolutions
+    recoCacheDir = opts.recoCache
+    timingBranches = opts.timingBranches
+    budget = EventBudget(opts.maxEventTime, opts.maxEventIterations)
+    mva = None
+    if opts.mvaDir != "":
+        mva = {"mvaDir": opts.mvaDir, "year": opts.mvaYear, "massPoints": [str(item) for item in opts.mvaMassPoints.split(",")],
+               "parametrized": opts.mvaParametrized, "folds": opts.mvaFolds}
+    if opts.stageDir != "":
+        staging = StagingCache(opts.stageDir, opts.stageSize)
     test = opts.test
     verbose = opts.verbose
 
     #Needed for reasons explained in https://root-forum.cern.ch/t/cannot-perform-both-dot-product-and-scalar-multiplication-on-tvector2-in-pyroot/28207
     fixOperations()
-    createTree(inputDir, outputDir, baseDir, filename, firstEvent, lastEvent, splitNumber)
+
+    #Several inputs can be bundled in the same job, so that the startup of the job is paid only once
+    inputs = [(filename, firstEvent, lastEvent, splitNumber)]
+    if opts.files != "":
+        inputs = []
+        for item in opts.files.split(","):
+            fields = item.split(":")
+            if len(fields) == 1:
+                fields = fields + [-1, -1, -1]
+            inputs.append((fields[0], int(fields[1]), int(fields[2]), int(fields[3])))
+
+    if staging is not None and opts.prefetch > 0 and len(inputs) > 1:
+        prefetcher = Prefetcher(staging, [inputDir + item[0] for item in inputs], opts.prefetch)
+
+    heartbeat = None
+    if opts.heartbeatDir != "" and not singleLepton:
+        jobName = opts.jobName if opts.jobName != "" else inputs[0][0].replace('.root', '') + "_" + str(inputs[0][3])
+        heartbeat = Heartbeat(opts.heartbeatDir, jobName, opts.jobToken if opts.jobToken != "" else jobName)
+
+    failed = []
+    for inputIndex, (filename, firstEvent, lastEvent, splitNumber) in enumerate(inputs):
+        try:
+            if singleLepton:
+                createTreeSingleLepton(inputDir, outputDir, baseDir, filename, firstEvent, lastEvent, splitNumber)
+            else:
+                if heartbeat is not None:
+                    heartbeat.startInput(inputIndex, len(inputs), outputPath(inputDir, outputDir, filename, splitNumber))
+                createTree(inputDir, outputDir, baseDir, filename, firstEvent, lastEvent, splitNumber, allSolutions, recoCacheDir, timingBranches, budget, mva, heartbeat)
+        except Exception:
+            removeTemporaryOutput(outputPath(inputDir, outputDir, filename, splitNumber))
+            if len(inputs) == 1:
+                if heartbeat is not None:
+                    heartbeat.finish("failed")
+                raise
+            traceback.print_exc() #The other inputs of the job are still processed, the failed one will be found by the resubmit option
+            failed.append(filename + ":" + str(splitNumber))
+
+    if heartbeat is not None:
+        heartbeat.finish("done" if len(failed) == 0 else "failed")
+    if prefetcher is not None:
+        prefetcher.close()
+
+    if len(failed) > 0:
+        print("Failed inputs: " + ", ".join(failed))
+        sys.exit(1)
     
@@ -0,0 +1,245 @@
+#Training datasets extracted once from the trees into memory-mapped arrays, so that the trainings do not read the input files again
+import ROOT
+import os, re, json, hashlib, shutil
+import numpy as np
+
+#Helpers to read the columns of the trees
+import mvaInference
+
+#Prefetching of the next files while one is read
+from stagingCache import Prefetcher, openStaged
+
+#To be increased each time the content of the cached datasets changes
+datasetCacheVersion = 2
+
+#Parameters of the signal hypotheses given as inputs to the parametrized networks
+massParameterNames = ["Mchi", "Mphi"]
+
+def massParameters(name):
+    """
+    (Mchi, Mphi) of a signal file or mass point name (..._Mchi_1_Mphi_100... or ..._Mchi1_Mphi100...), None if there is none.
+    """
+
+    match = re.search(r"Mchi_?(\d+)_Mphi_?(\d+)", name)
+    if match is None:
+        return None
+    return [float(match.group(1)), float(match.group(2))]
+
+def datasetKey(inputDir, processes, variables, weight, parametrized = False):
+    """
+    Hash of the list of files of each process (with their size and modification time), of the variables and of the weight expression.
+    """
+
+    description = {"version": datasetCacheVersion, "variables": variables, "weight": weight, "processes": []}
+    if parametrized:
+        description["parameters"] = massParameterNames
+    for label, files in processes:
+        description["processes"].append([label, [[inputFile, os.path.getsize(inputDir + inputFile), int(os.path.getmtime(inputDir + inputFile))] for inputFile in files]])
+    return hashlib.md5(json.dumps(description, sort_keys = True).encode()).hexdigest()
+
+class TrainingDataset():
+    """
+    Input variables (X), process label (y), event weight (w) and event number of all the training events, memory-mapped from a cached directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        f = open(os.path.join(path, "meta.json"))
+        self.meta = json.load(f)
+        f.close()
+        self.variables = self.meta["variables"]
+        self.labels = self.meta["labels"]
+        self.X = np.load(os.path.join(path, "X.npy"), mmap_mode = "r")
+        self.y = np.load(os.path.join(path, "y.npy"), mmap_mode = "r")
+        self.w = np.load(os.path.join(path, "w.npy"), mmap_mode = "r")
+        self.event = np.load(os.path.join(path, "event.npy"), mmap_mode = "r")
+
+        #Mass parameters of each event (NaN for the backgrounds) for the parametrized networks
+        self.parameters = self.meta.get("parameters", [])
+        self.P = np.load(os.path.join(path, "P.npy"), mmap_mode = "r") if len(self.parameters) > 0 else None
+        self.inputs = self.variables + self.parameters
+
+    def signalParameters(self):
+        """
+        Parameters of the signal files, with their number of events.
+        """
+
+        values = [parameters for parameters in self.meta["fileParameters"] if parameters is not None]
+        entries = [n for parameters, n in zip(self.meta["fileParameters"], self.meta["fileEntries"]) if parameters is not None]
+        return np.array(values), np.array(entries, dtype = np.float64)
+
+    def inputArray(self, X, P, random):
+        """
+        Inputs of the network: the variables, followed by the parameters if any, the ones of the background events being sampled
+        from the distribution of the signal events so that the backgrounds are seen with all the hypotheses.
+        """
+
+        if P is None:
+            return X
+        P = np.array(P, dtype = np.float32)
+        missing = np.isnan(P[:, 0])
+        values, entries = self.signalParameters()
+        P[missing] = values[random.choice(len(values), missing.sum(), p = entries/entries.sum())]
+        return np.hstack([X, P])
+
+def buildDataset(cacheDir, inputDir, processes, variables, weight = "XSWeight", chunkSize = 100000, parametrized = False, staging = None, prefetch = 0):
+    """
+    Return the TrainingDataset of a list of (label, files) processes, the label index of each process being its position in the list.
+    The trees are only read if this list of files, variables and weight has not been cached yet. If parametrized, the (Mchi, Mphi)
+    masses of the signal files are also stored for each event. With a staging cache, the files are read from their local copies, the
+    next prefetch files being copied while one is read.
+    """
+
+    path = os.path.join(cacheDir, datasetKey(inputDir, processes, variables, weight, parametrized))
+    if os.path.exists(os.path.join(path, "meta.json")):
+        print("Using the cached training dataset " + path)
+        return TrainingDataset(path)
+
+    print("Building the training dataset " + path)
+
+    #First count the events to book the arrays directly on disk
+    entries = []
+    for label, files in processes:
+        for inputFile in files:
+            rootfile = ROOT.TFile.Open(inputDir + inputFile, "READ")
+            entries.append(int(rootfile.Get("Events").GetEntries()))
+            rootfile.Close()
+    nEvents = sum(entries)
+
+    #Written in a temporary directory, renamed at the end so that an interrupted build is never used
+    temporary = path + ".tmp" + str(os.getpid())
+    try:
+        os.makedirs(temporary)
+    except:
+        pass #Directory already exists, this is fine
+
+    X = np.lib.format.open_memmap(os.path.join(temporary, "X.npy"), mode = "w+", dtype = np.float32, shape = (nEvents, len(variables)))
+    y = np.lib.format.open_memmap(os.path.join(temporary, "y.npy"), mode = "w+", dtype = np.int8, shape = (nEvents,))
+    w = np.lib.format.open_memmap(os.path.join(temporary, "w.npy"), mode = "w+", dtype = np.float32, shape = (nEvents,))
+    event = np.lib.format.open_memmap(os.path.join(temporary, "event.npy"), mode = "w+", dtype = np.int64, shape = (nEvents,))
+    fileParameters = [massParameters(inputFile) for process, files in processes for inputFile in files]
+    if parametrized:
+        P = np.lib.format.open_memmap(os.path.join(temporary, "P.npy"), mode = "w+", dtype = np.float32, shape = (nEvents, len(massParameterNames)))
+
+    prefetcher = None
+    if staging is not None and prefetch > 0:
+        prefetcher = Prefetcher(staging, [inputDir + inputFile for process, files in processes for inputFile in files], prefetch)
+
+    position, fileIndex, counts = 0, 0, []
+    for label, (process, files) in enumerate(processes):
+        first = position
+        for inputFile in files:
+            if prefetcher is not None:
+                local = prefetcher.get(inputDir + inputFile)
+            else:
+                local = staging.stage(inputDir + inputFile) if staging is not None else inputDir + inputFile
+            rootfile = openStaged(lambda p: ROOT.TFile.Open(p, "READ"), local, inputDir + inputFile)
+            tree = rootfile.Get("Events")
+            for firstEntry in range(0, entries[fileIndex], chunkSize):
+                n = min(chunkSize, entries[fileIndex] - firstEntry)
+                columns = mvaInference.readColumns(tree, variables + [weight, "event"], firstEntry, n)
+                X[position:position+n] = columns[:, :-2]
+                w[position:position+n] = columns[:, -2]
+                event[position:position+n] = columns[:, -1]
+                y[position:position+n] = label
+                if parametrized:
+                    P[position:position+n] = fileParameters[fileIndex] if fileParameters[fileIndex] is not None else np.nan
+                position = position + n
+            rootfile.Close()
+            fileIndex = fileIndex + 1
+        counts.append(position - first)
+    if prefetcher is not None:
+        prefetcher.close()
+
+    X.flush()
+    y.flush()
+    w.flush()
+    event.flush()
+    del X, y, w, event
+    if parametrized:
+        P.flush()
+        del P
+
+    meta = {"variables": variables, "weight": weight, "labels": [process for process, files in processes], "counts": counts,
+            "files": [files for process, files in processes], "inputDir": inputDir, "fileEntries": entries, "fileParameters": fileParameters,
+            "parameters": massParameterNames if parametrized else []}
+    f = open(os.path.join(temporary, "meta.json"), "w")
+    json.dump(meta, f, indent = 2)
+    f.close()
+
+    try:
+        os.rename(temporary, path)
+    except OSError: #Built at the same time by another training, keep the first one
+        shutil.rmtree(temporary)
+
+    return TrainingDataset(path)
+
+#=========================================================================================================
+# STREAMING
+#=========================================================================================================
+def splitBlocks(nEvents, blockSize = 10000, trainPercentage = 50, seed = 100):
+    """
+    Split the events in blocks of consecutive events, each block being randomly assigned to the training or to the testing sample.
+    Small datasets are split in smaller blocks (at least 10 when possible), and each sample gets at least one block as long as there
+    are two events.
+    """
+
+    blockSize = max(1, min(blockSize, nEvents//10))
+    blocks = [(first, min(first + blockSize, nEvents)) for first in range(0, nEvents, blockSize)]
+    random = np.random.RandomState(seed)
+    isTraining = random.rand(len(blocks)) < trainPercentage/100.
+    if len(blocks) >= 2 and (isTraining.all() or not isTraining.any()):
+        isTraining[random.randint(len(blocks))] = not isTraining[0] #One block moved to the empty sample
+    trainBlocks = [block for block, training in zip(blocks, isTraining) if training]
+    testBlocks = [block for block, training in zip(blocks, isTraining) if not training]
+    return trainBlocks, testBlocks
+
+def blockStatistics(dataset, blocks):
+    """
+    Minimum and maximum of each input (the range of the parameters being the one of the signal files) and number of events of each
+    process in the blocks, reading one block at a time.
+    """
+
+    minimums = np.full(len(dataset.variables), np.inf)
+    maximums = np.full(len(dataset.variables), -np.inf)
+    counts = np.zeros(len(dataset.labels), dtype = np.int64)
+    for first, last in blocks:
+        X = dataset.X[first:last]
+        minimums = np.minimum(minimums, X.min(axis = 0))
+        maximums = np.maximum(maximums, X.max(axis = 0))
+        counts = counts + np.bincount(dataset.y[first:last], minlength = len(dataset.labels))
+
+    if dataset.P is not None:
+        values, entries = dataset.signalParameters()
+        minimums = np.concatenate([minimums, values.min(axis = 0)])
+        maximums = np.concatenate([maximums, values.max(axis = 0)])
+    return minimums, maximums, counts
+
+def batchGenerator(dataset, blocks, batchSize, bufferBlocks = 20, seed = 100):
+    """
+    Endless generator of shuffled (X, y) mini-batches of the events of the blocks, X being the inputs of the network (see inputArray).
+    The blocks are read in a random order, bufferBlocks at a time, and the events are shuffled inside this buffer, so that the memory
+    used does not depend on the size of the dataset.
+    """
+
+    if sum([last - first for first, last in blocks]) < batchSize:
+        raise ValueError("Less events than the size of a batch")
+
+    random = np.random.RandomState(seed)
+    leftX = np.empty((0, len(dataset.inputs)), dtype = np.float32)
+    leftY = np.empty(0, dtype = np.int8)
+    while True:
+        order = random.permutation(len(blocks))
+        for i in range(0, len(order), bufferBlocks):
+            X = np.concatenate([leftX] + [dataset.inputArray(dataset.X[blocks[j][0]:blocks[j][1]], None if dataset.P is None else dataset.P[blocks[j][0]:blocks[j][1]], random)
+                                          for j in order[i:i+bufferBlocks]])
+            y = np.concatenate([leftY] + [dataset.y[blocks[j][0]:blocks[j][1]] for j in order[i:i+bufferBlocks]])
+            shuffle = random.permutation(len(y))
+            X, y = X[shuffle], y[shuffle]
+
+            nBatches = len(y)//batchSize
+            for batch in range(nBatches):
+                yield X[batch*batchSize:(batch+1)*batchSize], y[batch*batchSize:(batch+1)*batchSize]
+
+            #The remaining events are kept for the next buffer
+            leftX, leftY = X[nBatches*batchSize:], y[nBatches*batchSize:]
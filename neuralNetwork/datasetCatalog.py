@@ -0,0 +1,99 @@
+#Catalog of the input directories of each year, for the latino files (tier "latino") and the trees of createTrees.py (tier "trees"),
+#each of them for the data, MC and signal files, with the listings of the directories cached on disk so that the job creators do not
+#list the EOS directories again when nothing changed
+import os, json, time, fnmatch
+
+latinoDir = "/eos/cms/store/group/phys_higgs/cmshww/amassiro/HWWNano/"
+signalDir = "/eos/user/c/cprieels/work/SignalsPostProcessing/Pablo/"
+treesDir = "/eos/user/c/cprieels/work/TopPlusDMRunIILegacyRootfiles/"
+
+#Productions of each year: (MC, data)
+productions = {
+    "2016": ("Summer16_102X_nAODv5_Full2016v6/MCl1loose2016v6__MCCorr2016v6__l2loose__l2tightOR2016v6/", "Run2016_102X_nAODv5_Full2016v6/DATAl1loose2016v6__l2loose__l2tightOR2016v6/"),
+    "2017": ("Fall2017_102X_nAODv5_Full2017v6/MCl1loose2017v6__MCCorr2017v6__l2loose__l2tightOR2017v6/", "Run2017_102X_nAODv5_Full2017v6/DATAl1loose2017v6__l2loose__l2tightOR2017v6/"),
+    "2018": ("Autumn18_102X_nAODv6_Full2018v6/MCl1loose2018v6__MCCorr2018v6__l2loose__l2tightOR2018v6/", "Run2018_102X_nAODv6_Full2018v6/DATAl1loose2018v6__l2loose__l2tightOR2018v6/"),
+}
+
+#Directory of each tier, year and kind of files, the trees of the signal files being written next to the MC ones
+defaultDirectories = {"latino": {}, "trees": {}}
+for year, (mc, data) in productions.items():
+    defaultDirectories["latino"][year] = {"mc": latinoDir + mc, "data": latinoDir + data, "signal": signalDir + mc}
+    defaultDirectories["trees"][year] = {"mc": treesDir + mc, "data": treesDir + data, "signal": treesDir + mc}
+
+def fileKind(signal = False, data = False):
+    if signal:
+        return "signal"
+    return "data" if data else "mc"
+
+class DatasetCatalog():
+    """
+    Directories of the files of each (tier, year, kind), the defaults being overridden by the catalog file if given (a JSON file with the
+    same structure, pointing for instance to a local directory standing in for EOS). The listings of the directories are kept in cacheFile,
+    and only listed again when the modification time of the directory changed or when they are older than maxAge seconds.
+    """
+
+    def __init__(self, catalogFile = "", cacheFile = "catalogCache.json", maxAge = 3600.):
+        self.cacheFile = cacheFile
+        self.maxAge = maxAge
+
+        self.directories = json.loads(json.dumps(defaultDirectories))
+        if catalogFile != "":
+            f = open(catalogFile)
+            catalog = json.load(f)
+            f.close()
+            for tier in catalog:
+                for year in catalog[tier]:
+                    self.directories.setdefault(tier, {}).setdefault(year, {}).update(catalog[tier][year])
+
+        self.listings = {}
+        if cacheFile != "" and os.path.exists(cacheFile):
+            try:
+                f = open(cacheFile)
+                self.listings = json.load(f)
+                f.close()
+            except Exception as e: #An unreadable cache only means the directories will be listed again
+                print("Ignoring the catalog cache " + cacheFile + ": " + str(e))
+
+    def directory(self, year, tier, kind):
+        """
+        Directory of the files, an empty string if the catalog has none for this year.
+        """
+
+        return self.directories.get(tier, {}).get(str(year), {}).get(kind, "")
+
+    def listDirectory(self, directory):
+        """
+        Content of a directory, from the cache if it is still valid.
+        """
+
+        try:
+            mtime = int(os.stat(directory).st_mtime)
+        except OSError:
+            return []
+        listing = self.listings.get(directory)
+        if listing is not None and listing["mtime"] == mtime and time.time() - listing["time"] < self.maxAge:
+            return listing["files"]
+
+        listing = {"mtime": mtime, "time": time.time(), "files": sorted(os.listdir(directory))}
+        self.listings[directory] = listing
+        self.write()
+        return listing["files"]
+
+    def files(self, year, tier, kind, process = "*"):
+        """
+        Latino files (or trees) of a process, given as the string to be matched in their names without the nanoLatino prefix.
+        """
+
+        directory = self.directory(year, tier, kind)
+        if directory == "":
+            return []
+        return fnmatch.filter(self.listDirectory(directory), 'nanoLatino*' + process + '*.root') #Not the files written next to them (stamps, caches...)
+
+    def write(self):
+        if self.cacheFile == "":
+            return
+        temporary = self.cacheFile + ".tmp" + str(os.getpid())
+        f = open(temporary, "w")
+        json.dump(self.listings, f)
+        f.close()
+        os.rename(temporary, self.cacheFile)
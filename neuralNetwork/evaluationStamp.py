@@ -0,0 +1,52 @@
+#Stamps written next to the outputs of runMVA.py -e, used by createJobsEvaluateMVA.py to skip the files already evaluated with the same input file, models and variables
+import os, json
+
+from recoCache import fileHash
+
+def stampPath(outputPath):
+    return outputPath.replace('.root', '') + '_stamp.json'
+
+def describeInput(inputPath):
+    """
+    Size, modification time and checksum of an input file.
+    """
+
+    return {"size": os.path.getsize(inputPath), "mtime": int(os.path.getmtime(inputPath)), "md5": fileHash(inputPath)}
+
+def modelHashes(modelFiles):
+    return dict([(modelFile, fileHash(modelFile)) for modelFile in modelFiles])
+
+def writeStamp(outputPath, inputPath, hashes, variables, options):
+    """
+    Write the stamp of an evaluated output, atomically so that a failed job never leaves a valid stamp behind.
+    """
+
+    stamp = {"input": describeInput(inputPath), "models": hashes, "variables": variables, "options": options}
+    temporary = stampPath(outputPath) + ".tmp" + str(os.getpid())
+    f = open(temporary, "w")
+    json.dump(stamp, f, indent = 2, sort_keys = True)
+    f.close()
+    os.rename(temporary, stampPath(outputPath))
+
+def isUpToDate(outputPath, inputPath, hashes, variables, options):
+    """
+    Whether an output exists and was evaluated with the same models, variables and options from the same input file. The checksum of the
+    input file is only computed again if its size or modification time changed.
+    """
+
+    if not os.path.exists(outputPath) or not os.path.exists(stampPath(outputPath)):
+        return False
+
+    try:
+        f = open(stampPath(outputPath))
+        stamp = json.load(f)
+        f.close()
+    except Exception: #Unreadable stamp, evaluate the file again
+        return False
+
+    if stamp["models"] != hashes or stamp["variables"] != variables or stamp["options"] != options:
+        return False
+
+    if stamp["input"]["size"] == os.path.getsize(inputPath) and stamp["input"]["mtime"] == int(os.path.getmtime(inputPath)):
+        return True
+    return stamp["input"]["md5"] == fileHash(inputPath)
@@ -0,0 +1,138 @@
+#Index of the metadata of the input and output files (entries, size, cluster boundaries, modification time), read with a pool of threads
+#and cached on disk, so that the job creators only open again the files that changed since the previous run
+import os, json
+from multiprocessing.pool import ThreadPool
+
+#To be increased each time the content of the index entries changes
+fileIndexVersion = 1
+
+def statFile(path):
+    """
+    (size, modification time) of a file, None if it does not exist.
+    """
+
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return (info.st_size, int(info.st_mtime))
+
+def describeFile(path, treeName = "Events"):
+    """
+    Number of entries and cluster boundaries of the tree of a file, None if the file can not be opened.
+    A file without the tree (a failed output for instance) has -1 entries.
+    """
+
+    import ROOT as r
+
+    try:
+        rootfile = r.TFile.Open(path, "READ")
+    except Exception:
+        return None
+    if not rootfile or rootfile.IsZombie():
+        return None
+
+    description = {"entries": -1, "clusters": []}
+    if rootfile.GetListOfKeys().Contains(treeName):
+        tree = rootfile.Get(treeName)
+        nEntries = int(tree.GetEntries())
+        description["entries"] = nEntries
+
+        #First entry of each cluster, the natural boundaries to split the file without reading a basket twice
+        clusters = [0]
+        iterator = tree.GetClusterIterator(0)
+        entry = iterator.Next()
+        while 0 < entry < nEntries:
+            clusters.append(int(entry))
+            entry = iterator.Next()
+        description["clusters"] = clusters
+
+    rootfile.Close()
+    return description
+
+class FileIndex():
+    """
+    Metadata of files keyed by their path, cached in a JSON file. An entry is only valid as long as the size and modification time
+    of its file do not change.
+    """
+
+    def __init__(self, cacheFile = "fileIndex.json", threads = 16, treeName = "Events"):
+        self.cacheFile = cacheFile
+        self.threads = threads
+        self.treeName = treeName
+
+        self.entries = {}
+        if cacheFile != "" and os.path.exists(cacheFile):
+            try:
+                f = open(cacheFile)
+                cache = json.load(f)
+                f.close()
+                if cache.get("version") == fileIndexVersion and cache.get("treeName") == treeName:
+                    self.entries = cache["files"]
+            except Exception as e: #An unreadable index only means the files will be opened again
+                print("Ignoring the file index " + cacheFile + ": " + str(e))
+
+    def describe(self, path):
+        return describeFile(path, self.treeName)
+
+    def scan(self, paths):
+        """
+        Return the metadata (size, mtime, entries, clusters) of each path, None for the missing files and the ones that can not be opened.
+        Only the new and modified files are opened, in parallel, and the index is written back if any of them changed.
+        """
+
+        import ROOT as r
+
+        #Let the threads open the files at the same time, most of the time being spent waiting for the storage
+        r.ROOT.EnableThreadSafety()
+        try:
+            r.TFile.Open._threaded = True
+        except Exception:
+            pass #Attribute not available in this version of PyROOT, the files are then opened one at a time
+
+        pool = ThreadPool(max(1, self.threads))
+        stats = pool.map(statFile, paths)
+
+        toDescribe = []
+        for path, stat in zip(paths, stats):
+            entry = self.entries.get(path)
+            if stat is not None and (entry is None or [entry["size"], entry["mtime"]] != list(stat)):
+                toDescribe.append((path, stat))
+
+        if len(toDescribe) > 0:
+            print("Reading the metadata of " + str(len(toDescribe)) + " new or modified file(s) out of " + str(len(paths)) + ".")
+            descriptions = pool.map(self.describe, [path for path, stat in toDescribe])
+            for (path, stat), description in zip(toDescribe, descriptions):
+                if description is None: #Not cached, it might only be a temporary problem of the storage
+                    self.entries.pop(path, None)
+                else:
+                    self.entries[path] = dict(description, size = stat[0], mtime = stat[1])
+            self.write()
+        pool.close()
+        pool.join()
+
+        results = {}
+        for path, stat in zip(paths, stats):
+            entry = self.entries.get(path)
+            results[path] = entry if stat is not None and entry is not None and [entry["size"], entry["mtime"]] == list(stat) else None
+        return results
+
+    def write(self):
+        """
+        Write the index, atomically so that an interrupted job creation does not leave a truncated index behind.
+        """
+
+        if self.cacheFile == "":
+            return
+        temporary = self.cacheFile + ".tmp" + str(os.getpid())
+        f = open(temporary, "w")
+        json.dump({"version": fileIndexVersion, "treeName": self.treeName, "files": self.entries}, f)
+        f.close()
+        os.rename(temporary, self.cacheFile)
+
+def hasTree(metadata):
+    """
+    Whether a scanned file could be opened and contains the tree, used to find the failed outputs.
+    """
+
+    return metadata is not None and metadata["entries"] >= 0
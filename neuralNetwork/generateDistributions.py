@@ -1,6 +1,13 @@
 
 import ROOT as r
 import os,  sys, fnmatch
+import optparse
+
+#Input directories of each year and cached listings
+import datasetCatalog
+
+#Local copies of the ttbar files, the next ones being copied while one is read
+from stagingCache import StagingCache, Prefetcher, openStaged
 import math
 
 """
@@ -29,20 +36,58 @@ def updateProgress(progress):
     sys.stdout.write(text)
     sys.stdout.flush()
 
+def chainEvents(paths, prefetcher = None, maxEvents = -1):
+    """
+    First maxEvents events (-1 for all) of the files one after the other, as a TChain would give them, each file being read from its prefetched
+    copy if any. The prefetcher is closed as soon as the file being read holds the last events needed, the next files not being read.
+    """
+
+    nEvents = 0
+    for path in paths:
+        inputFile = openStaged(lambda p: r.TFile.Open(p, "r"), prefetcher.get(path) if prefetcher is not None else path, path)
+        tree = inputFile.Get("Events")
+        if prefetcher is not None and maxEvents != -1 and nEvents + tree.GetEntries() >= maxEvents:
+            prefetcher.close()
+        for ev in tree:
+            if nEvents == maxEvents:
+                break
+            nEvents = nEvents + 1
+            yield ev
+        inputFile.Close()
+        if nEvents == maxEvents:
+            return
+
 #===============================================================================0
 #MAIN FUNCTION
 #===============================================================================0
 
+parser = optparse.OptionParser(usage='usage: %prog [opts]', version='%prog 1.0')
+parser.add_option('-y', '--year', action='store', type=int, dest='year', default=2018) #Year of the ttbar files of the dataset catalog
+parser.add_option('-i', '--inputDir', action='store', type=str, dest='inputDir', default="") #Directory of the ttbar files, instead of the one of the catalog
+parser.add_option('-c', '--catalog', action='store', type=str, dest='catalog', default="") #JSON file overriding the input directories of the dataset catalog (see datasetCatalog.py)
+parser.add_option('-q', '--query', action='store', type=str, dest='query', default="TTTo2L2Nu__part") #String to be matched when searching for the ttbar files
+parser.add_option('-o', '--output', action='store', type=str, dest='output', default="distributions.root") #File where the distributions are written
+parser.add_option('--stageDir', action='store', type=str, dest='stageDir', default="") #Local directory where the ttbar files are copied before being read (not staged if empty)
+parser.add_option('--stageSize', action='store', type=float, dest='stageSize', default=20.) #Size in GB of the staging directory, the least recently used copies being removed first
+parser.add_option('--prefetch', action='store', type=int, dest='prefetch', default=2) #Number of the next files staged in the background while the current one is read (needs stageDir)
+(opts, args) = parser.parse_args()
+
 #Let's consider the ttbar files in a chain
 #baseDir = os.getcwd()+"/"
-baseDir = "/eos/cms/store/group/phys_higgs/cmshww/amassiro/HWWNano/Autumn18_102X_nAODv6_Full2018v6/MCl1loose2018v6__MCCorr2018v6__l2loose__l2tightOR2018v6/"
-filesChain = r.TChain("Events")
-listOfFiles = os.listdir(baseDir)
-pattern = "*"+"TTTo2L2Nu__part"+"*.root"
+catalog = datasetCatalog.DatasetCatalog(opts.catalog)
+baseDir = opts.inputDir if opts.inputDir != "" else catalog.directory(opts.year, "latino", "mc")
+listOfFiles = catalog.listDirectory(baseDir)
+pattern = "*"+opts.query+"*.root"
 
+inputFiles = []
 for index, entry in enumerate(listOfFiles):
     if fnmatch.fnmatch(entry, pattern):
-        filesChain.AddFile(baseDir+entry)
+        inputFiles.append(baseDir+entry)
+
+#Instead of a TChain, the files are opened one after the other so that the next ones can be staged while one is read
+prefetcher = None
+if opts.stageDir != "":
+    prefetcher = Prefetcher(StagingCache(opts.stageDir, opts.stageSize), inputFiles, opts.prefetch if opts.prefetch > 0 else 1)
 
 #Define the histograms
 bwHist = r.TH1F("bw", "Breit-Wigner W boson distribution", 40, 60, 100)
@@ -59,14 +104,11 @@ lphatHist = r.TH1F("lphat", "Lepton angular distribution", 200, 0, 0.02)
 
 #Start the loop
 #nEvents = filesChain.GetEntries()
-nEvents = 100000
-for index, ev in enumerate(filesChain):
+nEvents = 100000 #For testing only
+for index, ev in enumerate(chainEvents(inputFiles, prefetcher, nEvents)):
     if index % 100 == 0: #Update the loading bar every 100 events                                                                                                                                              
             updateProgress(round(index/float(nEvents), 2))
 
-    if index == 100000: #For testing only
-        break
-
     #===================================================
     #First, get the simulation information
     #===================================================
@@ -168,6 +210,9 @@ for index, ev in enumerate(filesChain):
         except:
             pass
 
+if prefetcher is not None:
+    prefetcher.close()
+
 mlbHist.Scale(1.0/mlbHist.Integral())
 mlbHist.SetTitle("Generation mlb distribution")
 mlbHist.GetXaxis().SetTitle("mlb [GeV]")
@@ -206,7 +251,7 @@ bwHist.SetTitle("Breit-Wigner W boson distribution")
 bwHist.GetXaxis().SetTitle("W mass [GeV]")
 
 #Keep the histograms in a new file
-outputFile = r.TFile.Open("distributions.root", "recreate")
+outputFile = r.TFile.Open(opts.output, "recreate")
 
 mlbHist.Write()
 jerHistTrue.Write()
@@ -0,0 +1,150 @@
+#Progress heartbeats written by the createTrees.py jobs, used to find the jobs running far beyond the others (stragglers) and to run
+#a speculative copy of them, the first copy to finish keeping its output
+import os, json, time, socket
+
+def claimPath(directory, outputName, token):
+    return os.path.join(directory, os.path.basename(outputName) + "." + token + ".claim")
+
+class Heartbeat():
+    """
+    Progress of one copy of a job, written in directory/<job>.<host>.<pid>.json at most every interval seconds. The copies of a job
+    share the same token, given when the jobs are created: the first copy to finish an output claims it, and the other copies stop.
+    """
+
+    def __init__(self, directory, job, token, interval = 60.):
+        self.directory = directory
+        self.token = token
+        self.interval = interval
+        self.path = os.path.join(directory, job + "." + socket.gethostname() + "." + str(os.getpid()) + ".json")
+        self.state = {"job": job, "token": token, "host": socket.gethostname(), "pid": os.getpid(), "start": time.time(), "update": 0.,
+                      "input": 0, "inputs": 1, "output": "", "done": 0, "total": 1, "status": "running"}
+        self.lastWrite = 0.
+
+        try:
+            os.makedirs(directory)
+        except:
+            pass #Directory already exists, this is fine
+
+    def write(self):
+        self.state["update"] = time.time()
+        temporary = self.path + ".tmp"
+        f = open(temporary, "w")
+        json.dump(self.state, f)
+        f.close()
+        os.rename(temporary, self.path)
+        self.lastWrite = self.state["update"]
+
+    def startInput(self, index, inputs, outputName):
+        self.state.update(input = index, inputs = inputs, output = os.path.basename(outputName), done = 0)
+        self.write()
+
+    def setTotal(self, total):
+        self.state["total"] = max(total, 1)
+
+    def beat(self, done):
+        """
+        Record the number of events done for the current output. Return False if another copy of the job already finished it.
+        """
+
+        if time.time() - self.lastWrite < self.interval:
+            return True
+        self.state["done"] = done
+        self.write()
+        return not os.path.exists(claimPath(self.directory, self.state["output"], self.token))
+
+    def claim(self, outputName):
+        """
+        Claim an output before moving it to its final name, True only for the first copy of the job to finish it.
+        """
+
+        try:
+            os.close(os.open(claimPath(self.directory, outputName, self.token), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError:
+            return False
+        return True
+
+    def finish(self, status = "done"):
+        self.state["status"] = status
+        self.state["done"] = self.state["total"]
+        self.write()
+
+def latestRound(heartbeats):
+    """
+    Heartbeats of the last round of each job: the copies sharing the token of its most recently started copy. The jobs created again
+    (or resubmitted) with the same name leave the heartbeats of their previous rounds in the directory.
+    """
+
+    latest = {}
+    for heartbeat in heartbeats:
+        if heartbeat["job"] not in latest or heartbeat["start"] > latest[heartbeat["job"]]["start"]:
+            latest[heartbeat["job"]] = heartbeat
+    return [heartbeat for heartbeat in heartbeats if heartbeat.get("token") == latest[heartbeat["job"]].get("token")]
+
+def readHeartbeats(directory):
+    """
+    Heartbeats of the last round of each job found in directory.
+    """
+
+    heartbeats = []
+    if not os.path.isdir(directory):
+        return heartbeats
+    for name in os.listdir(directory):
+        if not name.endswith(".json"):
+            continue
+        try:
+            f = open(os.path.join(directory, name))
+            heartbeats.append(json.load(f))
+            f.close()
+        except Exception: #Being written
+            continue
+    return latestRound(heartbeats)
+
+def progress(heartbeat):
+    """
+    Fraction of the job done, all its inputs being assumed to take the same time.
+    """
+
+    return (heartbeat["input"] + min(heartbeat["done"], heartbeat["total"])/float(heartbeat["total"]))/heartbeat["inputs"]
+
+def median(values):
+    values = sorted(values)
+    return values[len(values)//2] if len(values) > 0 else None
+
+def findStragglers(heartbeats, factor = 3., minElapsed = 600., staleTime = 1800., now = None):
+    """
+    Jobs (by name) whose copies are all running, one of them being expected to take more than factor times the median duration
+    of the jobs (the finished ones if there are enough of them, otherwise the projections of the running ones), or not having
+    written any heartbeat for staleTime seconds. Return a list of (job, reason, number of copies running).
+    """
+
+    now = time.time() if now is None else now
+    jobs = {}
+    for heartbeat in heartbeats:
+        jobs.setdefault(heartbeat["job"], []).append(heartbeat)
+
+    finished = [heartbeat["update"] - heartbeat["start"] for heartbeat in heartbeats if heartbeat["status"] == "done"]
+    projections = {}
+    for heartbeat in heartbeats:
+        if heartbeat["status"] == "running":
+            fraction = progress(heartbeat)
+            projections[(heartbeat["job"], heartbeat["pid"], heartbeat["host"])] = (now - heartbeat["start"])/fraction if fraction > 0 else float("inf")
+    reference = median(finished) if len(finished) >= 3 else median([projection for projection in projections.values() if projection != float("inf")])
+
+    stragglers = []
+    for job, copies in jobs.items():
+        if any([copy["status"] == "done" for copy in copies]):
+            continue
+        running = [copy for copy in copies if copy["status"] == "running"]
+        if len(running) == 0:
+            continue
+
+        for copy in running:
+            elapsed = now - copy["start"]
+            if now - copy["update"] > staleTime:
+                stragglers.append((job, "no heartbeat for " + str(int(now - copy["update"])) + " s", len(running)))
+                break
+            projection = projections[(copy["job"], copy["pid"], copy["host"])]
+            if reference is not None and elapsed > minElapsed and projection > factor*reference:
+                stragglers.append((job, "expected " + str(int(projection)) + " s instead of " + str(int(reference)) + " s", len(running)))
+                break
+    return stragglers
@@ -0,0 +1,137 @@
+#Cost model of the createTrees.py jobs, estimated from the _timing.json summaries of the previous productions (or of a short calibration run),
+#used by createJobsTrees.py to split the files in event ranges taking about the same wall time, and by the job creators to bundle the small inputs
+import os, sys, fnmatch, json, re, math, bisect, subprocess
+
+#Directory of the timing summaries in each output directory
+from stageTimer import timingDirectory
+
+def sampleName(filename):
+    """
+    Sample of a latino file, the files of a sample sharing the same cost per event (nanoLatino_TTTo2L2Nu__part12.root -> nanoLatino_TTTo2L2Nu).
+    """
+
+    return re.sub(r"(__part\d+)?\.root$", "", os.path.basename(filename))
+
+def readTimings(directories):
+    """
+    Time per event (s/event) and overhead per job (s) of each sample, averaged over all the _timing.json summaries found in the timing
+    directories of the output directories.
+    """
+
+    totals = {} #Sample: [time spent in the event loop, events, overhead, jobs]
+    for outputDir in directories:
+        directory = os.path.join(outputDir, timingDirectory)
+        if not os.path.isdir(directory):
+            continue
+        for name in fnmatch.filter(os.listdir(directory), "*_timing.json"):
+            try:
+                f = open(os.path.join(directory, name))
+                summary = json.load(f)
+                f.close()
+                events = summary["counters"].get("events", 0)
+                eventTime = sum([stage["time"] for stage in summary["stages"].values()])
+                totalTime = summary["totalTime"]
+            except Exception: #Summary being written or from an older version, ignored
+                continue
+            if events <= 0:
+                continue
+
+            sample = sampleName(summary.get("filename", name))
+            total = totals.setdefault(sample, [0., 0, 0., 0])
+            total[0] = total[0] + eventTime
+            total[1] = total[1] + events
+            total[2] = total[2] + max(totalTime - eventTime, 0.)
+            total[3] = total[3] + 1
+
+    return dict([(sample, {"eventCost": total[0]/total[1], "overhead": total[2]/total[3], "events": total[1], "jobs": total[3]}) for sample, total in totals.items()])
+
+def calibrate(filenames, inputDir, outputDir, baseDir, nEvents, options = ""):
+    """
+    Run createTrees.py on the first nEvents events of each file, so that their _timing.json summaries can be used by the cost model.
+    Return the files for which the run failed.
+    """
+
+    failed = []
+    for filename in filenames:
+        print("  --> Calibration run on the first " + str(nEvents) + " events of " + filename)
+        command = [sys.executable, os.path.join(baseDir, "createTrees.py"), "-f", filename, "-i", inputDir, "-o", outputDir, "-b", baseDir,
+                   "--splitNumber", "0", "--firstEvent", "0", "--lastEvent", str(nEvents - 1)] + options.split()
+        log = open(os.devnull, "w")
+        if subprocess.call(command, stdout = log, stderr = subprocess.STDOUT) != 0:
+            failed.append(filename)
+        log.close()
+    return failed
+
+class CostModel():
+    """
+    Estimated wall time of the jobs of each sample. The samples without any timing summary get the median cost of the known samples,
+    or defaultEventCost if none is known.
+    """
+
+    def __init__(self, timings, defaultEventCost = 0.05, jobOverhead = 60.):
+        self.timings = timings
+        self.jobOverhead = jobOverhead
+
+        costs = sorted([timing["eventCost"] for timing in timings.values()])
+        self.defaultEventCost = costs[len(costs)//2] if len(costs) > 0 else defaultEventCost
+
+    def isKnown(self, filename):
+        return sampleName(filename) in self.timings
+
+    def eventCost(self, filename):
+        timing = self.timings.get(sampleName(filename))
+        return timing["eventCost"] if timing is not None else self.defaultEventCost
+
+    def overhead(self, filename):
+        """
+        Time spent by a job outside of the event loop: the startup (CMSSW environment, imports, mt2 compilation) and the writing of the output.
+        """
+
+        timing = self.timings.get(sampleName(filename))
+        return self.jobOverhead + (timing["overhead"] if timing is not None else 0.)
+
+    def jobTime(self, filename, nEvents):
+        return self.overhead(filename) + nEvents*self.eventCost(filename)
+
+    def splitRanges(self, filename, nEntries, targetTime, clusters = []):
+        """
+        Split the entries of a file in (firstEvent, lastEvent) ranges (both included) expected to take at most about targetTime each,
+        the boundaries being moved to the nearest cluster boundary of the tree so that no basket is read by two jobs.
+        """
+
+        if nEntries <= 0:
+            return []
+
+        eventTime = max(targetTime - self.overhead(filename), 0.1*targetTime) #Time left for the event loop in each job
+        nJobs = max(1, min(nEntries, int(math.ceil(nEntries*self.eventCost(filename)/eventTime))))
+
+        boundaries = [0]
+        for job in range(1, nJobs):
+            boundary = (job*nEntries)//nJobs
+            if len(clusters) > 1:
+                position = bisect.bisect_left(clusters, boundary)
+                candidates = clusters[max(position - 1, 0):position + 1]
+                boundary = min(candidates, key = lambda cluster: abs(cluster - boundary))
+            if boundaries[-1] < boundary < nEntries:
+                boundaries.append(boundary)
+        boundaries.append(nEntries)
+
+        return [(boundaries[i], boundaries[i+1] - 1) for i in range(len(boundaries) - 1)]
+
+def packJobs(items, sizes, maxSize, times = None, maxTime = 0.):
+    """
+    Group consecutive items (files or event ranges, kept in their order so that the files of a sample stay together) in bundles
+    of at most maxSize (and at most maxTime if times are given), each bundle being processed by a single job. An item larger than
+    the limits gets its own job.
+    """
+
+    bundles, size, time = [], 0., 0.
+    for i, item in enumerate(items):
+        itemTime = times[i] if times is not None else 0.
+        if len(bundles) == 0 or size + sizes[i] > maxSize or (maxTime > 0 and time + itemTime > maxTime):
+            bundles.append([])
+            size, time = 0., 0.
+        bundles[-1].append(item)
+        size = size + sizes[i]
+        time = time + itemTime
+    return bundles
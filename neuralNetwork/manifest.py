@@ -0,0 +1,94 @@
+#Completion manifests written by the jobs once their outputs are complete (input range, entries written, size, checksum and timing),
+#used by the job creators to find the jobs to resubmit without opening the outputs. They are kept in a hidden directory next to the outputs,
+#so that the listings of the outputs (evaluation, training, plots) never take them for trees
+import os, json, time, socket, zlib
+
+#To be increased each time the content of the manifests changes, the older manifests then being ignored
+manifestVersion = 1
+
+manifestDirectory = ".manifests"
+
+def manifestPath(outputPath):
+    directory, name = os.path.split(outputPath)
+    return os.path.join(directory, manifestDirectory, name.replace('.root', '') + '.json')
+
+def checksum(path):
+    """
+    Adler-32 checksum of the content of a file, as given by xrdadler32 and eos.
+    """
+
+    value = 1
+    f = open(path, "rb")
+    for block in iter(lambda: f.read(1 << 20), b""):
+        value = zlib.adler32(block, value)
+    f.close()
+    return "%08x" % (value & 0xffffffff)
+
+def removeManifest(outputPath):
+    """
+    Remove the manifest of an output about to be written again, so that a job failing in the middle does not leave a valid manifest behind.
+    """
+
+    try:
+        os.remove(manifestPath(outputPath))
+    except OSError:
+        pass #No previous manifest
+
+def writeManifest(outputPath, inputName, firstEvent, lastEvent, entries, startTime, **extra):
+    """
+    Write the manifest of a complete output, atomically and only once the output has its final name: an output without manifest is incomplete.
+    """
+
+    info = os.stat(outputPath)
+    manifest = {"version": manifestVersion, "output": os.path.basename(outputPath), "input": os.path.basename(inputName),
+                "firstEvent": firstEvent, "lastEvent": lastEvent, "entries": entries, "size": info.st_size, "adler32": checksum(outputPath),
+                "start": startTime, "end": time.time(), "wallTime": time.time() - startTime, "host": socket.gethostname()}
+    manifest.update(extra)
+
+    try:
+        os.makedirs(os.path.dirname(manifestPath(outputPath)))
+    except:
+        pass #Directory already exists, this is fine
+
+    temporary = manifestPath(outputPath) + ".tmp" + str(os.getpid())
+    f = open(temporary, "w")
+    json.dump(manifest, f, indent = 2, sort_keys = True)
+    f.close()
+    os.rename(temporary, manifestPath(outputPath))
+
+def readManifest(outputPath):
+    """
+    Manifest of an output, None if it is missing, unreadable or from an older version.
+    """
+
+    try:
+        f = open(manifestPath(outputPath))
+        manifest = json.load(f)
+        f.close()
+    except (IOError, OSError, ValueError):
+        return None
+    return manifest if manifest.get("version") == manifestVersion else None
+
+def isComplete(outputPath, inputName = None, firstEvent = None, lastEvent = None, verify = False):
+    """
+    Whether an output was completed for this input and event range, and was not modified or truncated since (same size, and same
+    checksum if verify). Only the manifest is read, unless verify is used.
+    """
+
+    manifest = readManifest(outputPath)
+    if manifest is None:
+        return False
+    if inputName is not None and manifest["input"] != os.path.basename(inputName):
+        return False
+    if firstEvent is not None and [manifest["firstEvent"], manifest["lastEvent"]] != [firstEvent, lastEvent]:
+        return False
+    if "inputEntries" in manifest and manifest["entries"] != manifest["inputEntries"]: #Every input event is kept by the evaluation
+        return False
+
+    try:
+        size = os.path.getsize(outputPath)
+    except OSError:
+        return False
+    if size != manifest["size"]:
+        return False
+    return not verify or checksum(outputPath) == manifest["adler32"]
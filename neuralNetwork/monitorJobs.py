@@ -0,0 +1,131 @@
+#Follow the createTrees.py jobs through their heartbeats and submit a speculative copy of the stragglers to condor, the first copy
+#of a job to finish keeping its output while the other one stops. The failed jobs, which leave no output behind, can be submitted again
+import os, sys, time, subprocess
+import optparse
+import heartbeat
+
+def formatTime(seconds):
+    return "%d:%02d:%02d" % (seconds//3600, (seconds % 3600)//60, seconds % 60)
+
+#The markers of the copies already submitted are kept per round of the job (its token), so that a job created again gets new copies
+def speculatedPath(heartbeatDir, job, token):
+    return os.path.join(heartbeatDir, job + "." + token + ".speculated")
+
+def resubmittedPath(heartbeatDir, job, token):
+    return os.path.join(heartbeatDir, job + "." + token + ".resubmitted")
+
+def findFailed(heartbeats):
+    """
+    Jobs (by name) whose copies all failed: none of them is running or done.
+    """
+
+    done = set([hb["job"] for hb in heartbeats if hb["status"] == "done"])
+    running = set([hb["job"] for hb in heartbeats if hb["status"] == "running"])
+    return sorted(set([hb["job"] for hb in heartbeats if hb["status"] == "failed"]) - done - running)
+
+def submitCopies(jobs, tokens, scriptDir, heartbeatDir, condorTemplate, markerPath = speculatedPath):
+    """
+    Submit one more copy of each job with the condor description of condorTemplate, each round of a job (given by tokens) being copied
+    at most once (marked by the file markerPath(heartbeatDir, job, token)). Return the jobs submitted.
+    """
+
+    scripts = []
+    for job in jobs:
+        script = os.path.join(scriptDir, job + ".sh")
+        if os.path.exists(markerPath(heartbeatDir, job, tokens[job])):
+            continue
+        if not os.path.exists(script):
+            print("  --> " + script + " not found, " + job + " can not be copied.")
+            continue
+        scripts.append(script)
+    if len(scripts) == 0:
+        return []
+
+    f = open(condorTemplate)
+    lines = [line for line in f.readlines() if not line.strip().startswith("queue")]
+    f.close()
+    description = "".join(lines) + "queue filename in (" + " ".join(scripts) + ")\n"
+
+    process = subprocess.Popen(["condor_submit", "-"], stdin = subprocess.PIPE)
+    process.communicate(description.encode())
+    if process.returncode != 0:
+        print("  --> condor_submit failed with exit code " + str(process.returncode) + ".")
+        return []
+
+    submitted = [os.path.basename(script).replace('.sh', '') for script in scripts]
+    for job in submitted:
+        open(markerPath(heartbeatDir, job, tokens[job]), "w").close()
+    return submitted
+
+def printStatus(heartbeats, now):
+    done = set([hb["job"] for hb in heartbeats if hb["status"] == "done"])
+    running = [hb for hb in heartbeats if hb["status"] == "running" and hb["job"] not in done]
+    failed = set([hb["job"] for hb in heartbeats if hb["status"] == "failed"]) - done
+    print("[" + time.strftime("%H:%M:%S") + "] running: " + str(len(running)) + ", done: " + str(len(done)) + ", failed: " + str(len(failed)))
+    for hb in sorted(running, key = lambda hb: heartbeat.progress(hb)):
+        fraction = heartbeat.progress(hb)
+        elapsed = now - hb["start"]
+        line = "  " + hb["job"] + " (" + hb["host"] + ", pid " + str(hb["pid"]) + "): " + str(round(100*fraction, 1)) + "%, " + formatTime(elapsed)
+        if fraction > 0:
+            line = line + ", remaining: ~" + formatTime(elapsed/fraction - elapsed)
+        print(line)
+    sys.stdout.flush()
+
+########################## Main program #####################################
+if __name__ == "__main__":
+
+    # ===========================================
+    # Argument parser
+    # ===========================================
+    parser = optparse.OptionParser(usage='usage: %prog [opts]', version='%prog 1.0')
+    parser.add_option('-d', '--heartbeatDir', action='store', type=str, dest='heartbeatDir', default="heartbeats") #Directory given to createJobsTrees.py with the same option
+    parser.add_option('-f', '--factor', action='store', type=float, dest='factor', default=3.) #A job is a straggler if it is expected to take this many times the median job time
+    parser.add_option('-e', '--minElapsed', action='store', type=float, dest='minElapsed', default=600.) #Seconds a job has to run before being considered a straggler
+    parser.add_option('-t', '--staleTime', action='store', type=float, dest='staleTime', default=1800.) #A job without heartbeat for this many seconds is a straggler
+    parser.add_option('-s', '--submit', action='store_true', dest='submit', default=False) #Submit a copy of each straggler to condor, otherwise they are only listed
+    parser.add_option('-r', '--resubmitFailed', action='store_true', dest='resubmitFailed', default=False) #Submit once more the jobs whose copies all failed, otherwise they are only listed
+    parser.add_option('-c', '--condor', action='store', type=str, dest='condor', default="condorjob.tcl") #Condor description used for the copies, its queue statement being replaced
+    parser.add_option('--scriptDir', action='store', type=str, dest='scriptDir', default="sh") #Directory of the job scripts written by createJobsTrees.py
+    parser.add_option('-w', '--watch', action='store', type=float, dest='watch', default=0.) #Check the jobs again every this many seconds until they are all done (0: check once)
+    parser.add_option('-v', '--verbose', action='store_true', dest='verbose')
+    (opts, args) = parser.parse_args()
+
+    if opts.verbose:
+        print("=================================================")
+        print("OPTIONS USED:")
+        print("Heartbeat directory: " + str(opts.heartbeatDir))
+        print("Straggler factor: " + str(opts.factor) + ", minimum time: " + str(opts.minElapsed) + " s, stale time: " + str(opts.staleTime) + " s")
+        print("Submit: " + str(opts.submit) + ", resubmit failed: " + str(opts.resubmitFailed) + " (" + str(opts.condor) + ")")
+        print("Watch: " + str(opts.watch) + " s")
+        print("=================================================")
+
+    while True:
+        now = time.time()
+        heartbeats = heartbeat.readHeartbeats(opts.heartbeatDir) #Only the last round of each job
+        tokens = dict([(hb["job"], hb["token"]) for hb in heartbeats])
+        if opts.verbose:
+            printStatus(heartbeats, now)
+
+        stragglers = heartbeat.findStragglers(heartbeats, opts.factor, opts.minElapsed, opts.staleTime, now)
+        for job, reason, copies in stragglers:
+            speculated = os.path.exists(speculatedPath(opts.heartbeatDir, job, tokens[job]))
+            print("  --> Straggler " + job + ": " + reason + " (" + str(copies) + " cop" + ("ies" if copies > 1 else "y") + " running" + (", already copied" if speculated else "") + ")")
+        if opts.submit and len(stragglers) > 0:
+            submitted = submitCopies([job for job, reason, copies in stragglers], tokens, opts.scriptDir, opts.heartbeatDir, opts.condor)
+            if len(submitted) > 0:
+                print("Submitted a copy of " + str(len(submitted)) + " job(s): " + ", ".join(submitted))
+
+        failed = findFailed(heartbeats)
+        for job in failed:
+            resubmitted = os.path.exists(resubmittedPath(opts.heartbeatDir, job, tokens[job]))
+            print("  --> Failed " + job + (" (already resubmitted)" if resubmitted else ""))
+        if opts.resubmitFailed and len(failed) > 0:
+            submitted = submitCopies(failed, tokens, opts.scriptDir, opts.heartbeatDir, opts.condor, resubmittedPath)
+            if len(submitted) > 0:
+                print("Resubmitted " + str(len(submitted)) + " failed job(s): " + ", ".join(submitted))
+
+        done = set([hb["job"] for hb in heartbeats if hb["status"] == "done"])
+        running = set([hb["job"] for hb in heartbeats if hb["status"] == "running"]) - done #A copy killed by condor stays running
+        if opts.watch <= 0 or (len(heartbeats) > 0 and len(running) == 0):
+            break
+        time.sleep(opts.watch)
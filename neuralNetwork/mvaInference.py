@@ -0,0 +1,186 @@
+#Helpers used by runMVA.py to evaluate the trained networks on batches of events instead of one event at a time through the TMVA reader,
+#either with Keras or with a pure NumPy implementation of the dense networks, exported after the training
+import xml.etree.ElementTree as ElementTree
+import numpy as np
+
+def readWeightsXml(weightsFile):
+    """
+    Read the input variables, the normalization (VarTransform=N) and the trained model file name from a TMVA PyKeras weights file.
+    """
+
+    root = ElementTree.parse(weightsFile).getroot()
+
+    options = dict([(option.get("name"), option.text) for option in root.iter("Option")])
+    variables = [variable.get("Expression") for variable in root.find("Variables").findall("Variable")]
+
+    #The reader normalizes the inputs with the ranges of all the classes together, stored as the last class of the transformation
+    minimums = -np.ones(len(variables))
+    maximums = np.ones(len(variables))
+    for transform in root.find("Transformations").findall("Transform"):
+        if transform.get("Name") != "Normalize":
+            raise ValueError("Unsupported input transformation " + str(transform.get("Name")) + " in " + weightsFile)
+        allClasses = max(transform.findall("Class"), key = lambda cls: int(cls.get("ClassIndex")))
+        for inputRange in allClasses.find("Ranges").findall("Range"):
+            minimums[int(inputRange.get("Index"))] = float(inputRange.get("Min"))
+            maximums[int(inputRange.get("Index"))] = float(inputRange.get("Max"))
+
+    return {"variables": variables, "min": minimums, "max": maximums, "trainedModel": options.get("FilenameTrainedModel")}
+
+def normalize(inputs, minimums, maximums):
+    """
+    Same linear transformation to [-1, 1] as the TMVA Normalize transformation.
+    """
+
+    scale = maximums - minimums
+    scale = np.where(scale > 0, scale, 1.)
+    return ((2.*(inputs - minimums)/scale) - 1.).astype(np.float32)
+
+def readColumns(tree, expressions, first, nEntries):
+    """
+    Read the values of the expressions for nEntries entries of a tree, starting at first, as a (nEntries, len(expressions)) array.
+    Each expression has to give exactly one value per entry (Lepton_pt[1] would skip the events with a single lepton).
+    """
+
+    tree.SetEstimate(nEntries + 1)
+    option = "goff para" if len(expressions) > 1 else "goff" #More than 4 expressions are only allowed with the para option
+    n = tree.Draw(":".join(expressions), "", option, nEntries, first)
+    if n != nEntries:
+        raise ValueError("Read " + str(n) + " values instead of " + str(nEntries) + " for " + ":".join(expressions) + ", every expression must have one value per event")
+
+    columns = np.empty((n, len(expressions)))
+    for i in range(len(expressions)):
+        values = tree.GetVal(i)
+        values.SetSize(n)
+        columns[:, i] = np.frombuffer(values, dtype = np.float64, count = n)
+    return columns
+
+def categories(scores):
+    """
+    Category with the highest output, with the same tie-breaking as the per event evaluation (0 unless another output is strictly higher).
+    """
+
+    category = np.zeros(len(scores), dtype = np.int32)
+    category[(scores[:, 1] > scores[:, 2]) & (scores[:, 1] > scores[:, 0])] = 1
+    category[(scores[:, 2] > scores[:, 1]) & (scores[:, 2] > scores[:, 0])] = 2
+    return category
+
+def predictFolds(models, inputs, events):
+    """
+    Outputs of the k models of a k-fold training, each event being evaluated by the model of its fold (event % k), not trained on it.
+    """
+
+    folds = events.astype(np.int64) % len(models)
+    outputs = None
+    for fold, model in enumerate(models):
+        selected = folds == fold
+        if not selected.any():
+            continue
+        values = model.predict(inputs[selected])
+        if outputs is None:
+            outputs = np.empty((len(inputs), values.shape[1]), dtype = values.dtype)
+        outputs[selected] = values
+    return outputs
+
+class KerasModel():
+    """
+    Trained Keras model of a TMVA PyKeras weights file, evaluated on batches of events with the normalization used during the training.
+    """
+
+    def __init__(self, weightsFile, batchSize = 10000):
+        from keras.models import load_model
+
+        self.weightsFile = weightsFile
+        self.batchSize = batchSize
+        self.config = readWeightsXml(weightsFile)
+        self.variables = self.config["variables"]
+        self.model = load_model(self.config["trainedModel"])
+
+    def predict(self, inputs):
+        """
+        Outputs of the network for a (nEvents, nVariables) array of raw input variables.
+        """
+
+        return self.model.predict(normalize(inputs, self.config["min"], self.config["max"]), batch_size = self.batchSize)
+
+#=========================================================================================================
+# NUMPY MODELS
+#=========================================================================================================
+def softmax(x):
+    exponentials = np.exp(x - x.max(axis = 1, keepdims = True))
+    return exponentials/exponentials.sum(axis = 1, keepdims = True)
+
+activations = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0.),
+    "tanh": np.tanh,
+    "sigmoid": lambda x: 1./(1. + np.exp(-x)),
+    "softmax": softmax
+}
+
+def exportModel(weightsFile, outputFile):
+    """
+    Write the layers of the trained Keras model of a TMVA PyKeras weights file, with its input variables and normalization, in a .npz file.
+    """
+
+    from keras.models import load_model
+
+    config = readWeightsXml(weightsFile)
+    exportLayers(load_model(config["trainedModel"]), config["variables"], config["min"], config["max"], outputFile)
+
+def exportLayers(model, variables, minimums, maximums, outputFile):
+    """
+    Write the layers of a trained Keras model, with its input variables and normalization ranges, in a .npz file.
+    Only sequential networks made of Dense, Activation and Dropout layers are supported.
+    """
+
+    layers = [] #[weights, biases, activation] of each dense layer
+    for layer in model.layers:
+        layerType = layer.__class__.__name__
+        if layerType == "Dense":
+            weights, biases = layer.get_weights()
+            layers.append([weights, biases, layer.get_config()["activation"]])
+        elif layerType == "Activation" and len(layers) > 0 and layers[-1][2] == "linear":
+            layers[-1][2] = layer.get_config()["activation"]
+        elif layerType != "Dropout": #Dropout does nothing once trained
+            raise ValueError("Layer " + layer.name + " of type " + layerType + " can not be exported")
+
+    for layer in layers:
+        if layer[2] not in activations:
+            raise ValueError("Unsupported activation " + layer[2])
+
+    arrays = {"variables": np.array(variables), "min": np.asarray(minimums, dtype = np.float64), "max": np.asarray(maximums, dtype = np.float64), "activations": np.array([layer[2] for layer in layers])}
+    for i, layer in enumerate(layers):
+        arrays["weights" + str(i)] = layer[0].astype(np.float32)
+        arrays["biases" + str(i)] = layer[1].astype(np.float32)
+
+    f = open(outputFile, "wb")
+    np.savez(f, **arrays)
+    f.close()
+
+def asString(value):
+    """
+    Strings saved with python 2 are read back as bytes with python 3.
+    """
+    return value if isinstance(value, str) else value.decode()
+
+class NumpyModel():
+    """
+    Dense network exported by exportModel, evaluated with NumPy only.
+    """
+
+    def __init__(self, modelFile):
+        arrays = np.load(modelFile)
+        self.variables = [asString(variable) for variable in arrays["variables"]]
+        self.minimums = arrays["min"]
+        self.maximums = arrays["max"]
+        self.layers = [(arrays["weights" + str(i)], arrays["biases" + str(i)], activations[asString(activation)]) for i, activation in enumerate(arrays["activations"])]
+
+    def predict(self, inputs):
+        """
+        Outputs of the network for a (nEvents, nVariables) array of raw input variables.
+        """
+
+        values = normalize(inputs, self.minimums, self.maximums)
+        for weights, biases, activation in self.layers:
+            values = activation(np.dot(values, weights) + biases)
+        return values
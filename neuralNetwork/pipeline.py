@@ -0,0 +1,410 @@
+#Make-like runner of the whole chain generateDistributions.py -> createTrees.py -> runMVA.py (training) -> runMVA.py -e, described in
+#pipeline.json. Each task gets a signature, the hash of its command, configuration, code, inputs and of the signatures of the tasks it
+#depends on: only the tasks whose signature changed since their last success (or whose outputs are missing) are run again, the
+#independent ones (years, samples) in parallel
+import os, sys, json, time, fnmatch, hashlib, subprocess
+import optparse
+
+#Content hashes, file sizes and modification times
+from recoCache import fileHash
+from fileIndex import statFile
+
+#Samples of the latino files and grouping of the small files in the same task
+import jobCost
+
+#Completion manifests of the trees and evaluated files
+import manifest
+
+#Names of the trained models
+import runMVA
+
+from runJobsLocally import concurrency, formatTime
+
+#To be increased each time the way the tasks are described changes, all of them being then run again
+pipelineVersion = 2
+
+#Code changing the outputs of each stage, relative to the directory of this script (see also the code of each task in buildTasks)
+stageCode = {
+    "distributions": ["generateDistributions.py"],
+    "trees": ["createTrees.py", "ttbarReco/eventKinematic.py", "ttbarReco/nuSolutions.py", "ttbarReco/ttResults.py", "ttbarReco/ttbar.py",
+              "ttbarReco/ttbarDM.py", "mt2Calculation/lester_mt2_bisect.h", "recoCache.py", "stagingCache.py"],
+    "train": ["runMVA.py", "mvaInference.py", "datasetCache.py"],
+    "evaluate": ["runMVA.py", "mvaInference.py"],
+}
+
+def treesDir(inputDir, outputDir):
+    """
+    Directory of the outputs of createTrees.py for the files of inputDir, named after their production (as in createTrees.outputPath).
+    """
+
+    return outputDir + "/".join(inputDir.split('/')[-3:-1]) + "/"
+
+def newTask(name, stage, command, outputs, deps = [], inputs = [], contentInputs = [], config = {}, manifests = False, code = []):
+    """
+    Task of the pipeline: its command, the tasks it depends on, the external inputs identified by their size and modification time
+    (the latino files, never modified in place and too large to be read only to be hashed), the inputs identified by their content
+    (distributions.root), the configuration not already in the command, the outputs, checked with their manifest if manifests, and
+    the code used by this task in addition to the one of its stage.
+    """
+
+    return {"name": name, "stage": stage, "command": command, "outputs": outputs, "deps": list(deps), "inputs": list(inputs),
+            "contentInputs": list(contentInputs), "config": config, "manifests": manifests, "code": list(code)}
+
+def readConfig(path):
+    f = open(path)
+    config = json.load(f)
+    f.close()
+    return config
+
+def listInputs(inputDir, query):
+    """
+    Latino files of a directory matching the query, grouped by sample.
+    """
+
+    samples = {}
+    for filename in sorted(fnmatch.filter(os.listdir(inputDir), 'nanoLatino*' + query + '*.root')):
+        samples.setdefault(jobCost.sampleName(filename), []).append(filename)
+    return samples
+
+def bundleFiles(inputDir, filenames, bundleSize):
+    """
+    Files of a sample processed by the same task, up to bundleSize MB of input (0: all the files of the sample in the same task).
+    """
+
+    if bundleSize <= 0:
+        return [filenames]
+    return jobCost.packJobs(filenames, [os.path.getsize(inputDir + filename)/1024./1024. for filename in filenames], bundleSize)
+
+def trainingOutputs(baseDir, year, massPoints, options):
+    """
+    Models written by the training, the ones read by the evaluation with these options.
+    """
+
+    names = ["parametrized"] if options["parametrized"] else massPoints
+    outputs = []
+    for name in names:
+        if options["folds"] > 0:
+            outputs = outputs + [runMVA.weightsFile(baseDir, year, name, "_fold" + str(fold) + ".npz") for fold in range(options["folds"])]
+        elif options["mode"] == "numpy":
+            outputs.append(runMVA.weightsFile(baseDir, year, name, ".npz"))
+        else:
+            outputs.append(runMVA.weightsFile(baseDir, year, name))
+    return outputs
+
+def buildTasks(config, baseDir, years = None):
+    """
+    Tasks of the pipeline described by the configuration, in an order where each task comes after the ones it depends on.
+    """
+
+    python = sys.executable
+    tasks = []
+    distributions = baseDir + "distributions.root"
+
+    #Distributions used by the smearing of the reconstruction, only generated if described (otherwise the one of the repository is used)
+    distributionsTasks = []
+    if config.get("distributions") is not None:
+        inputDir, query = config["distributions"]["inputDir"], config["distributions"]["query"]
+        inputs = [inputDir + filename for files in listInputs(inputDir, query).values() for filename in files]
+        tasks.append(newTask("distributions", "distributions", [python, baseDir + "generateDistributions.py", "-i", inputDir, "-q", query, "-o", distributions],
+                             [distributions], inputs = inputs))
+        distributionsTasks = ["distributions"]
+
+    training = config.get("training", {})
+    evaluation = config.get("evaluation", {})
+    massPoints = [str(item) for item in config["massPoints"].split(",")]
+    options = runMVA.evaluationOptions(massPoints, evaluation.get("batch", False), evaluation.get("numpy", False), training.get("parametrized", False), training.get("folds", 0))
+
+    for year in sorted(config["years"]):
+        if years is not None and year not in years:
+            continue
+        yearConfig = config["years"][year]
+        outputDir = yearConfig.get("outputDir", config["outputDir"])
+
+        #Trees of each sample, the files of a sample being bundled in tasks of about bundleSize MB of input. The networks evaluated
+        #in the same pass (mvaDir tree option) are part of their code
+        treeTasks = {} #Output directory: {filename: task}
+        treeCode = ["runMVA.py", "mvaInference.py"] if "--mvaDir" in config.get("treeOptions", "").split() else []
+        for inputDir in yearConfig["inputDirs"]:
+            directory = treesDir(inputDir, outputDir)
+            for sample, filenames in sorted(listInputs(inputDir, yearConfig.get("query", "*")).items()):
+                bundles = bundleFiles(inputDir, filenames, config.get("bundleSize", 0.))
+                for i, bundle in enumerate(bundles):
+                    name = "trees/" + year + "/" + sample.replace("nanoLatino_", "", 1) + ("/" + str(i) if len(bundles) > 1 else "")
+                    command = [python, baseDir + "createTrees.py", "--files", ",".join(bundle), "-i", inputDir, "-o", outputDir, "-b", baseDir] + config.get("treeOptions", "").split()
+                    tasks.append(newTask(name, "trees", command, [directory + filename for filename in bundle], distributionsTasks,
+                                         inputs = [inputDir + filename for filename in bundle], contentInputs = [distributions], manifests = True, code = treeCode))
+                    for filename in bundle:
+                        treeTasks.setdefault(directory, {})[filename] = name
+
+        #Training on the trees of the signal and background samples of the year
+        trainingFiles = {"s": [], "b": []}
+        for key, queries in [("s", yearConfig["signalQuery"]), ("b", yearConfig["backgroundQuery"])]:
+            for query in queries.split(","):
+                for directory in sorted(treeTasks):
+                    trainingFiles[key] = trainingFiles[key] + [(directory, filename) for filename in sorted(fnmatch.filter(treeTasks[directory].keys(), 'nanoLatino*' + query + '*'))]
+        directories = set([directory for directory, filename in trainingFiles["s"] + trainingFiles["b"]])
+        if len(trainingFiles["s"]) == 0 or len(trainingFiles["b"]) == 0:
+            print("No signal or background trees found for " + year + ", the training and evaluation are skipped.")
+            continue
+        if len(directories) > 1:
+            raise ValueError("The training files of " + year + " are in several directories: " + ", ".join(sorted(directories)))
+        trainingDir = directories.pop()
+
+        command = [python, baseDir + "runMVA.py", "-i", trainingDir, "-d", baseDir, "-y", year,
+                   "-s", ",".join([filename for directory, filename in trainingFiles["s"]]), "-b", ",".join([filename for directory, filename in trainingFiles["b"]])]
+        if training.get("datasetDir", "") != "":
+            command = command + ["-D", training["datasetDir"]]
+        if training.get("streaming", False):
+            command.append("-S")
+        if training.get("parametrized", False):
+            command.append("-P")
+        if training.get("folds", 0) > 0:
+            command = command + ["-k", str(training["folds"])]
+        trainingDeps = sorted(set([treeTasks[directory][filename] for directory, filename in trainingFiles["s"] + trainingFiles["b"]]))
+        trainingName = "train/" + year
+        tasks.append(newTask(trainingName, "train", command, trainingOutputs(baseDir, year, massPoints, options), trainingDeps))
+
+        #Evaluation of the trees of all the samples, with the same bundles as their trees
+        for directory in sorted(treeTasks):
+            bundles = {}
+            for filename, name in treeTasks[directory].items():
+                bundles.setdefault(name, []).append(filename)
+            for name in sorted(bundles):
+                filenames = sorted(bundles[name])
+                command = [python, baseDir + "runMVA.py", "-e", "-i", directory, "-d", baseDir, "-y", year, "-m", ",".join(massPoints), "-f", ",".join(filenames)]
+                if evaluation.get("batch", False):
+                    command.append("-B")
+                if evaluation.get("numpy", False):
+                    command.append("-N")
+                if training.get("parametrized", False):
+                    command.append("-P")
+                if training.get("folds", 0) > 0:
+                    command = command + ["-k", str(training["folds"])]
+                tasks.append(newTask(name.replace("trees/", "evaluate/", 1), "evaluate", command, [directory[:-1] + "_weighted/" + filename for filename in filenames],
+                                     [name, trainingName], manifests = True))
+
+    return tasks
+
+def selectTasks(tasks, targets):
+    """
+    Tasks matching one of the target patterns, with all the tasks they depend on.
+    """
+
+    byName = dict([(task["name"], task) for task in tasks])
+    selected = set()
+    toVisit = [task["name"] for task in tasks if any([fnmatch.fnmatch(task["name"], target) for target in targets])]
+    while len(toVisit) > 0:
+        name = toVisit.pop()
+        if name not in selected:
+            selected.add(name)
+            toVisit = toVisit + byName[name]["deps"]
+    return [task for task in tasks if task["name"] in selected]
+
+class PipelineState():
+    """
+    Signature of the last successful run of each task and content hashes of the files, kept in a JSON file. The content hash of a file
+    is only computed again if its size or modification time changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tasks, self.hashes = {}, {}
+        if os.path.exists(path):
+            f = open(path)
+            state = json.load(f)
+            f.close()
+            if state.get("version") == pipelineVersion:
+                self.tasks, self.hashes = state["tasks"], state["hashes"]
+
+    def contentHash(self, path):
+        stat = statFile(path)
+        if stat is None:
+            return None
+        cached = self.hashes.get(path)
+        if cached is None or [cached["size"], cached["mtime"]] != list(stat):
+            cached = {"size": stat[0], "mtime": stat[1], "md5": fileHash(path)}
+            self.hashes[path] = cached
+        return cached["md5"]
+
+    def write(self):
+        temporary = self.path + ".tmp" + str(os.getpid())
+        f = open(temporary, "w")
+        json.dump({"version": pipelineVersion, "tasks": self.tasks, "hashes": self.hashes}, f, indent = 1, sort_keys = True)
+        f.close()
+        os.rename(temporary, self.path)
+
+class PipelineRunner():
+    """
+    Run the stale tasks of the pipeline on a pool of processes, each task being started once all the tasks it depends on are done.
+    The signature of a task is computed only then, so that it sees the outputs of these tasks.
+    """
+
+    def __init__(self, tasks, state, baseDir, logDir, processes, force = [], dryRun = False):
+        self.tasks = tasks
+        self.state = state
+        self.baseDir = baseDir
+        self.logDir = logDir
+        self.processes = processes
+        self.force = force
+        self.dryRun = dryRun
+
+        self.byName = dict([(task["name"], task) for task in tasks])
+        self.signatures = {}
+        self.running = {} #Task name: (process, log file, start time)
+        self.upToDate, self.done, self.failed, self.skipped = [], [], [], []
+
+        try:
+            os.makedirs(logDir)
+        except:
+            pass #Directory already exists, this is fine
+
+    def signature(self, task):
+        """
+        Hash of everything the outputs of the task depend on. Each dependency enters with its signature and the end of its last successful
+        run, so that a dependency run again with the same signature (forced, missing output, smearing being random) makes the task stale.
+        """
+
+        description = {"version": pipelineVersion, "command": task["command"], "config": task["config"],
+                       "code": dict([(path, self.state.contentHash(self.baseDir + path)) for path in stageCode[task["stage"]] + task.get("code", [])]),
+                       "inputs": dict([(path, statFile(path)) for path in task["inputs"]]),
+                       "contentInputs": dict([(path, self.state.contentHash(path)) for path in task["contentInputs"]]),
+                       "deps": dict([(dep, [self.signatures[dep], self.state.tasks.get(dep, {}).get("end")]) for dep in task["deps"]])}
+        return hashlib.md5(json.dumps(description, sort_keys = True).encode()).hexdigest()
+
+    def staleReason(self, task, signature):
+        """
+        Why the task has to be run, None if it is up to date.
+        """
+
+        if any([fnmatch.fnmatch(task["name"], pattern) for pattern in self.force]):
+            return "forced"
+        record = self.state.tasks.get(task["name"])
+        if record is None:
+            return "never run"
+        ranDeps = [dep for dep in task["deps"] if dep in self.done]
+        if len(ranDeps) > 0:
+            return "dependency " + ranDeps[0] + (" would run" if self.dryRun else " was run again")
+        if record["signature"] != signature:
+            return "inputs, code or configuration changed"
+        for output in task["outputs"]:
+            if not os.path.exists(output) or (task["manifests"] and not manifest.isComplete(output)):
+                return "missing or incomplete output " + os.path.basename(output)
+        return None
+
+    def logPath(self, task):
+        return os.path.join(self.logDir, task["name"].replace("/", "_") + ".log")
+
+    def start(self, task):
+        log = open(self.logPath(task), "w")
+        process = subprocess.Popen(task["command"], stdout = log, stderr = subprocess.STDOUT, cwd = self.baseDir)
+        self.running[task["name"]] = (process, log, time.time())
+
+    def poll(self):
+        for name, (process, log, startTime) in list(self.running.items()):
+            code = process.poll()
+            if code is None:
+                continue
+            log.close()
+            del self.running[name]
+
+            if code == 0:
+                self.done.append(name)
+                self.state.tasks[name] = {"signature": self.signatures[name], "end": time.time(), "wallTime": time.time() - startTime}
+                self.state.write()
+                print("  --> " + name + " done in " + formatTime(time.time() - startTime))
+            else:
+                self.failed.append(name)
+                print("  --> " + name + " failed with exit code " + str(code) + ", see " + os.path.basename(self.logPath(self.byName[name])))
+            sys.stdout.flush()
+
+    def run(self):
+        pending = list(self.tasks)
+        startTime = time.time()
+        try:
+            while len(pending) > 0 or len(self.running) > 0:
+                self.poll()
+                finished = set(self.upToDate + self.done)
+                stopped = set(self.failed + self.skipped)
+                for task in list(pending):
+                    if any([dep in stopped for dep in task["deps"]]):
+                        pending.remove(task)
+                        self.skipped.append(task["name"])
+                        continue
+                    if not all([dep in finished for dep in task["deps"]]):
+                        continue
+                    if task["name"] not in self.signatures:
+                        self.signatures[task["name"]] = self.signature(task)
+                        reason = self.staleReason(task, self.signatures[task["name"]])
+                        if reason is None:
+                            pending.remove(task)
+                            self.upToDate.append(task["name"])
+                            finished.add(task["name"])
+                            continue
+                        print(("  --> Would run " if self.dryRun else "  --> Stale ") + task["name"] + ": " + reason)
+                        if self.dryRun: #Assumed to succeed, so that the tasks depending on it are listed as well
+                            pending.remove(task)
+                            self.done.append(task["name"])
+                            finished.add(task["name"])
+                            continue
+                    if len(self.running) < self.processes:
+                        pending.remove(task)
+                        self.start(task)
+                if len(self.running) > 0:
+                    time.sleep(1)
+        except KeyboardInterrupt: #Stop the running tasks as well, they will be run again the next time
+            print("Interrupted, killing the " + str(len(self.running)) + " running task(s).")
+            for name, (process, log, taskStart) in self.running.items():
+                process.kill()
+                process.wait()
+                log.close()
+            raise
+        finally:
+            self.state.write()
+
+        print("[" + formatTime(time.time() - startTime) + "] up to date: " + str(len(self.upToDate)) + (", to run: " if self.dryRun else ", done: ") + str(len(self.done)) +
+              ", failed: " + str(len(self.failed)) + ", skipped because of a failed dependency: " + str(len(self.skipped)))
+        return self.failed
+
+########################## Main program #####################################
+if __name__ == "__main__":
+
+    # ===========================================
+    # Argument parser
+    # ===========================================
+    parser = optparse.OptionParser(usage='usage: %prog [opts] [task patterns]', version='%prog 1.0')
+    parser.add_option('-c', '--config', action='store', type=str, dest='config', default="pipeline.json") #Description of the productions, training and evaluation
+    parser.add_option('-s', '--state', action='store', type=str, dest='state', default="pipelineState.json") #File keeping the signature of the last successful run of each task
+    parser.add_option('-y', '--years', action='store', type=str, dest='years', default="") #Comma separated years to be considered (all the years of the configuration if empty)
+    parser.add_option('-j', '--processes', action='store', type=int, dest='processes', default=0) #Number of tasks run at the same time (0: one per core)
+    parser.add_option('-m', '--memoryPerJob', action='store', type=float, dest='memoryPerJob', default=2.) #Memory in GB needed by each task, limiting the number of tasks run at the same time (0: no limit)
+    parser.add_option('-l', '--logDir', action='store', type=str, dest='logDir', default="log/pipeline") #Directory of the logs of each task
+    parser.add_option('-f', '--force', action='store', type=str, dest='force', default="") #Comma separated patterns of the tasks to be run even if they are up to date
+    parser.add_option('-n', '--dryRun', action='store_true', dest='dryRun', default=False) #Only list the tasks that would be run, and why
+    parser.add_option('-v', '--verbose', action='store_true', dest='verbose')
+    (opts, args) = parser.parse_args()
+
+    baseDir = os.path.dirname(os.path.abspath(__file__)) + "/"
+    config = readConfig(opts.config)
+    years = [str(item) for item in opts.years.split(",")] if opts.years != "" else None
+    tasks = buildTasks(config, baseDir, years)
+    if len(args) > 0: #Only the tasks matching the patterns given (trees/2018/*, train/2017...) and the ones they depend on
+        tasks = selectTasks(tasks, args)
+    processes = concurrency(opts.processes, opts.memoryPerJob)
+
+    if opts.verbose:
+        print("=================================================")
+        print("OPTIONS USED:")
+        print("Configuration: " + str(opts.config))
+        print("State: " + str(opts.state))
+        print("Years: " + str(opts.years if years is not None else "all"))
+        print("Processes: " + str(processes))
+        print("Force: " + str(opts.force))
+        print("Dry run: " + str(opts.dryRun))
+        print("=================================================")
+
+    print(str(len(tasks)) + " task(s) in the pipeline.")
+    runner = PipelineRunner(tasks, PipelineState(opts.state), baseDir, opts.logDir, processes, [item for item in opts.force.split(",") if item != ""], opts.dryRun)
+    failed = runner.run()
+    if len(failed) > 0:
+        print(str(len(failed)) + " task(s) failed: " + ", ".join(failed))
+        sys.exit(1)
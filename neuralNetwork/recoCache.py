@@ -0,0 +1,98 @@
+#Persistent cache of the ttbar reconstruction outputs, so that createTrees.py only runs the reconstruction for the events whose inputs or configuration changed
+import os, fnmatch, json, gzip, hashlib
+
+#To be increased each time the reconstruction code changes in a way that changes its results
+recoCacheVersion = 2
+
+def fileHash(path):
+    """
+    Hash of the content of a file.
+    """
+
+    md5 = hashlib.md5()
+    f = open(path, "rb")
+    for block in iter(lambda: f.read(1 << 20), b""):
+        md5.update(block)
+    f.close()
+    return md5.hexdigest()
+
+def configHash(config):
+    """
+    Hash of the reconstruction configuration, given as a dictionary (smearing, distributions.root hash, b-tagging threshold...).
+    """
+
+    config = dict(config, recoCacheVersion = recoCacheVersion)
+    return hashlib.md5(json.dumps(config, sort_keys = True).encode()).hexdigest()
+
+def inputHash(values):
+    """
+    Hash of the inputs of the reconstruction of an event, given as a list of numbers.
+    """
+
+    return hashlib.md5(",".join(["%.9g" % value for value in values]).encode()).hexdigest()
+
+class RecoCache():
+    """
+    Reconstruction outputs of the events of one input file, keyed by (run, lumi, event) and valid for one configuration hash.
+    Each job writes its own shard, named after its event range, and reads all the shards of the file: the shards of another splitting
+    are kept, and still used, instead of being overwritten.
+    """
+
+    def __init__(self, cacheDir, filename, firstEvent, lastEvent, configHash):
+        self.cacheDir = cacheDir
+        self.configHash = configHash
+        stem = filename.replace('.root', '')
+        eventRange = "all" if lastEvent == -1 else str(max(firstEvent, 0)) + "-" + str(lastEvent)
+        self.shard = os.path.join(cacheDir, stem + "__" + eventRange + "." + configHash + ".json.gz")
+
+        try:
+            os.makedirs(cacheDir)
+        except:
+            pass #Directory already exists, this is fine
+
+        self.entries = {}
+        for shard in fnmatch.filter(os.listdir(cacheDir), stem + "__*." + configHash + ".json.gz"):
+            try:
+                f = gzip.open(os.path.join(cacheDir, shard), "rb")
+                self.entries.update(json.loads(f.read().decode()))
+                f.close()
+            except Exception as e: #A corrupted shard only means these events will be reconstructed again
+                print("Ignoring the reconstruction cache shard " + shard + ": " + str(e))
+
+        self.used = {} #Entries to be written in the shard of this job
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def key(run, lumi, event):
+        return str(run) + ":" + str(lumi) + ":" + str(event)
+
+    def lookup(self, run, lumi, event, inputHash):
+        """
+        Return the cached result of an event, or None if it is missing or its inputs changed.
+        """
+
+        key = self.key(run, lumi, event)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != inputHash:
+            self.misses = self.misses + 1
+            return None
+
+        self.hits = self.hits + 1
+        self.used[key] = entry
+        return entry[1]
+
+    def store(self, run, lumi, event, inputHash, result):
+        key = self.key(run, lumi, event)
+        self.entries[key] = [inputHash, result]
+        self.used[key] = self.entries[key]
+
+    def write(self):
+        """
+        Write the shard of this job, atomically so that a failed job does not leave a truncated shard behind.
+        """
+
+        temporary = self.shard + ".tmp" + str(os.getpid())
+        f = gzip.open(temporary, "wb")
+        f.write(json.dumps(self.used).encode())
+        f.close()
+        os.rename(temporary, self.shard)
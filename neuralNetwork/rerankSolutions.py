@@ -0,0 +1,155 @@
+#Code used to choose again the best ttbar reconstruction solution from the candidates kept by createTrees.py -a, without running the reconstruction
+import ROOT as r
+from array import array
+import optparse
+import os, sys
+
+#Reference masses and widths, as used by the ttbar reconstruction and its smearing
+mt = 173.0
+mW = 80.379
+widthTop = 1.41
+widthW = 2.085
+
+#=========================================================================================================
+# HELPERS
+#=========================================================================================================
+#Progress bar
+def updateProgress(progress):
+    barLength = 20 # Modify this to change the length of the progress bar
+    status = ""
+    if isinstance(progress, int):
+        progress = float(progress)
+    if not isinstance(progress, float):
+        progress = 0
+        status = "error: progress var must be float\r\n"
+    if progress < 0:
+        progress = 0
+        status = "Halt...\r\n"
+    if progress >= 1:
+        progress = 1
+        status = "Done!\r\n"
+    block = int(round(barLength*progress))
+    text = "\rProgress: [{0}] {1}% {2}".format( "#"*block + "-"*(barLength-block), progress*100, status)
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+#=========================================================================================================
+# RANKING CRITERIA
+#=========================================================================================================
+#Each criteria gives a score to the solution s of the candidate c, the solution with the lowest score being kept
+def scoreWeight(ev, c, s):
+    """
+    Highest mlb weight, then smallest invariant mass (default choice of createTrees.py).
+    """
+    return (-ev.Candidate_weight[c], ev.Solution_mt1[s] + ev.Solution_mt2[s])
+
+def scoreMinMass(ev, c, s):
+    """
+    Smallest sum of the top quarks invariant masses.
+    """
+    return (ev.Solution_mt1[s] + ev.Solution_mt2[s], -ev.Candidate_weight[c])
+
+def scoreChi2(ev, c, s):
+    """
+    Smallest chi2 with respect to the top quark and W boson masses, relevant for the smeared candidates.
+    """
+    chi2 = ((ev.Solution_mt1[s] - mt)/widthTop)**2 + ((ev.Solution_mt2[s] - mt)/widthTop)**2 + ((ev.Solution_mW1[s] - mW)/widthW)**2 + ((ev.Solution_mW2[s] - mW)/widthW)**2
+    return (chi2, -ev.Candidate_weight[c])
+
+criteria = {
+    "weight": scoreWeight,
+    "minMass": scoreMinMass,
+    "chi2": scoreChi2
+}
+
+#=========================================================================================================
+# RERANKING
+#=========================================================================================================
+def rerankSolutions(inputDir, filename, criteriaNames, test):
+    """
+    Add, for each criteria, the index and the variables of the best candidate/solution to the trees.
+    """
+
+    try:
+        os.makedirs(inputDir[:-1] + '_reranked/')
+    except:
+        pass
+
+    inputFile = r.TFile.Open(inputDir+filename, "READ")
+    inputTree = inputFile.Get("Events")
+    outputFile = r.TFile.Open(inputDir[:-1] + '_reranked/' + filename, "RECREATE")
+    outputTree = inputTree.CloneTree(0)
+
+    branches = {}
+    for criteriaName in criteriaNames:
+        for variable in ["candidateIdx", "solutionIdx"]:
+            name = criteriaName + "_" + variable
+            branches[name] = array("i", [0])
+            outputTree.Branch(name, branches[name], name + "/I")
+        for variable in ["reco_weight", "dark_pt", "overlapping_factor"]:
+            name = criteriaName + "_" + variable
+            branches[name] = array("f", [0.])
+            outputTree.Branch(name, branches[name], name + "/F")
+
+    nEvents = inputTree.GetEntries()
+    if test:
+        nEvents = 1000
+
+    for index, ev in enumerate(inputTree):
+
+        if index % 1000 == 0: #Update the loading bar every 1000 events
+            updateProgress(round(index/float(nEvents), 2))
+
+        #For testing only
+        if test and index == nEvents:
+            break
+
+        for criteriaName in criteriaNames:
+            bestScore = None
+            bestSolution = -1
+            for s in range(ev.nSolution):
+                score = criteria[criteriaName](ev, ev.Solution_candidateIdx[s], s)
+                if bestScore is None or score < bestScore:
+                    bestScore = score
+                    bestSolution = s
+
+            if bestSolution != -1:
+                c = ev.Solution_candidateIdx[bestSolution]
+                branches[criteriaName + "_candidateIdx"][0] = c
+                branches[criteriaName + "_solutionIdx"][0] = bestSolution
+                branches[criteriaName + "_reco_weight"][0] = ev.Candidate_weight[c]
+                branches[criteriaName + "_dark_pt"][0] = ev.Candidate_dark_pt[c]
+                branches[criteriaName + "_overlapping_factor"][0] = ev.Candidate_overlapping_factor[c]
+            else: #Same default values as createTrees.py if the reco failed
+                branches[criteriaName + "_candidateIdx"][0] = -1
+                branches[criteriaName + "_solutionIdx"][0] = -1
+                branches[criteriaName + "_reco_weight"][0] = -99.0
+                branches[criteriaName + "_dark_pt"][0] = -99.0
+                branches[criteriaName + "_overlapping_factor"][0] = -99.0
+
+        outputTree.Fill()
+
+    outputFile.cd()
+    outputTree.Write()
+    inputFile.Close()
+    outputFile.Close()
+
+
+if __name__ == "__main__":
+
+    # ===========================================
+    # Argument parser
+    # ===========================================
+    parser = optparse.OptionParser(usage='usage: %prog [opts] FilenameWithSamples', version='%prog 1.0')
+    parser.add_option('-f', '--filename', action='store', type=str, dest='filename', default='', help='Name of the file produced by createTrees.py -a')
+    parser.add_option('-i', '--inputDir', action='store', type=str, dest='inputDir', default="")
+    parser.add_option('-c', '--criteria', action='store', type=str, dest='criteria', default="weight,minMass,chi2", help='Comma separated ranking criteria among ' + ', '.join(sorted(criteria.keys())))
+    parser.add_option('-t', '--test', action='store_true', dest='test')
+    (opts, args) = parser.parse_args()
+
+    criteriaNames = [str(item) for item in opts.criteria.split(",")]
+    for criteriaName in criteriaNames:
+        if criteriaName not in criteria:
+            parser.error("Unknown ranking criteria " + criteriaName)
+
+    rerankSolutions(opts.inputDir, opts.filename, criteriaNames, opts.test)
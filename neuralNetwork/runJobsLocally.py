@@ -0,0 +1,184 @@
+#Run the job scripts written by the createJobs*.py scripts (sh/send_*.sh) on the local machine, on a bounded pool of processes,
+#instead of submitting them to condor with condorjob.tcl
+import os, sys, glob, time, subprocess
+import multiprocessing
+import optparse
+
+def availableMemory():
+    """
+    Memory available for new processes in GB, read from /proc/meminfo (None if unknown).
+    """
+
+    try:
+        f = open("/proc/meminfo")
+        lines = f.readlines()
+        f.close()
+    except IOError:
+        return None
+    for line in lines:
+        if line.startswith("MemAvailable:"):
+            return int(line.split()[1])/1024./1024.
+    return None
+
+def concurrency(processes, memoryPerJob):
+    """
+    Number of jobs run at the same time: the requested number (one per core by default), limited by the memory available.
+    """
+
+    if processes <= 0:
+        processes = multiprocessing.cpu_count()
+    memory = availableMemory()
+    if memoryPerJob > 0 and memory is not None:
+        processes = min(processes, max(1, int(memory/memoryPerJob)))
+    return processes
+
+def formatTime(seconds):
+    return "%d:%02d:%02d" % (seconds//3600, (seconds % 3600)//60, seconds % 60)
+
+class LocalRunner():
+    """
+    Pool of job scripts run as separate processes, each job writing its output in its own log file and being retried if it fails.
+    The jobs that succeeded are marked with a .done file in the log directory, so that they are skipped when the runner is started again.
+    """
+
+    def __init__(self, scripts, logDir, processes, retries = 1, summaryInterval = 30.):
+        self.queue = list(scripts)
+        self.logDir = logDir
+        self.processes = processes
+        self.retries = retries
+        self.summaryInterval = summaryInterval
+
+        self.attempts = dict([(script, 0) for script in scripts])
+        self.running = {} #Script: (process, log file, start time)
+        self.done, self.failed = [], []
+        self.jobTimes = []
+
+        try:
+            os.makedirs(logDir)
+        except:
+            pass #Directory already exists, this is fine
+
+    def jobName(self, script):
+        return os.path.basename(script).replace('.sh', '')
+
+    def donePath(self, script):
+        return os.path.join(self.logDir, self.jobName(script) + ".done")
+
+    def isDone(self, script):
+        """
+        Whether the job succeeded after its script was last written (a job created again by the createJobs*.py scripts is run again).
+        """
+
+        return os.path.exists(self.donePath(script)) and os.path.getmtime(self.donePath(script)) >= os.path.getmtime(script)
+
+    def skipDone(self):
+        finished = [script for script in self.queue if self.isDone(script)]
+        self.queue = [script for script in self.queue if script not in finished]
+        return finished
+
+    def start(self, script):
+        self.attempts[script] = self.attempts[script] + 1
+        log = open(os.path.join(self.logDir, self.jobName(script) + "." + str(self.attempts[script]) + ".log"), "w")
+        process = subprocess.Popen(["/bin/bash", script], stdout = log, stderr = subprocess.STDOUT)
+        self.running[script] = (process, log, time.time())
+
+    def poll(self):
+        """
+        Collect the finished jobs, putting back in the queue the failed ones that still have retries left.
+        """
+
+        for script, (process, log, startTime) in list(self.running.items()):
+            code = process.poll()
+            if code is None:
+                continue
+            log.close()
+            del self.running[script]
+
+            if code == 0:
+                self.done.append(script)
+                self.jobTimes.append(time.time() - startTime)
+                open(self.donePath(script), "w").close()
+            elif self.attempts[script] <= self.retries:
+                print("  --> " + self.jobName(script) + " failed with exit code " + str(code) + ", retrying (" + str(self.attempts[script]) + "/" + str(self.retries) + ")")
+                self.queue.append(script)
+            else:
+                print("  --> " + self.jobName(script) + " failed with exit code " + str(code) + ", see its logs in " + self.logDir)
+                self.failed.append(script)
+
+    def printSummary(self, startTime):
+        elapsed = time.time() - startTime
+        finished = len(self.done) + len(self.failed)
+        line = "[" + formatTime(elapsed) + "] running: " + str(len(self.running)) + ", queued: " + str(len(self.queue))
+        line = line + ", done: " + str(len(self.done)) + ", failed: " + str(len(self.failed))
+        if finished > 0 and elapsed > 0:
+            rate = finished/elapsed
+            line = line + ", " + str(round(3600*rate, 1)) + " jobs/h"
+            if len(self.jobTimes) > 0:
+                line = line + ", mean job time: " + formatTime(sum(self.jobTimes)/len(self.jobTimes))
+            line = line + ", remaining: ~" + formatTime((len(self.queue) + len(self.running))/rate)
+        print(line)
+        sys.stdout.flush()
+
+    def run(self):
+        startTime = time.time()
+        lastSummary = 0.
+        try:
+            while len(self.queue) > 0 or len(self.running) > 0:
+                self.poll()
+                while len(self.queue) > 0 and len(self.running) < self.processes:
+                    self.start(self.queue.pop(0))
+                if len(self.running) > 0 and time.time() - lastSummary > self.summaryInterval:
+                    self.printSummary(startTime)
+                    lastSummary = time.time()
+                time.sleep(1)
+        except KeyboardInterrupt: #Stop the running jobs as well, they will be run again the next time
+            print("Interrupted, killing the " + str(len(self.running)) + " running job(s).")
+            for script, (process, log, jobStart) in self.running.items():
+                process.kill()
+                process.wait()
+                log.close()
+            raise
+
+        self.printSummary(startTime)
+        return self.failed
+
+########################## Main program #####################################
+if __name__ == "__main__":
+
+    # ===========================================
+    # Argument parser
+    # ===========================================
+    parser = optparse.OptionParser(usage='usage: %prog [opts]', version='%prog 1.0')
+    parser.add_option('-s', '--scripts', action='store', type=str, dest='scripts', default="sh/send_*.sh") #Job scripts to be run (glob pattern)
+    parser.add_option('-j', '--processes', action='store', type=int, dest='processes', default=0) #Number of jobs run at the same time (0: one per core)
+    parser.add_option('-m', '--memoryPerJob', action='store', type=float, dest='memoryPerJob', default=2.) #Memory in GB needed by each job, limiting the number of jobs run at the same time (0: no limit)
+    parser.add_option('-r', '--retries', action='store', type=int, dest='retries', default=1) #Number of times a failed job is run again
+    parser.add_option('-l', '--logDir', action='store', type=str, dest='logDir', default="log/local") #Directory of the logs of each job
+    parser.add_option('-i', '--summaryInterval', action='store', type=float, dest='summaryInterval', default=30.) #Seconds between two summaries of the progress
+    parser.add_option('-a', '--all', action='store_true', dest='all') #Also run the jobs that already succeeded in a previous run
+    parser.add_option('-v', '--verbose', action='store_true', dest='verbose')
+    (opts, args) = parser.parse_args()
+
+    scripts = sorted(glob.glob(opts.scripts))
+    processes = concurrency(opts.processes, opts.memoryPerJob)
+    runner = LocalRunner(scripts, opts.logDir, processes, opts.retries, opts.summaryInterval)
+    if not opts.all:
+        skipped = runner.skipDone()
+        if len(skipped) > 0:
+            print(str(len(skipped)) + " job(s) already done are skipped (use -a to run them again).")
+
+    if opts.verbose:
+        print("=================================================")
+        print("OPTIONS USED:")
+        print("Scripts: " + str(opts.scripts) + " (" + str(len(scripts)) + " found)")
+        print("Processes: " + str(processes))
+        print("Memory per job: " + str(opts.memoryPerJob) + " GB")
+        print("Retries: " + str(opts.retries))
+        print("Log directory: " + str(opts.logDir))
+        print("=================================================")
+
+    print("Running " + str(len(runner.queue)) + " job(s), " + str(processes) + " at a time.")
+    failed = runner.run()
+    if len(failed) > 0:
+        print(str(len(failed)) + " job(s) failed: " + ", ".join([runner.jobName(script) for script in failed]))
+        sys.exit(1)
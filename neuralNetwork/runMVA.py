@@ -2,15 +2,28 @@ import ROOT
 from subprocess import call
 from os.path import isfile
 
-from keras.models import Sequential
-from keras.layers import Dense, Activation, Dropout
-from keras.regularizers import l2
-from keras.optimizers import SGD, RMSprop, Adam
-from keras.models import load_model
+#Keras is only imported when training, so that the evaluation with the exported NumPy models does not need it
 #from keras.utils import plot_model
 
-import optparse, os, fnmatch, sys
+import optparse, os, fnmatch, sys, time, json, re
+import multiprocessing
 from array import array
+import numpy as np
+
+#Batched evaluation of the trained networks
+import mvaInference
+
+#Training datasets cached in memory-mapped arrays
+import datasetCache
+
+#Stamps of the evaluated outputs
+import evaluationStamp
+
+#Completion manifests of the evaluated files, read by createJobsEvaluateMVA.py to find the jobs to resubmit
+import manifest
+
+#Local copies of the evaluated files
+from stagingCache import StagingCache, Prefetcher, openStaged
 
 # ===========================================
 # Arguments to be updated
@@ -24,6 +37,12 @@ variables = ["PuppiMET_pt", "mt2ll", "dphillmet", "dark_pt", "nbJet", "mblt"]
 trainPercentage = 50
 normalizeProcesses = True #Normalize all the processes to have the same input training events in each case
 
+#Staging cache of the evaluated files, set by the --stageDir option (read from their directory if None), and prefetcher of the next
+#files of the job (--prefetch option, also used for the files of the training dataset)
+staging = None
+prefetcher = None
+prefetchDepth = 0
+
 #=========================================================================================================
 # HELPERS
 #=========================================================================================================
@@ -57,7 +76,35 @@ def updateProgress(progress):
     sys.stdout.write(text)
     sys.stdout.flush()
 
-def splitByProcess(inputFiles, test = False, background = False):
+def openInput(path):
+    if prefetcher is not None:
+        local = prefetcher.get(path)
+    else:
+        local = staging.stage(path) if staging is not None else path
+    return openStaged(lambda p: ROOT.TFile.Open(p, "READ"), local, path)
+
+def outputPrefix(massPoint, massPoints):
+    """
+    Prefix of the output branches of a mass point: PyKeras_output if a single mass point is evaluated, PyKeras_<massPoint> otherwise
+    """
+    if len(massPoints) == 1:
+        return "PyKeras_output"
+    return "PyKeras_" + massPoint
+
+def bookOutputBranches(outputTree, prefix):
+    """
+    Book the output branches of one model, considering exactly 3 processes (two signals and one common background)
+    """
+
+    outputs = {}
+    for output in ["signal0", "signal1", "bkg"]:
+        outputs[output] = array("f", [0.])
+        outputTree.Branch(prefix + "_" + output, outputs[output], prefix + "_" + output + "/F")
+    outputs["category"] = array("i", [0]) #Which category gets the highest softmax output?
+    outputTree.Branch(prefix + "_category", outputs["category"], prefix + "_category/I")
+    return outputs
+
+def splitByProcess(inputFiles, test = False, background = False, parametrized = False):
     processes = [] #List of dictionnaries with the different processes as keys and a list of files as values
     
     for inputFile in inputFiles:
@@ -66,6 +113,10 @@ def splitByProcess(inputFiles, test = False, background = False):
         end = "__part"
         process = inputFile[inputFile.find(start)+len(start):inputFile.rfind(end)].replace('_ext', '')
 
+        #For the parametrized network, all the mass points of a signal are the same process, the masses being inputs of the network
+        if parametrized:
+            process = re.sub(r"_?Mchi_?\d+_Mphi_?\d+", "", process)
+
         #However, at least for now, let's group all the background processes if the option is set
         if background:
             process = 'backgrounds'
@@ -81,6 +132,41 @@ def splitByProcess(inputFiles, test = False, background = False):
 
     return processes
 
+#=========================================================================================================
+# MODELS
+#=========================================================================================================
+#Hidden layers and Adam learning rate of the different architectures
+architectures = {
+    "Adam1": ([20, 15, 10, 5], 0.005),
+    "Adam2": ([20, 15, 10, 5], 0.001),
+    "Adam3": ([20, 15, 10, 5], 0.0005),
+    "Juan": ([15, 10, 5], 0.005) #Repeat 2016 analysis
+}
+
+def buildModel(hiddenLayers, learningRate, numberInputs, numberProcesses):
+    """
+    Dense network with relu hidden layers and a softmax output, compiled with Adam
+    """
+
+    from keras.models import Sequential
+    from keras.layers import Dense
+    from keras.optimizers import Adam
+
+    model = Sequential()
+    model.add(Dense(hiddenLayers[0], activation='relu', input_dim=numberInputs))
+    for hiddenLayer in hiddenLayers[1:]:
+        model.add(Dense(hiddenLayer, activation='relu'))
+    model.add(Dense(numberProcesses, activation='softmax'))
+
+    model.compile(loss='categorical_crossentropy', optimizer=Adam(learningRate), metrics=['accuracy', 'mse'])
+    return model
+
+def juanModel(numberInputs, numberProcesses):
+    """
+    Network of the 2016 analysis
+    """
+    return buildModel(architectures["Juan"][0], architectures["Juan"][1], numberInputs, numberProcesses)
+
 #=========================================================================================================
 # TRAINING
 #=========================================================================================================
@@ -192,34 +278,13 @@ def trainMVA(baseDir, inputDir, year, backgroundFiles, signalFiles, test):
     # ===========================================
     # Keras model with grid search
     # ===========================================
-    model = Sequential()
-    model.add(Dense(20, activation='relu', input_dim=len(variables)))
-    model.add(Dense(15, activation='relu'))
-    model.add(Dense(10, activation='relu'))
-    model.add(Dense(5, activation='relu'))
-    model.add(Dense(numberProcesses, activation='softmax'))
-
-    # Set loss and optimizer and save the model
-    model.compile(loss='categorical_crossentropy', optimizer=Adam(0.005), metrics=['accuracy', 'mse'])
-    model.save(outputDirTraining+'Adam1.h5')
-    model.summary()
-
-    model.compile(loss='categorical_crossentropy', optimizer=Adam(0.001), metrics=['accuracy', 'mse'])
-    model.save(outputDirTraining+'Adam2.h5')
-    model.summary()
-
-    model.compile(loss='categorical_crossentropy', optimizer=Adam(0.0005), metrics=['accuracy', 'mse'])
-    model.save(outputDirTraining+'Adam3.h5')
-    model.summary()
+    for name in ["Adam1", "Adam2", "Adam3"]:
+        model = buildModel(architectures[name][0], architectures[name][1], len(variables), numberProcesses)
+        model.save(outputDirTraining+name+'.h5')
+        model.summary()
 
     #Repeat 2016 analysis
-    model = Sequential()
-    model.add(Dense(15, activation='relu', input_dim=len(variables)))
-    model.add(Dense(10, activation='relu'))
-    model.add(Dense(5, activation='relu'))
-    model.add(Dense(numberProcesses, activation='softmax'))
-
-    model.compile(loss='categorical_crossentropy', optimizer=Adam(0.005), metrics=['accuracy', 'mse'])
+    model = juanModel(len(variables), numberProcesses)
     model.save(outputDirTraining+'Juan.h5')
     model.summary()
 
@@ -237,13 +302,308 @@ def trainMVA(baseDir, inputDir, year, backgroundFiles, signalFiles, test):
     factory.TestAllMethods()
     factory.EvaluateAllMethods()
 
+    #Export the trained network for the evaluation without Keras
+    exportMVA(baseDir, year, massPoint)
+
+def splitTrainTest(counts, seed = 100):
+    """
+    Random training and testing indexes of the events of each process (stored one process after the other), with the same numbers of
+    events as the TMVA dataloader: trainPercentage/testPercentage of the smallest process for all the processes if normalizeProcesses is set
+    """
+
+    random = np.random.RandomState(seed)
+    minEvents = min(counts)
+    trainIndexes, testIndexes = [], []
+    first = 0
+    for count in counts:
+        if normalizeProcesses:
+            numberEvents = minEvents
+        else:
+            numberEvents = count
+        nTrain = int(numberEvents*trainPercentage/100)
+        nTest = int(numberEvents*(100 - trainPercentage)/100)
+
+        permutation = first + random.permutation(count)
+        trainIndexes.append(permutation[:nTrain])
+        testIndexes.append(permutation[nTrain:nTrain+nTest])
+        first = first + count
+
+    #Sorted to read the memory-mapped arrays in order
+    return np.sort(np.concatenate(trainIndexes)), np.sort(np.concatenate(testIndexes))
+
+def splitFold(dataset, folds, fold, seed = 100):
+    """
+    Training indexes (events of the other folds) and testing indexes (events of the fold) of a k-fold training, the fold of each event
+    being given by its event number (event % folds). If normalizeProcesses is set, all the processes keep the same number of training events
+    """
+
+    events = np.asarray(dataset.event)
+    labels = np.asarray(dataset.y)
+    inFold = events % folds == fold
+
+    trainIndexes = [np.flatnonzero(~inFold & (labels == label)) for label in range(len(dataset.labels))]
+    if normalizeProcesses:
+        random = np.random.RandomState(seed)
+        minEvents = min([len(indexes) for indexes in trainIndexes])
+        trainIndexes = [np.sort(random.permutation(indexes)[:minEvents]) for indexes in trainIndexes]
+
+    return np.sort(np.concatenate(trainIndexes)), np.flatnonzero(inFold)
+
+def loadTrainingDataset(inputDir, backgroundFiles, signalFiles, test, datasetDir, parametrized = False):
+    """
+    Cached dataset of the signal processes and of the backgrounds, built the first time these files are used
+    """
+
+    signalProcesses = splitByProcess(signalFiles, test, False, parametrized)
+    backgroundProcesses = splitByProcess(backgroundFiles, test, True)
+    processes = [list(process.items())[0] for process in signalProcesses + backgroundProcesses]
+
+    print(bcolors.WARNING + "\n --> I found " + str(len(signalProcesses)) + " signal processes and " + str(len(backgroundProcesses)) + " background processes.")
+    print("Please check if these numbers seem to be correct! \n" + bcolors.ENDC)
+
+    return datasetCache.buildDataset(datasetDir, inputDir, processes, variables, parametrized = parametrized, staging = staging, prefetch = prefetchDepth)
+
+def trainArchitecture(task):
+    """
+    Train one network on a cached dataset and return its metrics. The task is a dictionary with the dataset path, the hidden layers and
+    learning rate, the file names of the trained model and of its NumPy export, and optionally the number of threads to be used and
+    whether the events should be streamed (see trainStreaming)
+    """
+
+    if "threads" in task: #Has to be set before Keras is imported in this process
+        os.environ["OMP_NUM_THREADS"] = str(task["threads"])
+    from keras.utils import to_categorical
+
+    dataset = datasetCache.TrainingDataset(task["dataset"])
+    numberProcesses = len(dataset.labels)
+    epochs, batchSize = task.get("epochs", 200), task.get("batchSize", 200)
+
+    start = time.time()
+    model = buildModel(task["hiddenLayers"], task["learningRate"], len(dataset.inputs), numberProcesses)
+    model.summary()
+
+    if task.get("streaming", False):
+        history, testMetrics, minimums, maximums = trainStreaming(model, dataset, epochs, batchSize)
+    else:
+        if "fold" in task:
+            trainIndexes, testIndexes = splitFold(dataset, task["folds"], task["fold"])
+        else:
+            trainIndexes, testIndexes = splitTrainTest(dataset.meta["counts"])
+        random = np.random.RandomState(100)
+
+        X_train = dataset.inputArray(dataset.X[trainIndexes], None if dataset.P is None else dataset.P[trainIndexes], random)
+        X_test = dataset.inputArray(dataset.X[testIndexes], None if dataset.P is None else dataset.P[testIndexes], random)
+        y_train = to_categorical(dataset.y[trainIndexes], numberProcesses)
+        y_test = to_categorical(dataset.y[testIndexes], numberProcesses)
+
+        #Same normalization as VarTransform=N, computed on the training events of all the processes
+        minimums, maximums = X_train.min(axis = 0).astype(np.float64), X_train.max(axis = 0).astype(np.float64)
+        X_train = mvaInference.normalize(X_train, minimums, maximums)
+        X_test = mvaInference.normalize(X_test, minimums, maximums)
+
+        history = model.fit(X_train, y_train, validation_data = (X_test, y_test), epochs = epochs, batch_size = batchSize, verbose = 2)
+        testMetrics = model.evaluate(X_test, y_test, batch_size = 10000, verbose = 0)
+
+    model.save(task["modelFile"])
+    mvaInference.exportLayers(model, dataset.inputs, minimums, maximums, task["exportFile"])
+    print("Trained model exported to " + task["exportFile"])
+
+    metrics = dict(zip(["testLoss", "testAccuracy", "testMse"], [float(value) for value in testMetrics]))
+    metrics.update({"name": task["name"], "hiddenLayers": task["hiddenLayers"], "learningRate": task["learningRate"],
+                    "trainLoss": float(history.history["loss"][-1]), "time": time.time() - start})
+    return metrics
+
+def kerasBatches(batches, minimums, maximums, classWeights, numberProcesses):
+    """
+    Normalized inputs, one-hot targets and sample weights of a generator of (X, y) batches
+    """
+
+    targets = np.eye(numberProcesses, dtype = np.float32)
+    for X, y in batches:
+        yield mvaInference.normalize(X, minimums, maximums), targets[y], classWeights[y]
+
+def trainStreaming(model, dataset, epochs, batchSize, testBatchSize = 10000):
+    """
+    Train a model on all the events of a cached dataset, streamed by shuffled mini-batches with a bounded memory. Instead of keeping
+    the same number of events for each process, each process gets the same total weight in the loss through the sample weights.
+    Return the training history, the test metrics and the normalization ranges
+    """
+
+    numberProcesses = len(dataset.labels)
+    trainBlocks, testBlocks = datasetCache.splitBlocks(len(dataset.y), trainPercentage = trainPercentage)
+    minimums, maximums, counts = datasetCache.blockStatistics(dataset, trainBlocks)
+    classWeights = (counts.sum()/(float(numberProcesses)*np.maximum(counts, 1))).astype(np.float32)
+    print("Training events by process: " + ", ".join([label + ": " + str(count) for label, count in zip(dataset.labels, counts)]))
+
+    nTrain = int(counts.sum())
+    nTest = sum([last - first for first, last in testBlocks])
+    if nTrain == 0:
+        raise ValueError("No training events in the dataset")
+    batchSize = min(batchSize, nTrain)
+    trainBatches = kerasBatches(datasetCache.batchGenerator(dataset, trainBlocks, batchSize), minimums, maximums, classWeights, numberProcesses)
+
+    if nTest == 0: #Only possible with a single event, nothing to validate on
+        print(bcolors.WARNING + "No testing events, the model is trained without validation." + bcolors.ENDC)
+        history = model.fit_generator(trainBatches, steps_per_epoch = nTrain//batchSize, epochs = epochs, verbose = 2)
+        return history, [float("nan")]*3, minimums, maximums
+
+    testBatchSize = min(testBatchSize, nTest)
+    testBatches = kerasBatches(datasetCache.batchGenerator(dataset, testBlocks, testBatchSize), minimums, maximums, classWeights, numberProcesses)
+
+    history = model.fit_generator(trainBatches, steps_per_epoch = nTrain//batchSize, epochs = epochs,
+                                  validation_data = testBatches, validation_steps = nTest//testBatchSize, verbose = 2)
+    testMetrics = model.evaluate_generator(testBatches, steps = nTest//testBatchSize)
+    return history, testMetrics, minimums, maximums
+
+def trainingName(signalFiles, parametrized = False):
+    """
+    Mass point of the first signal file, or parametrized for the network trained on all the mass points together
+    """
+
+    if parametrized:
+        return "parametrized"
+    massPoint = signalFiles[0].split("_")[3:9]
+    return "_".join(massPoint).replace(".root", "")
+
+def trainMVAArrays(baseDir, inputDir, year, backgroundFiles, signalFiles, test, datasetDir, streaming = False, parametrized = False):
+    """
+    Same training as trainMVA, directly with Keras on the cached memory-mapped dataset instead of the TMVA dataloader.
+    The trained network is exported to the .npz file used by the NumPy evaluation. If parametrized, all the mass points of each signal
+    are trained together, with their masses as additional inputs
+    """
+
+    massPoint = trainingName(signalFiles, parametrized)
+
+    outputDirTraining = baseDir + "/" + str(year) + "/" + massPoint + "/training/"
+    try:
+        os.makedirs(outputDirTraining)
+    except:
+        pass
+    try:
+        os.makedirs(os.path.dirname(weightsFile(baseDir, year, massPoint)))
+    except:
+        pass
+
+    dataset = loadTrainingDataset(inputDir, backgroundFiles, signalFiles, test, datasetDir, parametrized)
+    trainArchitecture({"name": "Juan", "dataset": dataset.path, "hiddenLayers": architectures["Juan"][0], "learningRate": architectures["Juan"][1],
+                       "modelFile": outputDirTraining + "JuanTrained.h5", "exportFile": weightsFile(baseDir, year, massPoint, ".npz"), "streaming": streaming})
+
+def gridSearch(baseDir, inputDir, year, backgroundFiles, signalFiles, test, datasetDir, architectureNames, learningRates = [], processes = 0, streaming = False, parametrized = False):
+    """
+    Train the given architectures, with their own learning rate or with each of the learning rates given, in parallel on the same cached
+    dataset, and write a comparison table of their metrics in the training directory
+    """
+
+    massPoint = trainingName(signalFiles, parametrized)
+
+    outputDirGridSearch = baseDir + "/" + str(year) + "/" + massPoint + "/training/gridSearch/"
+    try:
+        os.makedirs(outputDirGridSearch)
+    except:
+        pass
+
+    #The dataset is built once, before starting the trainings
+    dataset = loadTrainingDataset(inputDir, backgroundFiles, signalFiles, test, datasetDir, parametrized)
+
+    tasks = []
+    for architectureName in architectureNames:
+        hiddenLayers, learningRate = architectures[architectureName]
+        for rate in (learningRates if len(learningRates) > 0 else [learningRate]):
+            name = architectureName if len(learningRates) == 0 else architectureName + "_lr" + str(rate)
+            tasks.append({"name": name, "dataset": dataset.path, "hiddenLayers": hiddenLayers, "learningRate": rate,
+                          "modelFile": outputDirGridSearch + name + "Trained.h5", "exportFile": outputDirGridSearch + name + ".npz", "streaming": streaming})
+
+    results = runTrainings(tasks, processes)
+
+    #Comparison table, best test loss first
+    writeMetrics(sorted(results, key = lambda result: result["testLoss"]), outputDirGridSearch + "comparison")
+
+def kFoldTraining(baseDir, inputDir, year, backgroundFiles, signalFiles, test, datasetDir, folds, processes = 0, parametrized = False):
+    """
+    Train in parallel the k models of a k-fold training, the model of each fold being trained on the events of the other folds.
+    They are exported to the _fold<fold>.npz files evaluated by runMVA.py -e -k
+    """
+
+    massPoint = trainingName(signalFiles, parametrized)
+
+    outputDirTraining = baseDir + "/" + str(year) + "/" + massPoint + "/training/"
+    try:
+        os.makedirs(outputDirTraining)
+    except:
+        pass
+    try:
+        os.makedirs(os.path.dirname(weightsFile(baseDir, year, massPoint)))
+    except:
+        pass
+
+    dataset = loadTrainingDataset(inputDir, backgroundFiles, signalFiles, test, datasetDir, parametrized)
+
+    tasks = []
+    for fold in range(folds):
+        tasks.append({"name": "Juan_fold" + str(fold), "dataset": dataset.path, "hiddenLayers": architectures["Juan"][0], "learningRate": architectures["Juan"][1],
+                      "folds": folds, "fold": fold, "modelFile": outputDirTraining + "JuanTrained_fold" + str(fold) + ".h5",
+                      "exportFile": weightsFile(baseDir, year, massPoint, "_fold" + str(fold) + ".npz")})
+
+    writeMetrics(runTrainings(tasks, processes), outputDirTraining + "folds")
+
+def runTrainings(tasks, processes = 0):
+    """
+    Run the trainings of the tasks (see trainArchitecture) in a pool of processes (0: one per core), and return their metrics
+    """
+
+    if processes <= 0:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(tasks))
+    for task in tasks: #Share the cores of the node between the trainings
+        task["threads"] = max(1, multiprocessing.cpu_count()//processes)
+
+    print("Training " + str(len(tasks)) + " networks with " + str(processes) + " processes")
+    pool = multiprocessing.Pool(processes, maxtasksperchild = 1) #Each training gets a fresh Keras session
+    results = pool.map(trainArchitecture, tasks)
+    pool.close()
+    pool.join()
+    return results
+
+def writeMetrics(results, path):
+    """
+    Print the metrics of several trainings as a table, also written to path.txt, and write them to path.json
+    """
+
+    columns = ["name", "hiddenLayers", "learningRate", "trainLoss", "testLoss", "testAccuracy", "testMse", "time"]
+    lines = ["".join([column.rjust(16) for column in columns])]
+    for result in results:
+        lines.append("".join([(("%.4g" % result[column]) if isinstance(result[column], float) else str(result[column]).replace(" ", "")).rjust(16) for column in columns]))
+    table = "\n".join(lines)
+    print(table)
+
+    f = open(path + ".txt", "w")
+    f.write(table + "\n")
+    f.close()
+    f = open(path + ".json", "w")
+    json.dump(results, f, indent = 2)
+    f.close()
+
+def weightsFile(baseDir, year, massPoint, extension = ".weights.xml"):
+    """
+    TMVA weights file of a mass point, or the NumPy model exported next to it with extension = ".npz"
+    """
+    return baseDir + "/" + str(year) + "/" + massPoint + "/dataset/weights/TMVAClassification_PyKeras" + extension
+
+def exportMVA(baseDir, year, massPoint):
+    """
+    Export the trained network of a mass point and its input normalization to a .npz file, evaluated with NumPy only
+    """
+
+    mvaInference.exportModel(weightsFile(baseDir, year, massPoint), weightsFile(baseDir, year, massPoint, ".npz"))
+    print("Trained model exported to " + weightsFile(baseDir, year, massPoint, ".npz"))
+
 
 #=========================================================================================================
 # APPLICATION
 #=========================================================================================================
-def evaluateMVA(baseDir, inputDir, filename, massPoints, year, test):
+def evaluateMVA(baseDir, inputDir, filenames, massPoints, year, test):
     """
-    Function used to evaluate the MVA after being trained
+    Function used to evaluate the MVA after being trained, on each of the files given (the reader being booked only once)
     """
 
     # ===========================================
@@ -257,37 +617,34 @@ def evaluateMVA(baseDir, inputDir, filename, massPoints, year, test):
         os.makedirs(inputDir[:-1] + '_weighted/')
     except:
         pass
-    
-    rootfile = ROOT.TFile.Open(inputDir+filename, "READ")
-    inputTree = rootfile.Get("Events")
-    inputTree.SetBranchStatus("*", 1);
-    outputFile = ROOT.TFile.Open(inputDir[:-1] + '_weighted/' + filename, "RECREATE")
-    outputTree = inputTree.CloneTree(0)
 
     reader = ROOT.TMVA.Reader("Color:!Silent")    
     branches = {}
     for variable in variables:
-        branch = inputTree.GetBranch(variable)
-        branchName = branch.GetName()
-        branches[branchName] = array('f', [-999])
-        reader.AddVariable(branchName, branches[branchName])
-        inputTree.SetBranchAddress(branchName, branches[branchName])
+        branches[variable] = array('f', [-999])
+        reader.AddVariable(variable, branches[variable])
 
+    #All the mass points are booked in the same reader, and evaluated in a single pass over the events
     for massPoint in massPoints:
-        weightsDir = baseDir + "/" + str(year) + "/" + massPoint
+        #reader.BookMVA("BDT", baseDir + "/" + str(year) + "/" + massPoint + "/dataset/weights/TMVAClassification_BDT.weights.xml")
+        reader.BookMVA("PyKeras_" + massPoint, weightsFile(baseDir, year, massPoint))
+
+    for filename in filenames:
+    
+        startTime = time.time()
+        manifest.removeManifest(inputDir[:-1] + '_weighted/' + filename)
+        rootfile = openInput(inputDir+filename)
+        inputTree = rootfile.Get("Events")
+        inputTree.SetBranchStatus("*", 1);
+        outputFile = ROOT.TFile.Open(inputDir[:-1] + '_weighted/' + filename, "RECREATE")
+        outputTree = inputTree.CloneTree(0)
 
-        #reader.BookMVA("BDT", weightsDir + "/dataset/weights/TMVAClassification_BDT.weights.xml")
-        reader.BookMVA("PyKeras", weightsDir + "/dataset/weights/TMVAClassification_PyKeras.weights.xml")
+        for variable in variables:
+            inputTree.SetBranchAddress(variable, branches[variable])
 
-        #For now at least, let's consider we have exactly 3 processes (two signals and one common background)
-        PyKeras_output_signal0 = array("f", [0.])
-        PyKeras_output_signal1 = array("f", [0.])
-        PyKeras_output_bkg = array("f", [0.])
-        PyKeras_output_category = array("i", [0]) #Which category gets the highest softmax output?
-        outputTree.Branch("PyKeras_output_signal0", PyKeras_output_signal0, "PyKeras_output_signal0/F")
-        outputTree.Branch("PyKeras_output_signal1", PyKeras_output_signal1, "PyKeras_output_signal1/F")
-        outputTree.Branch("PyKeras_output_bkg", PyKeras_output_bkg, "PyKeras_output_bkg/F")
-        outputTree.Branch("PyKeras_output_category", PyKeras_output_category, "PyKeras_output_category/I")
+        outputs = {}
+        for massPoint in massPoints:
+            outputs[massPoint] = bookOutputBranches(outputTree, outputPrefix(massPoint, massPoints))
 
         nEvents = inputTree.GetEntries()
         if test:
@@ -306,27 +663,170 @@ def evaluateMVA(baseDir, inputDir, filename, massPoints, year, test):
             #BDTValue = reader.EvaluateMVA("BDT")
             #BDT_output[0] = BDTValue
 
-            PyKerasValues = reader.EvaluateMulticlass("PyKeras")
-            #print(PyKerasValues)
-            PyKeras_output_signal0[0] = PyKerasValues[0]
-            PyKeras_output_signal1[0] = PyKerasValues[1]
-            PyKeras_output_bkg[0] = PyKerasValues[2]
-
-            if PyKerasValues[1] > PyKerasValues[2] and PyKerasValues[1] > PyKerasValues[0]:
-                PyKeras_output_category[0] = 1
-            elif PyKerasValues[2] > PyKerasValues[1] and PyKerasValues[2] > PyKerasValues[0]:
-                PyKeras_output_category[0] = 2
-            else:
-                PyKeras_output_category[0] = 0
-            #print("Value0: " + str(PyKerasValues[0]) + ", value1: " + str(PyKerasValues[1]) + ", value2: " + str(PyKerasValues[2]))
-            #print(PyKeras_output_category[0])
+            for massPoint in massPoints:
+                PyKerasValues = reader.EvaluateMulticlass("PyKeras_" + massPoint)
+                output = outputs[massPoint]
+                output["signal0"][0] = PyKerasValues[0]
+                output["signal1"][0] = PyKerasValues[1]
+                output["bkg"][0] = PyKerasValues[2]
+
+                if PyKerasValues[1] > PyKerasValues[2] and PyKerasValues[1] > PyKerasValues[0]:
+                    output["category"][0] = 1
+                elif PyKerasValues[2] > PyKerasValues[1] and PyKerasValues[2] > PyKerasValues[0]:
+                    output["category"][0] = 2
+                else:
+                    output["category"][0] = 0
 
             outputTree.Fill()
 
-    outputFile.cd()
-    outputTree.Write()
-    rootfile.Close()
-    outputFile.Close()
+        eventsFilled = int(outputTree.GetEntries())
+        outputFile.cd()
+        outputTree.Write()
+        rootfile.Close()
+        outputFile.Close()
+
+        if not test:
+            stampOutput(baseDir, inputDir, filename, massPoints, year, evaluationOptions(massPoints))
+            manifest.writeManifest(inputDir[:-1] + '_weighted/' + filename, filename, -1, -1, eventsFilled, startTime, inputEntries = int(nEvents))
+
+
+def evaluationOptions(massPoints, batch = False, numpyModels = False, parametrized = False, folds = 0):
+    """
+    Options of an evaluation changing its outputs, kept in the stamps of the evaluated files
+    """
+
+    if numpyModels or parametrized or folds > 0:
+        mode = "numpy"
+    elif batch:
+        mode = "keras"
+    else:
+        mode = "tmva"
+    return {"massPoints": massPoints, "mode": mode, "parametrized": bool(parametrized), "folds": folds}
+
+def modelFiles(baseDir, year, massPoints, options):
+    """
+    Files of the models used by an evaluation with these options
+    """
+
+    names = ["parametrized"] if options["parametrized"] else massPoints
+    files = []
+    for name in names:
+        if options["folds"] > 0:
+            files = files + [weightsFile(baseDir, year, name, "_fold" + str(fold) + ".npz") for fold in range(options["folds"])]
+        elif options["mode"] == "numpy":
+            files.append(weightsFile(baseDir, year, name, ".npz"))
+        else: #The trained Keras model is given in the TMVA weights file
+            files = files + [weightsFile(baseDir, year, name), mvaInference.readWeightsXml(weightsFile(baseDir, year, name))["trainedModel"]]
+    return files
+
+def stampOutput(baseDir, inputDir, filename, massPoints, year, options):
+    """
+    Write the stamp of an evaluated file, used by createJobsEvaluateMVA.py to skip it as long as its input, models and variables do not change
+    """
+
+    hashes = evaluationStamp.modelHashes(modelFiles(baseDir, year, massPoints, options))
+    evaluationStamp.writeStamp(inputDir[:-1] + '_weighted/' + filename, inputDir + filename, hashes, variables, options)
+
+def loadNumpyModels(baseDir, year, massPoint, folds = 0):
+    """
+    NumPy models of a mass point: the one of the training, or one per fold of a k-fold training if folds > 0
+    """
+
+    if folds > 0:
+        return [mvaInference.NumpyModel(weightsFile(baseDir, year, massPoint, "_fold" + str(fold) + ".npz")) for fold in range(folds)]
+    return [mvaInference.NumpyModel(weightsFile(baseDir, year, massPoint, ".npz"))]
+
+def evaluateMVABatch(baseDir, inputDir, filenames, massPoints, year, test, chunkSize = 10000, numpyModels = False, parametrized = False, folds = 0):
+    """
+    Same as evaluateMVA, but reading the input variables by chunks of events and evaluating the network on each chunk at once,
+    with Keras or with the NumPy models exported after the training. If parametrized, the parametrized NumPy model is evaluated
+    for the masses of each mass point. With k folds, each event is evaluated by the model of the k-fold training not trained on it.
+    The models are loaded once for all the files given
+    """
+
+    models = {} #Models of each mass point, one per fold
+    hypotheses = {} #Values of the parameters of the parametrized model for each mass point
+    if parametrized:
+        parametrizedModels = loadNumpyModels(baseDir, year, "parametrized", folds)
+    for massPoint in massPoints:
+        if parametrized:
+            models[massPoint] = parametrizedModels
+            masses = datasetCache.massParameters(massPoint)
+            if masses is None:
+                raise ValueError("No Mchi and Mphi found in the mass point " + massPoint)
+            hypotheses[massPoint] = dict(zip(datasetCache.massParameterNames, masses))
+        elif numpyModels or folds > 0:
+            models[massPoint] = loadNumpyModels(baseDir, year, massPoint, folds)
+        else:
+            models[massPoint] = [mvaInference.KerasModel(weightsFile(baseDir, year, massPoint), chunkSize)]
+
+    #The input variables of all the models, read only once
+    expressions = ["event"] if folds > 0 else []
+    for massPoint in massPoints:
+        expressions = expressions + [variable for variable in models[massPoint][0].variables if variable not in expressions and variable not in hypotheses.get(massPoint, {})]
+
+    #Write the new branches in a new tree
+    try:
+        os.makedirs(inputDir[:-1] + '_weighted/')
+    except:
+        pass
+
+    for filename in filenames:
+
+        startTime = time.time()
+        manifest.removeManifest(inputDir[:-1] + '_weighted/' + filename)
+        rootfile = openInput(inputDir+filename)
+        inputTree = rootfile.Get("Events")
+        inputTree.SetBranchStatus("*", 1);
+        outputFile = ROOT.TFile.Open(inputDir[:-1] + '_weighted/' + filename, "RECREATE")
+        outputTree = inputTree.CloneTree(0)
+
+        outputs = {}
+        for massPoint in massPoints:
+            outputs[massPoint] = bookOutputBranches(outputTree, outputPrefix(massPoint, massPoints))
+
+        nEvents = inputTree.GetEntries()
+        if test:
+            nEvents = min(nEvents, 1000)
+
+        for first in range(0, nEvents, chunkSize):
+
+            updateProgress(round(first/float(nEvents), 2))
+
+            nChunk = min(chunkSize, nEvents - first)
+            columns = mvaInference.readColumns(inputTree, expressions, first, nChunk)
+            scores, category = {}, {}
+            for massPoint in massPoints:
+                hypothesis = hypotheses.get(massPoint, {})
+                inputs = np.column_stack([np.full(nChunk, hypothesis[variable]) if variable in hypothesis else columns[:, expressions.index(variable)] for variable in models[massPoint][0].variables])
+                if folds > 0:
+                    scores[massPoint] = mvaInference.predictFolds(models[massPoint], inputs, columns[:, expressions.index("event")])
+                else:
+                    scores[massPoint] = models[massPoint][0].predict(inputs)
+                category[massPoint] = mvaInference.categories(scores[massPoint])
+
+            #Copy the events of the chunk with their outputs
+            for i in range(nChunk):
+                inputTree.GetEntry(first + i)
+                for massPoint in massPoints:
+                    output = outputs[massPoint]
+                    output["signal0"][0] = scores[massPoint][i, 0]
+                    output["signal1"][0] = scores[massPoint][i, 1]
+                    output["bkg"][0] = scores[massPoint][i, 2]
+                    output["category"][0] = int(category[massPoint][i])
+                outputTree.Fill()
+
+        updateProgress(1)
+
+        eventsFilled = int(outputTree.GetEntries())
+        outputFile.cd()
+        outputTree.Write()
+        rootfile.Close()
+        outputFile.Close()
+
+        if not test:
+            stampOutput(baseDir, inputDir, filename, massPoints, year, evaluationOptions(massPoints, True, numpyModels, parametrized, folds))
+            manifest.writeManifest(inputDir[:-1] + '_weighted/' + filename, filename, -1, -1, eventsFilled, startTime, inputEntries = int(nEvents))
 
     
 if __name__ == "__main__":
@@ -337,12 +837,26 @@ if __name__ == "__main__":
     parser = optparse.OptionParser(usage='usage: %prog [opts] FilenameWithSamples', version='%prog 1.0')
     parser.add_option('-s', '--signalFiles', action='store', type=str, dest='signalFiles', default=[], help='Name of the signal files to be used to train the MVA')
     parser.add_option('-b', '--backgroundFiles', action='store', type=str, dest='backgroundFiles', default=[], help='Name of the background files samples to train the MVA')
-    parser.add_option('-f', '--filename', action='store', type=str, dest='filename', default='', help='Name of the file to be evaluated')
+    parser.add_option('-f', '--filename', action='store', type=str, dest='filename', default='', help='Name of the file to be evaluated (comma separated to evaluate several files in the same job)')
     parser.add_option('-i', '--inputDir', action='store', type=str, dest='inputDir', default="") 
     parser.add_option('-d', '--baseDir', action='store', type=str, dest='baseDir', default="/afs/cern.ch/user/c/cprieels/work/public/TopPlusDMRunIILegacy/CMSSW_10_4_0/src/neuralNetwork/")
     parser.add_option('-m', '--massPoints', action='store', type=str, dest='massPoints', default="scalar_LO_Mchi_1_Mphi_100")
     parser.add_option('-y', '--year', action='store', type=int, dest='year', default=2018)
     parser.add_option('-e', '--evaluate', action='store_true', dest='evaluate') #Evaluate the MVA or train it?
+    parser.add_option('-B', '--batch', action='store_true', dest='batch') #Evaluate the network on chunks of events instead of event by event through the TMVA reader
+    parser.add_option('-c', '--chunkSize', action='store', type=int, dest='chunkSize', default=10000) #Number of events read and evaluated at once with the batch option
+    parser.add_option('-N', '--numpy', action='store_true', dest='numpy') #Batch evaluation with the NumPy models exported after the training, without Keras
+    parser.add_option('-x', '--export', action='store_true', dest='export') #Only export the already trained networks of the mass points to NumPy models
+    parser.add_option('-D', '--datasetDir', action='store', type=str, dest='datasetDir', default="") #Train directly with Keras on the training datasets cached in this directory instead of the TMVA dataloader
+    parser.add_option('-G', '--gridSearch', action='store', type=str, dest='gridSearch', default="") #Comma separated architectures to be trained in parallel and compared, among Adam1, Adam2, Adam3 and Juan (needs the D option)
+    parser.add_option('-l', '--learningRates', action='store', type=str, dest='learningRates', default="") #Comma separated learning rates tried for each architecture of the grid search, instead of their own one
+    parser.add_option('-S', '--streaming', action='store_true', dest='streaming') #Train on all the events of the cached dataset, streamed by mini-batches, balancing the processes with weights (needs the D option)
+    parser.add_option('-P', '--parametrized', action='store_true', dest='parametrized') #Train a single network for all the mass points, with their masses as inputs (needs the D option), or evaluate it for each mass point
+    parser.add_option('-k', '--folds', action='store', type=int, dest='folds', default=0) #Number of folds of a k-fold training by event number (needs the D option), or of the models to be evaluated (0: no k-fold)
+    parser.add_option('-p', '--processes', action='store', type=int, dest='processes', default=0) #Number of trainings run at the same time in the grid search (0: one per core)
+    parser.add_option('--stageDir', action='store', type=str, dest='stageDir', default="") #Local directory where the evaluated files are copied before being read, shared by the jobs of the node (not staged if empty)
+    parser.add_option('--stageSize', action='store', type=float, dest='stageSize', default=20.) #Size in GB of the staging directory, the least recently used copies being removed first
+    parser.add_option('--prefetch', action='store', type=int, dest='prefetch', default=2) #Number of the next files of the job (or of the training dataset) staged in the background while the current one is read (needs stageDir, 0: no prefetching)
     parser.add_option('-t', '--test', action='store_true', dest='test') #Only run on a single file
     (opts, args) = parser.parse_args()
 
@@ -354,18 +868,67 @@ if __name__ == "__main__":
     massPoints= opts.massPoints
     year = opts.year
     evaluate = opts.evaluate
+    batch = opts.batch
+    chunkSize = opts.chunkSize
+    numpyModels = opts.numpy
+    export = opts.export
+    datasetDir = opts.datasetDir
+    gridSearchArchitectures = [str(item) for item in opts.gridSearch.split(",") if item != ""]
+    learningRates = [float(item) for item in opts.learningRates.split(",") if item != ""]
+    processes = opts.processes
+    streaming = opts.streaming
+    parametrized = opts.parametrized
+    folds = opts.folds
+    if opts.stageDir != "":
+        staging = StagingCache(opts.stageDir, opts.stageSize)
+        prefetchDepth = opts.prefetch
+
+    for architecture in gridSearchArchitectures:
+        if architecture not in architectures:
+            parser.error("Unknown architecture " + architecture)
+    if len(gridSearchArchitectures) > 0 and datasetDir == "":
+        parser.error("The grid search needs a dataset directory (D option)")
+    if streaming and datasetDir == "":
+        parser.error("The streaming training needs a dataset directory (D option)")
+    if parametrized and not evaluate and datasetDir == "":
+        parser.error("The parametrized training needs a dataset directory (D option)")
+    if folds > 0 and not evaluate and datasetDir == "":
+        parser.error("The k-fold training needs a dataset directory (D option)")
+    if folds > 0 and streaming:
+        parser.error("The k-fold training can not be streamed")
+    if folds == 1:
+        parser.error("The k-fold training needs at least two folds")
     test = opts.test
 
-    #To evaluate the MVA, we pass as argument one file name each time, to parallelize the jobs
-    if(evaluate):
+    #To evaluate the MVA, we pass as argument one file name (or a few small ones) each time, to parallelize the jobs
+    if export:
+        for massPoint in massPoints.split(","):
+            exportMVA(baseDir, year, massPoint)
 
-        #The mass points to be added to the trees are also passed as comma separated values
+    elif(evaluate):
+
+        #The mass points to be added to the trees are also passed as comma separated values, as well as the files evaluated by the same job
+        filenames = [str(item) for item in filename.split(",")]
         massPointsList = [str(item) for item in massPoints.split(",")]
-        evaluateMVA(baseDir, inputDir, filename, massPointsList, year, test)
+        if staging is not None and opts.prefetch > 0 and len(filenames) > 1:
+            prefetcher = Prefetcher(staging, [inputDir + item for item in filenames], opts.prefetch)
+        if batch or numpyModels or parametrized or folds > 0:
+            evaluateMVABatch(baseDir, inputDir, filenames, massPointsList, year, test, chunkSize, numpyModels, parametrized, folds)
+        else:
+            evaluateMVA(baseDir, inputDir, filenames, massPointsList, year, test)
+        if prefetcher is not None:
+            prefetcher.close()
 
     else: #To train, we need to pass a list containing all the files at once
 
         #Split the comma separated string for the files into lists
         signalFiles = [str(item) for item in signalFiles.split(',')]
         backgroundFiles = [str(item) for item in backgroundFiles.split(',')]            
-        trainMVA(baseDir, inputDir, year, backgroundFiles, signalFiles, test)
+        if folds > 0:
+            kFoldTraining(baseDir, inputDir, year, backgroundFiles, signalFiles, test, datasetDir, folds, processes, parametrized)
+        elif len(gridSearchArchitectures) > 0:
+            gridSearch(baseDir, inputDir, year, backgroundFiles, signalFiles, test, datasetDir, gridSearchArchitectures, learningRates, processes, streaming, parametrized)
+        elif datasetDir != "":
+            trainMVAArrays(baseDir, inputDir, year, backgroundFiles, signalFiles, test, datasetDir, streaming, parametrized)
+        else:
+            trainMVA(baseDir, inputDir, year, backgroundFiles, signalFiles, test)
@@ -0,0 +1,82 @@
+#Low overhead timers and counters used to know where the time goes in createTrees.py
+import os, time, json
+
+#Directory of the timing summaries, next to the outputs, so that they are never listed with the trees
+timingDirectory = "timing"
+
+def timingPath(outputPath):
+    directory, name = os.path.split(outputPath)
+    return os.path.join(directory, timingDirectory, name.replace('.root', '') + '_timing.json')
+
+class StageTimer():
+    """
+    Lap timer: each call to stage() charges the time elapsed since the previous call to the previous stage, so that a single
+    time.time() call is needed per stage. Counters (cut flow, reconstruction attempts, exceptions...) are kept alongside.
+    """
+
+    stages = ["io", "preselection", "bJets", "reco", "smearing", "kinematics", "mt2", "variables", "mblt", "mva", "fill"]
+
+    def __init__(self):
+        self.times = dict([(stage, 0.) for stage in self.stages])
+        self.calls = dict([(stage, 0) for stage in self.stages])
+        self.eventTimes = dict([(stage, 0.) for stage in self.stages])
+        self.counters = {}
+        self.exceptions = {}
+        self.startTime = time.time()
+        self.currentStage = None
+        self.lastTime = self.startTime
+
+    def stage(self, stage):
+        """
+        Start a new stage (or None to stop timing), closing the current one.
+        """
+
+        now = time.time()
+        if self.currentStage is not None:
+            elapsed = now - self.lastTime
+            self.times[self.currentStage] += elapsed
+            self.eventTimes[self.currentStage] += elapsed
+            self.calls[self.currentStage] += 1
+        self.currentStage = stage
+        self.lastTime = now
+
+    def nextEvent(self):
+        """
+        Close the current event: the time until the next stage is spent reading the next event.
+        """
+
+        self.stage("io")
+        for stage in self.stages:
+            self.eventTimes[stage] = 0.
+
+    def count(self, counter, n = 1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def countException(self, name):
+        self.exceptions[name] = self.exceptions.get(name, 0) + 1
+
+    def summary(self, **info):
+        """
+        Summary of the timers and counters, with any additional information given as keyword arguments.
+        """
+
+        summary = dict(info)
+        summary["totalTime"] = time.time() - self.startTime
+        summary["stages"] = dict([(stage, {"time": self.times[stage], "calls": self.calls[stage]}) for stage in self.stages])
+        summary["counters"] = self.counters
+        summary["exceptions"] = self.exceptions
+        return summary
+
+    def writeSummary(self, path, **info):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except:
+            pass #Directory already exists, this is fine
+        f = open(path, "w")
+        json.dump(self.summary(**info), f, indent = 2, sort_keys = True)
+        f.close()
+
+    def printSummary(self):
+        total = sum(self.times.values())
+        for stage in self.stages:
+            print("  " + stage.ljust(14) + str(round(self.times[stage], 2)).rjust(10) + " s " + (str(round(100*self.times[stage]/total, 1)) if total > 0 else "0.0").rjust(6) + " %")
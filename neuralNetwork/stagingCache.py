@@ -0,0 +1,304 @@
+#Copies of the input files on the local disk of the node (its scratch directory), shared by all the jobs running on the node, so that
+#the files read again and again (the trees of a training, the inputs of several evaluations) are read from the local disk instead of EOS.
+#The cache is bounded in size, the least recently used files being removed first
+import os, json, time, errno, fcntl, hashlib, threading
+
+#Content of the cache index
+from fileIndex import statFile
+
+class StagingCache():
+    """
+    Local copies of the files, up to maxSize GB in directory. Each copy is kept with the size and modification time of its source, and
+    is copied again if they change. The index of the copies is locked by each operation, the copies themselves being made without the lock
+    but with their size reserved in the index beforehand, so that concurrent copies never overflow the directory. The copies looked up less
+    than graceTime seconds ago are not removed, as the job that looked them up may not have opened them yet.
+    """
+
+    def __init__(self, directory, maxSize = 20., graceTime = 60.):
+        self.directory = directory
+        self.maxBytes = int(maxSize*1024*1024*1024)
+        self.graceTime = graceTime
+        self.indexFile = os.path.join(directory, "index.json")
+        self.hits, self.misses = 0, 0
+
+        try:
+            os.makedirs(directory)
+        except:
+            pass #Directory already exists, this is fine
+
+    def localPath(self, path):
+        return os.path.join(self.directory, hashlib.md5(path.encode()).hexdigest()[:12] + "_" + os.path.basename(path))
+
+    def temporaryPath(self, path):
+        return self.localPath(path) + ".tmp" + str(os.getpid()) + "_" + str(threading.current_thread().ident)
+
+    def transaction(self, operation):
+        lock = open(self.indexFile + ".lock", "a")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            try:
+                f = open(self.indexFile)
+                index = json.load(f)
+                f.close()
+            except (IOError, OSError, ValueError):
+                index = {}
+            result = operation(index)
+            temporary = self.indexFile + ".tmp" + str(os.getpid())
+            f = open(temporary, "w")
+            json.dump(index, f)
+            f.close()
+            os.rename(temporary, self.indexFile)
+            return result
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def removeDeadCopies(self, index):
+        #Copies being made by processes that died meanwhile
+        for name, entry in list(index.items()):
+            if "copying" not in entry:
+                continue
+            try:
+                os.kill(entry["copying"], 0)
+                continue
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    continue #Running as another user
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass #Not started or already removed
+            del index[name]
+
+    def makeRoom(self, index, size):
+        """
+        Remove the least recently used copies until size more bytes fit in the directory, the copies being made and the ones looked up
+        less than graceTime seconds ago being kept. Return False, without removing anything, if it can not fit.
+        """
+
+        now = time.time()
+        used = sum([entry["size"] for entry in index.values()])
+        removable = sorted([(name, entry) for name, entry in index.items() if "copying" not in entry and now - entry["lastUsed"] > self.graceTime],
+                           key = lambda item: item[1]["lastUsed"])
+        if used - sum([entry["size"] for name, entry in removable]) + size > self.maxBytes:
+            return False
+        for name, entry in removable:
+            if used + size <= self.maxBytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name)) #The jobs still reading it keep their open file
+            except OSError:
+                pass #Already removed
+            del index[name]
+            used = used - entry["size"]
+        return True
+
+    def lookup(self, path, stat):
+        """
+        Local copy of a file if it is already staged and up to date, None otherwise.
+        """
+
+        local = self.localPath(path)
+        def use(index):
+            entry = index.get(os.path.basename(local))
+            if entry is None or [entry["size"], entry["mtime"]] != list(stat) or not os.path.exists(local):
+                return None
+            entry["lastUsed"] = time.time()
+            return local
+        return self.transaction(use)
+
+    def reserve(self, path, stat, temporary):
+        """
+        Count a copy about to be made in temporary in the size of the cache, making room for it. Return False if it does not fit.
+        """
+
+        def add(index):
+            self.removeDeadCopies(index)
+            if not self.makeRoom(index, stat[0]):
+                return False
+            index[os.path.basename(temporary)] = {"source": path, "size": stat[0], "copying": os.getpid(), "lastUsed": time.time()}
+            return True
+        return self.transaction(add)
+
+    def release(self, temporary):
+        """
+        Remove a copy that could not be made and its reservation.
+        """
+
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        self.transaction(lambda index: index.pop(os.path.basename(temporary), None))
+
+    def insert(self, path, stat, temporary):
+        """
+        Move a new copy, whose size was reserved, in the cache.
+        """
+
+        local = self.localPath(path)
+        def add(index):
+            index.pop(os.path.basename(temporary), None)
+            index.pop(os.path.basename(local), None) #Previous copy, out of date
+            os.rename(temporary, local)
+            index[os.path.basename(local)] = {"source": path, "size": stat[0], "mtime": stat[1], "lastUsed": time.time()}
+        self.transaction(add)
+        return local
+
+    def copy(self, path, temporary, cancelled = None):
+        """
+        Copy a file block by block, stopping as soon as cancelled() is true. Return False if it was cancelled.
+        """
+
+        source = open(path, "rb")
+        try:
+            target = open(temporary, "wb")
+            try:
+                while cancelled is None or not cancelled():
+                    block = source.read(16*1024*1024)
+                    if not block:
+                        return True
+                    target.write(block)
+                return False
+            finally:
+                target.close()
+        finally:
+            source.close()
+
+    def stage(self, path, cancelled = None):
+        """
+        Path to read a file from: its local copy, made now if needed, or the file itself if it can not be staged (not a local or
+        mounted file, larger than the room left in the cache, failed or cancelled copy).
+        """
+
+        stat = statFile(path)
+        if stat is None or stat[0] > self.maxBytes:
+            return path
+
+        local = self.lookup(path, stat)
+        if local is not None:
+            self.hits = self.hits + 1
+            return local
+
+        self.misses = self.misses + 1
+        temporary = self.temporaryPath(path)
+        if not self.reserve(path, stat, temporary):
+            return path #The cache is full of copies in use
+        try:
+            copied = self.copy(path, temporary, cancelled)
+        except (IOError, OSError) as e:
+            print("Could not stage " + path + " (" + str(e) + "), it is read directly.")
+            copied = False
+        if not copied:
+            self.release(temporary)
+            return path
+        return self.insert(path, stat, temporary)
+
+def openStaged(openFile, local, path):
+    """
+    Open the local copy of a file with openFile (a function of the path), or the file itself if its copy can not be opened (removed by
+    another job of the node between its lookup and its opening).
+    """
+
+    if local == path:
+        return openFile(path)
+    f = openFile(local)
+    if not f or f.IsZombie():
+        print("Could not open the local copy of " + path + ", it is read directly.")
+        return openFile(path)
+    return f
+
+class Prefetcher():
+    """
+    Stage the next files of a list in background threads while the current one is read, so that the copy of the next files overlaps
+    with the processing of the current one instead of adding to it. At most depth files are staged ahead of the file being read, taking
+    at most budget bytes of the staging directory (half of it by default, so that they do not evict the file being read).
+    """
+
+    def __init__(self, staging, paths, depth = 2, budget = None):
+        self.staging = staging
+        self.paths = []
+        for path in paths: #A file split in several event ranges is staged once
+            if path not in self.paths:
+                self.paths.append(path)
+        self.depth = max(depth, 1)
+        self.budget = budget if budget is not None else staging.maxBytes//2
+        self.staged, self.sizes = {}, {}
+        self.current, self.nextIndex = 0, 0
+        self.stopped = False
+        self.condition = threading.Condition()
+
+        self.threads = [threading.Thread(target = self.run) for i in range(min(self.depth, len(self.paths)))]
+        for thread in self.threads:
+            thread.daemon = True #Never keeps a finished job alive
+            thread.start()
+
+    def ahead(self, index):
+        return sum([self.sizes.get(i, 0) for i in range(self.current + 1, index)])
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                if self.stopped or self.nextIndex >= len(self.paths):
+                    return
+                index = self.nextIndex
+                self.nextIndex = self.nextIndex + 1
+            finally:
+                self.condition.release()
+
+            path = self.paths[index]
+            stat = statFile(path)
+            size = stat[0] if stat is not None else 0
+            self.condition.acquire()
+            try:
+                self.sizes[index] = size
+                while not self.stopped and index > self.current and (index > self.current + self.depth or self.ahead(index) + size > self.budget):
+                    self.condition.wait(1.)
+                skip = self.stopped or index < self.current #Already read without waiting for it
+            finally:
+                self.condition.release()
+
+            local = path
+            if not skip:
+                try:
+                    local = self.staging.stage(path, lambda: self.stopped)
+                except Exception as e: #The file is then read directly
+                    print("Could not prefetch " + path + " (" + str(e) + ").")
+            self.condition.acquire()
+            self.staged[index] = local
+            self.condition.notifyAll()
+            self.condition.release()
+
+    def get(self, path):
+        """
+        Path to read a file of the list from, waiting for it to be staged if it is being copied. The files after it are staged meanwhile.
+        """
+
+        if path not in self.paths:
+            return self.staging.stage(path)
+        index = self.paths.index(path)
+
+        self.condition.acquire()
+        try:
+            self.current = max(self.current, index)
+            self.condition.notifyAll()
+            while index not in self.staged and not self.stopped:
+                self.condition.wait(1.)
+            local = self.staged.get(index, path)
+        finally:
+            self.condition.release()
+
+        if local != path and not os.path.exists(local): #Evicted by another job of the node meanwhile
+            return self.staging.stage(path)
+        return local
+
+    def close(self):
+        """
+        Stop staging the next files, the copies in progress being abandoned.
+        """
+
+        self.condition.acquire()
+        self.stopped = True
+        self.condition.notifyAll()
+        self.condition.release()
+        for thread in self.threads:
+            thread.join()
@@ -29,6 +29,8 @@ class EventKinematic():
 
         self.numberSolutions = 0
         self.nuSol = None #Place to keep the optimal nuSol object
+        self.solutions = [] #Neutrino pairs found by the reconstruction, nuSol.solution being solved again each time it is accessed
+        self.recoException = None #Name of the exception raised by the solver, if any
         self.rand = r.TRandom3()
 
     #We need the TLOrentzVector of the W and the tops in the main code
@@ -102,22 +104,28 @@ class EventKinematic():
         Function to actually run the top reconstruction using a EventKinematic() object.
         """
 
+        self.recoException = None
         try:
             nuSol = ttbar.solveNeutrino(self.Tb1, self.Tb2, self.Tlep1, self.Tlep2, self.Tnu1, self.Tnu2, self.TMET, self.mW1, self.mW2, self.mt1, self.mt2)
-        except:
+        except Exception as e:
             #print("An error occured when performing the reconstruction")
+            self.recoException = type(e).__name__
             nuSol = None
 
         #Some events do not have any solutions even though the reconstruction succeeds
+        solutions = []
         if nuSol is not None:
             try:
-                self.numberSolutions = len(nuSol.solution)
-                if(len(nuSol.solution) == 0):
+                solutions = nuSol.solution
+                self.numberSolutions = len(solutions)
+                if(len(solutions) == 0):
                     nuSol = None
-            except:
+            except Exception as e:
+                self.recoException = type(e).__name__
                 nuSol = None
 
         self.nuSol = nuSol
+        self.solutions = solutions if nuSol is not None else []
         return nuSol
 
     def findBestSolution(self, mlbHist):
@@ -133,7 +141,7 @@ class EventKinematic():
 
         if self.nuSol is not None:
             try:
-                for s, possibleSolution in enumerate(self.nuSol.solution):
+                for s, possibleSolution in enumerate(self.solutions):
                     #TOCHECK: value of the total momentum (=energy) of a neutrino
                     #possibleSolution[0] is the neutrino, possibleSolution[0][0] its momentum along the x-axis
                     Tnu1.SetPxPyPzE(possibleSolution[0][0], possibleSolution[0][1], possibleSolution[0][2], math.sqrt(possibleSolution[0][0]**2 + possibleSolution[0][1]**2 + possibleSolution[0][2]**2)) 
@@ -153,6 +161,21 @@ class EventKinematic():
 
         return [Tnu1, Tnu2]
             
+    def allSolutions(self):
+        """
+        Return all the neutrino pairs found by the reconstruction, as [Tnu1, Tnu2] lists of TLorentzVectors.
+        """
+
+        allSolutions = []
+        for possibleSolution in self.solutions:
+            Tnu1 = r.TLorentzVector()
+            Tnu2 = r.TLorentzVector()
+            Tnu1.SetPxPyPzE(possibleSolution[0][0], possibleSolution[0][1], possibleSolution[0][2], math.sqrt(possibleSolution[0][0]**2 + possibleSolution[0][1]**2 + possibleSolution[0][2]**2))
+            Tnu2.SetPxPyPzE(possibleSolution[1][0], possibleSolution[1][1], possibleSolution[1][2], math.sqrt(possibleSolution[1][0]**2 + possibleSolution[1][1]**2 + possibleSolution[1][2]**2))
+            allSolutions.append([Tnu1, Tnu2])
+
+        return allSolutions
+
     def setWeight(self, mlbHist):
         """
         Set the weight associated to a given (smeared) object.
@@ -261,3 +261,157 @@ class doubleNeutrinoSolutions(object):
                  for ss in self.solutionSets]
         return [(K.dot(s), K_.dot(s_))
                 for s, s_ in zip(self.perp, self.perp_)]
+
+
+def batchR(axis, angles):
+    '''Stack of rotation matrices about x(0),y(1), or z(2) axis'''
+    c, s = np.cos(angles), np.sin(angles)
+    R = c[:, None, None] * np.eye(3)
+    R[:, axis, axis] = 1
+    R[:, (axis+1) % 3, (axis-1) % 3] = -s
+    R[:, (axis-1) % 3, (axis+1) % 3] = s
+    return R
+
+
+class batchNuSolutionSet(object):
+    '''nuSolutionSet for arrays of b and mu four-momenta (px, py, pz, E)'''
+
+    def __init__(self, b, mu,  # Arrays of shape (n, 4)
+                 mW2=mW**2, mT2=mT**2, mN2=mN**2):
+        b, mu = np.asarray(b, dtype=float), np.asarray(mu, dtype=float)
+        bP = np.sqrt((b[:, :3]**2).sum(axis=1))
+        muP = np.sqrt((mu[:, :3]**2).sum(axis=1))
+        c = (b[:, :3] * mu[:, :3]).sum(axis=1) / (bP * muP)
+        s = np.sqrt(1 - c**2)
+        x0p = - (mT2 - mW2 - (b[:, 3]**2 - bP**2)) / (2*b[:, 3])
+        x0 = - (mW2 - (mu[:, 3]**2 - muP**2) - mN2) / (2*mu[:, 3])
+
+        Bb, Bm = bP / b[:, 3], muP / mu[:, 3]
+
+        Sx = (x0 * Bm - muP*(1-Bm**2)) / Bm**2
+        Sy = (x0p / Bb - c * Sx) / s
+
+        w = (Bm / Bb - c) / s
+
+        Om2 = w**2 + 1 - Bm**2
+        eps2 = (mW2 - mN2) * (1 - Bm**2)
+        x1 = Sx - (Sx+w*Sy) / Om2
+        y1 = Sy - (Sx+w*Sy) * w / Om2
+        Z2 = x1**2 * Om2 - (Sy-w*Sx)**2 - (mW2-x0**2-eps2)
+        Z = np.sqrt(np.maximum(0, Z2))
+
+        for item in ['b', 'mu', 'bP', 'muP', 'c', 's', 'x1', 'y1',
+                     'Z', 'w', 'Om2']:
+            setattr(self, item, eval(item))
+
+    @property
+    def R_T(self):
+        '''Rotations from F coord. to laboratory coord.'''
+        muPhi = np.arctan2(self.mu[:, 1], self.mu[:, 0])
+        muTheta = np.arccos(self.mu[:, 2] / self.muP)
+        R_z = batchR(2, -muPhi)
+        R_y = batchR(1, 0.5*math.pi - muTheta)
+        b_xyz = np.einsum('nij,nj->ni', R_y, np.einsum('nij,nj->ni', R_z, self.b[:, :3]))
+        R_x = batchR(0, -np.arctan2(b_xyz[:, 2], b_xyz[:, 1]))
+        T = lambda M: M.transpose(0, 2, 1)
+        return np.matmul(T(R_z), np.matmul(T(R_y), T(R_x)))
+
+    @property
+    def H_tilde(self):
+        '''Transformations of t=[c,s,1] to p_nu: F coord.'''
+        Om = np.sqrt(self.Om2)
+        h_t = np.zeros((len(self.Z), 3, 3))
+        h_t[:, 0, 0] = self.Z / Om
+        h_t[:, 0, 2] = self.x1 - self.muP
+        h_t[:, 1, 0] = self.w * self.Z / Om
+        h_t[:, 1, 2] = self.y1
+        h_t[:, 2, 1] = self.Z
+        return h_t
+
+    @property
+    def H(self):
+        '''Transformations of t=[c,s,1] to p_nu: lab coord.'''
+        return np.matmul(self.R_T, self.H_tilde)
+
+
+def batchIntersectionsUnitCircle(M, zero=1e-7):
+    '''Points of intersection between a stack of conics and the unit circle
+
+    Equivalent to intersections_ellipses(M, UnitCircle()) for every conic at once:
+    with t = [cos, sin, 1] written in terms of u = tan(angle/2), t.M.t = 0 is a
+    quartic in u whose roots are taken as eigenvalues of its companion matrix.
+    Returns the points, shape (n, 5, 3), and a mask of the valid ones, shape (n, 5);
+    the last point (angle = pi) covers the root at infinity.
+    '''
+    finite = np.isfinite(M).all(axis=(1, 2))
+    M = np.where(finite[:, None, None], M, UnitCircle())
+    M00, M01, M02 = M[:, 0, 0], 0.5*(M[:, 0, 1] + M[:, 1, 0]), 0.5*(M[:, 0, 2] + M[:, 2, 0])
+    M11, M12, M22 = M[:, 1, 1], 0.5*(M[:, 1, 2] + M[:, 2, 1]), M[:, 2, 2]
+    coefficients = np.stack([M00 - 2*M02 + M22,
+                             4*(M12 - M01),
+                             4*M11 - 2*M00 + 2*M22,
+                             4*(M01 + M12),
+                             M00 + 2*M02 + M22], axis=1)
+    scale = np.abs(coefficients).max(axis=1)
+    coefficients /= np.where(scale > 0, scale, 1)[:, None]
+
+    #Vanishing leading coefficients mean a root at infinity, already covered by angle = pi
+    leading = coefficients[:, 0]
+    degenerate = np.abs(leading) < zero
+    leading = np.where(degenerate, zero, leading)
+
+    companion = np.zeros((len(M), 4, 4))
+    companion[:, 0, :] = -coefficients[:, 1:] / leading[:, None]
+    companion[:, 1, 0] = companion[:, 2, 1] = companion[:, 3, 2] = 1
+    u = np.linalg.eigvals(companion)
+
+    valid = np.abs(u.imag) < zero * (1 + np.abs(u.real))
+    u = u.real
+    points = np.stack([(1 - u**2) / (1 + u**2), 2*u / (1 + u**2), np.ones_like(u)], axis=2)
+
+    points = np.concatenate([points, np.tile([[[-1., 0., 1.]]], (len(M), 1, 1))], axis=1)
+    valid = np.concatenate([valid, np.ones((len(M), 1), dtype=bool)], axis=1)
+    return points, valid & finite[:, None]
+
+
+class batchSingleNeutrinoSolutions(object):
+    '''Most likely neutrino momenta for arrays of tt-->lepton+jets candidates'''
+    def __init__(self, b, mu,                  # Arrays of shape (n, 4)
+                 metX, metY,                   # Arrays of shape (n,)
+                 sigma2,                       # Mo. imbalance unc. matrices, shape (n, 2, 2)
+                 mW2=mW**2, mT2=mT**2):
+        self.solutionSet = batchNuSolutionSet(b, mu, mW2, mT2)
+        H = self.solutionSet.H
+        n = len(H)
+
+        #Explicit inverse of the 2x2 uncertainty matrices
+        sigma2 = np.asarray(sigma2, dtype=float)
+        det = sigma2[:, 0, 0] * sigma2[:, 1, 1] - sigma2[:, 0, 1] * sigma2[:, 1, 0]
+        S2 = np.zeros((n, 3, 3))
+        S2[:, 0, 0] = sigma2[:, 1, 1] / det
+        S2[:, 0, 1] = -sigma2[:, 0, 1] / det
+        S2[:, 1, 0] = -sigma2[:, 1, 0] / det
+        S2[:, 1, 1] = sigma2[:, 0, 0] / det
+
+        deltaNu = -H
+        deltaNu[:, 0, 2] += metX
+        deltaNu[:, 1, 2] += metY
+
+        self.X = np.matmul(deltaNu.transpose(0, 2, 1), np.matmul(S2, deltaNu))
+        XD = np.matmul(self.X, Derivative())
+        M = XD + XD.transpose(0, 2, 1)
+
+        points, valid = batchIntersectionsUnitCircle(M)
+        chi2s = np.einsum('nki,nij,nkj->nk', points, self.X, points)
+        chi2s = np.where(valid, chi2s, np.inf)
+        best = np.argmin(chi2s, axis=1)
+
+        #Candidates for which the solution set is not defined (e.g. Om2 < 0) keep an infinite chi2
+        self.solutions = points[np.arange(n), best]
+        self.chi2 = chi2s[np.arange(n), best]
+        self.valid = np.isfinite(self.chi2)
+
+    @property
+    def nu(self):
+        '''Solutions for neutrino momenta, shape (n, 3)'''
+        return np.einsum('nij,nj->ni', self.solutionSet.H, self.solutions)
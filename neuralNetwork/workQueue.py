@@ -0,0 +1,593 @@
+#Pull-based production of the trees: a coordinator hands out event ranges of the input files to the workers on demand, the ranges
+#getting smaller towards the end of the production so that no worker is left with a long chunk, and merges the partial outputs of
+#each file with hadd once all its ranges are done. The queue is kept in a JSON state file, shared either through a socket server
+#(the coordinator, for workers running anywhere, under condor for instance) or directly through the file, locked by each worker
+import os, sys, json, time, fcntl, socket, binascii, subprocess, threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from multiprocessing.pool import ThreadPool
+import optparse
+
+#Cached metadata of the input files
+import fileIndex
+
+#Completion manifests of the partial and merged outputs
+import manifest
+
+templateCONDOR = """#!/bin/bash
+pushd CMSSWRELEASE/src
+eval `scramv1 runtime -sh`
+pushd
+python EXENAME
+"""
+
+#=========================================================================================================
+# QUEUE
+#=========================================================================================================
+def newQueue(inputDir, outputDir, baseDir, files, options = "", minChunk = 1000, maxChunk = 100000, maxAttempts = 3, leaseTime = 900.):
+    """
+    State of a new queue for a list of (filename, entries, clusters) input files, processed by createTrees.py with the given options.
+    A running chunk not renewed by its worker for leaseTime seconds is given to another worker.
+    """
+
+    queue = {"inputDir": inputDir, "outputDir": outputDir, "baseDir": baseDir, "options": options, "minChunk": minChunk, "maxChunk": maxChunk,
+             "maxAttempts": maxAttempts, "leaseTime": leaseTime, "workers": [], "pending": [], "files": {}}
+    for filename, entries, clusters in files:
+        queue["files"][filename] = {"entries": entries, "clusters": clusters, "next": 0, "chunks": {}, "merged": False}
+    return queue
+
+def chunkSize(queue):
+    """
+    Guided self-scheduling: each worker gets half of its share of the events not assigned yet, so that the chunks get smaller
+    towards the end of the production and the last ones finish at about the same time.
+    """
+
+    remaining = sum([inputFile["entries"] - inputFile["next"] for inputFile in queue["files"].values()])
+    size = remaining//(2*max(1, len(queue["workers"])))
+    return max(queue["minChunk"], min(queue["maxChunk"], size))
+
+def nextChunk(queue, worker):
+    """
+    Assign the next chunk to a worker: a failed chunk to be processed again if any, or a new range of the first file not fully
+    assigned yet, ending on a cluster boundary. Return None if every event has already been assigned.
+    """
+
+    if worker not in queue["workers"]:
+        queue["workers"].append(worker)
+
+    if len(queue["pending"]) > 0:
+        filename, chunkId = queue["pending"].pop(0)
+    else:
+        for filename in sorted(queue["files"]):
+            inputFile = queue["files"][filename]
+            if inputFile["next"] < inputFile["entries"]:
+                break
+        else:
+            return None
+
+        first = inputFile["next"]
+        last = min(first + chunkSize(queue), inputFile["entries"])
+        later = [cluster for cluster in inputFile["clusters"] if cluster >= last]
+        if len(later) > 0 and later[0] - first <= 2*queue["maxChunk"]:
+            last = later[0]
+        elif inputFile["entries"] - last < queue["minChunk"]: #Do not leave a tiny chunk behind
+            last = inputFile["entries"]
+
+        inputFile["next"] = last
+        chunkId = str(len(inputFile["chunks"]))
+        inputFile["chunks"][chunkId] = {"first": first, "last": last - 1, "status": "pending", "attempts": 0}
+
+    chunk = queue["files"][filename]["chunks"][chunkId]
+    chunk["status"] = "running"
+    chunk["worker"] = worker
+    chunk["start"] = time.time()
+    chunk["renewed"] = chunk["start"]
+    chunk["attempts"] = chunk["attempts"] + 1
+    return {"filename": filename, "chunkId": chunkId, "firstEvent": chunk["first"], "lastEvent": chunk["last"],
+            "inputDir": queue["inputDir"], "outputDir": queue["outputDir"], "baseDir": queue["baseDir"], "options": queue["options"]}
+
+def renewRunning(queue):
+    """
+    Give a new lease to the chunks that were running when the coordinator stopped: their workers keep processing them and renew them
+    once the coordinator is back, the chunks of the workers gone meanwhile expiring after leaseTime seconds.
+    """
+
+    for filename, inputFile in queue["files"].items():
+        for chunkId, chunk in inputFile["chunks"].items():
+            if chunk["status"] == "running":
+                chunk["renewed"] = time.time()
+
+def renewChunk(queue, filename, chunkId, worker):
+    """
+    Extend the lease of a running chunk, its worker being still alive. Return False if the chunk was given to another worker meanwhile.
+    """
+
+    chunk = queue["files"][filename]["chunks"][chunkId]
+    if chunk["status"] != "running" or chunk.get("worker") != worker:
+        return False
+    chunk["renewed"] = time.time()
+    return True
+
+def expireLeases(queue):
+    """
+    Put back in the queue the running chunks whose worker stopped renewing them (evicted or killed condor job, lost node), so that
+    the production does not wait for them forever. Return the expired chunks.
+    """
+
+    expired = []
+    for filename, inputFile in queue["files"].items():
+        for chunkId, chunk in inputFile["chunks"].items():
+            if chunk["status"] == "running" and time.time() - chunk.get("renewed", chunk["start"]) > queue.get("leaseTime", 900.):
+                chunk["status"] = "pending"
+                queue["pending"].append([filename, chunkId])
+                expired.append((filename, chunkId, chunk.get("worker")))
+    return expired
+
+def finishChunk(queue, filename, chunkId, success, worker = None):
+    """
+    Record the end of a chunk. A failed chunk is put back in the queue until it has been tried maxAttempts times. The failure of a
+    worker whose lease expired is ignored, the chunk having been given to another worker.
+    Return True if all the chunks of the file are now done, and its outputs can be merged.
+    """
+
+    inputFile = queue["files"][filename]
+    chunk = inputFile["chunks"][chunkId]
+    if chunk["status"] == "pending" and success: #Completed by a worker whose lease had expired, its output is as good as another one
+        queue["pending"].remove([filename, chunkId])
+        chunk["status"] = "running"
+    if chunk["status"] != "running": #Already finished
+        return False
+    if not success and worker is not None and chunk.get("worker") != worker:
+        return False
+
+    if success:
+        chunk["status"] = "done"
+        chunk["time"] = time.time() - chunk["start"]
+    elif chunk["attempts"] < queue["maxAttempts"]:
+        chunk["status"] = "pending"
+        queue["pending"].append([filename, chunkId])
+    else:
+        chunk["status"] = "failed"
+
+    return inputFile["next"] == inputFile["entries"] and all([chunk["status"] == "done" for chunk in inputFile["chunks"].values()])
+
+def isFinished(queue):
+    """
+    Whether there is nothing left to be assigned or waited for (failed chunks apart).
+    """
+
+    for inputFile in queue["files"].values():
+        if inputFile["next"] < inputFile["entries"]:
+            return False
+        for chunk in inputFile["chunks"].values():
+            if chunk["status"] in ["pending", "running"]:
+                return False
+    return True
+
+def summary(queue):
+    chunks = [chunk for inputFile in queue["files"].values() for chunk in inputFile["chunks"].values()]
+    counts = dict([(status, len([chunk for chunk in chunks if chunk["status"] == status])) for status in ["running", "done", "failed"]])
+    assigned = sum([inputFile["next"] for inputFile in queue["files"].values()])
+    total = sum([inputFile["entries"] for inputFile in queue["files"].values()])
+    merged = len([inputFile for inputFile in queue["files"].values() if inputFile["merged"]])
+    return ("events assigned: " + str(assigned) + "/" + str(total) + ", chunks running: " + str(counts["running"]) + ", done: " + str(counts["done"]) +
+            ", failed: " + str(counts["failed"]) + ", files merged: " + str(merged) + "/" + str(len(queue["files"])) + ", workers: " + str(len(queue["workers"])))
+
+#=========================================================================================================
+# OUTPUTS
+#=========================================================================================================
+def productionDir(queue):
+    """
+    Directory of the outputs of createTrees.py, named after the production of the input files.
+    """
+
+    return queue["outputDir"] + "/".join(queue["inputDir"].split('/')[-3:-1]) + "/"
+
+def partPath(queue, filename, chunkId):
+    return productionDir(queue) + filename.replace('.root', '') + "_" + str(chunkId) + ".root"
+
+def writeMergedManifest(output, filename, partManifests):
+    """
+    Manifest of a merged output covering the whole input file, not written if one of the partial outputs has no manifest.
+    """
+
+    if None in partManifests:
+        return
+    manifest.writeManifest(output, filename, -1, -1, sum([part["entries"] for part in partManifests]), min([part["start"] for part in partManifests]),
+                           eventsRead = sum([part.get("eventsRead", 0) for part in partManifests]), parts = len(partManifests))
+
+def mergeOutputs(queue, filename):
+    """
+    Merge the partial outputs of a file with hadd in the output the file would have if it was not split, written atomically.
+    The partial outputs are removed once merged, their _timing.json summaries (in the timing directory) being kept for the cost model. The merged output gets
+    a manifest as if it was produced by a single job, when all its partial outputs have one.
+    """
+
+    parts = [partPath(queue, filename, chunkId) for chunkId in sorted(queue["files"][filename]["chunks"], key = int)]
+    output = productionDir(queue) + filename
+    temporary = os.path.join(os.path.dirname(output), "." + os.path.basename(output) + ".merging" + str(os.getpid())) #Never listed as a tree
+    partManifests = [manifest.readManifest(part) for part in parts]
+    manifest.removeManifest(output)
+    if len(parts) == 1:
+        os.rename(parts[0], output)
+        manifest.removeManifest(parts[0])
+        writeMergedManifest(output, filename, partManifests)
+        return True
+
+    log = open(os.devnull, "w")
+    code = subprocess.call(["hadd", "-f", temporary] + parts, stdout = log, stderr = subprocess.STDOUT)
+    log.close()
+    if code != 0:
+        print("  --> hadd failed for " + filename + ", the partial outputs are kept.")
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        return False
+
+    os.rename(temporary, output)
+    writeMergedManifest(output, filename, partManifests)
+    for part in parts:
+        os.remove(part)
+        manifest.removeManifest(part)
+    return True
+
+#=========================================================================================================
+# BACKENDS
+#=========================================================================================================
+class FileQueue():
+    """
+    Queue shared through its state file, each operation being done while holding a lock on the file. Only suited to workers
+    running on machines where the locks are reliable (local disk, AFS), not on EOS.
+    """
+
+    def __init__(self, stateFile):
+        self.stateFile = stateFile
+
+    def transaction(self, operation):
+        lock = open(self.stateFile + ".lock", "a")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            queue = loadState(self.stateFile)
+            result = operation(queue)
+            saveState(self.stateFile, queue)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+        return result
+
+    def request(self, message):
+        if message[0] == "next":
+            def assign(queue):
+                expireLeases(queue)
+                return "stop" if isFinished(queue) else nextChunk(queue, message[1])
+            return self.transaction(assign)
+        if message[0] == "renew":
+            return self.transaction(lambda queue: renewChunk(queue, message[1], message[2], message[3]))
+
+        queue, toMerge = self.transaction(lambda queue: (queue, finishChunk(queue, message[1], message[2], message[0] == "done", message[3])))
+        if toMerge and mergeOutputs(queue, message[1]): #The worker finishing the last chunk of a file merges its outputs
+            self.transaction(lambda queue: queue["files"][message[1]].update(merged = True))
+        return None
+
+class ServerQueue():
+    """
+    Queue served by the coordinator, reached through a socket.
+    """
+
+    def __init__(self, address, authkey, retryTime = 600.):
+        self.address = address
+        self.authkey = authkey
+        self.retryTime = retryTime
+
+    def request(self, message):
+        """
+        Send a request to the coordinator, trying again for retryTime seconds if it can not be reached (while it is restarted for instance).
+        """
+
+        start = time.time()
+        while True:
+            try:
+                connection = Client(self.address, authkey = self.authkey)
+                connection.send(message)
+                reply = connection.recv()
+                connection.close()
+                return reply
+            except (socket.error, EOFError, IOError):
+                if time.time() - start > self.retryTime:
+                    raise
+                time.sleep(10)
+
+class Acceptor():
+    """
+    Connections of the workers accepted in a background thread, so that the coordinator can wake up regularly to collect the merges
+    and expire the leases even if no worker is connected. A connection failing the authentication is dropped.
+    """
+
+    def __init__(self, listener):
+        self.listener = listener
+        self.connections = []
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True #Still blocked in accept when the coordinator stops
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except AuthenticationError as e:
+                print("Rejected a connection that failed the authentication: " + str(e))
+                continue
+            except (socket.error, EOFError, IOError) as e: #Client gone during the handshake
+                print("Ignoring a broken connection: " + str(e))
+                continue
+            self.condition.acquire()
+            self.connections.append(connection)
+            self.condition.notify()
+            self.condition.release()
+
+    def next(self, timeout):
+        """
+        Next accepted connection, None if there was none for timeout seconds.
+        """
+
+        self.condition.acquire()
+        try:
+            if len(self.connections) == 0:
+                self.condition.wait(timeout)
+            return self.connections.pop(0) if len(self.connections) > 0 else None
+        finally:
+            self.condition.release()
+
+def loadState(stateFile):
+    f = open(stateFile)
+    queue = json.load(f)
+    f.close()
+    return queue
+
+def saveState(stateFile, queue):
+    temporary = stateFile + ".tmp" + str(os.getpid())
+    f = open(temporary, "w")
+    json.dump(queue, f)
+    f.close()
+    os.rename(temporary, stateFile)
+
+def serve(stateFile, address, authkey, mergeThreads = 4, summaryInterval = 60., linger = 60.):
+    """
+    Coordinator: answer the requests of the workers until every chunk is done and every file merged, keeping the state file
+    up to date so that the coordinator can be started again without losing the chunks already done. The coordinator then waits
+    up to linger seconds for the workers to ask for more work, to tell them to stop.
+    """
+
+    queue = loadState(stateFile)
+    renewRunning(queue)
+    listener = Listener(address, authkey = authkey)
+    pool = ThreadPool(mergeThreads)
+    merging = {} #Filename: result of the merge running in the pool
+    stopped = set() #Workers told to stop
+    lastSummary, finishTime = 0., None
+
+    #Files completed before a restart of the coordinator but not merged yet
+    for filename, inputFile in queue["files"].items():
+        if not inputFile["merged"] and inputFile["next"] == inputFile["entries"] and all([chunk["status"] == "done" for chunk in inputFile["chunks"].values()]):
+            merging[filename] = pool.apply_async(mergeOutputs, (queue, filename))
+
+    acceptor = Acceptor(listener)
+
+    while finishTime is None or (len(stopped) < len(queue["workers"]) and time.time() - finishTime < linger):
+        connection = acceptor.next(5.)
+
+        for filename, chunkId, worker in expireLeases(queue):
+            print("  --> Lease of chunk " + chunkId + " of " + filename + " expired (" + str(worker) + "), it is given to another worker.")
+            saveState(stateFile, queue)
+
+        if connection is not None:
+            try:
+                message = connection.recv()
+                if message[0] == "next" and isFinished(queue):
+                    stopped.add(message[1])
+                    connection.send("stop")
+                elif message[0] == "next":
+                    connection.send(nextChunk(queue, message[1]))
+                elif message[0] == "renew":
+                    connection.send(renewChunk(queue, message[1], message[2], message[3]))
+                else:
+                    if finishChunk(queue, message[1], message[2], message[0] == "done", message[3]):
+                        merging[message[1]] = pool.apply_async(mergeOutputs, (queue, message[1]))
+                    connection.send(None)
+                saveState(stateFile, queue)
+            except (EOFError, IOError) as e: #A worker disconnected during its request, it will ask again
+                print("Ignoring a broken request: " + str(e))
+            connection.close()
+
+        for filename, result in list(merging.items()):
+            if result.ready():
+                queue["files"][filename]["merged"] = result.get()
+                del merging[filename]
+                saveState(stateFile, queue)
+
+        if time.time() - lastSummary > summaryInterval:
+            print(summary(queue))
+            sys.stdout.flush()
+            lastSummary = time.time()
+
+        if finishTime is None and isFinished(queue) and len(merging) == 0:
+            finishTime = time.time()
+
+    pool.close()
+    pool.join()
+    listener.close()
+    print(summary(queue))
+    return queue
+
+def work(backend, worker, waitTime = 10., renewInterval = 60.):
+    """
+    Worker: process chunks with createTrees.py until the queue tells it to stop, renewing the lease of its chunk every renewInterval
+    seconds while createTrees.py runs. A chunk given to another worker meanwhile (expired lease) is abandoned.
+    """
+
+    while True:
+        try:
+            chunk = backend.request(("next", worker))
+        except (socket.error, EOFError, IOError): #The coordinator is gone, the production is over
+            return
+        if chunk == "stop":
+            return
+        if chunk is None: #Everything is assigned, but a chunk might still fail and be given back
+            time.sleep(waitTime)
+            continue
+
+        command = [sys.executable, os.path.join(chunk["baseDir"], "createTrees.py"), "-f", chunk["filename"], "-i", chunk["inputDir"], "-o", chunk["outputDir"],
+                   "-b", chunk["baseDir"], "--splitNumber", chunk["chunkId"], "--firstEvent", str(chunk["firstEvent"]), "--lastEvent", str(chunk["lastEvent"])] + chunk["options"].split()
+        print("Processing events " + str(chunk["firstEvent"]) + " to " + str(chunk["lastEvent"]) + " of " + chunk["filename"])
+        sys.stdout.flush()
+        process = subprocess.Popen(command)
+        lastRenew = time.time()
+        while process.poll() is None:
+            time.sleep(1)
+            if time.time() - lastRenew < renewInterval:
+                continue
+            lastRenew = time.time()
+            try:
+                kept = backend.request(("renew", chunk["filename"], chunk["chunkId"], worker))
+            except (socket.error, EOFError, IOError): #Coordinator unreachable for a while, the lease will tell
+                continue
+            if not kept:
+                print("The chunk was given to another worker, stopping")
+                process.kill()
+        try:
+            backend.request(("done" if process.wait() == 0 else "failed", chunk["filename"], chunk["chunkId"], worker))
+        except (socket.error, EOFError, IOError): #Coordinator unreachable for a while, the expired lease gives the chunk to another worker
+            print("Could not report the end of the chunk to the coordinator")
+            sys.stdout.flush()
+
+def keyPath(stateFile):
+    return stateFile + ".key"
+
+def createKey(path):
+    """
+    Random key authenticating the workers, written in a file only readable by its owner (the workers reading it from there).
+    """
+
+    key = binascii.hexlify(os.urandom(32))
+    temporary = path + ".tmp" + str(os.getpid())
+    descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.write(descriptor, key)
+    os.close(descriptor)
+    os.rename(temporary, path)
+    return key
+
+def readKey(path):
+    f = open(path, "rb")
+    key = f.read().strip()
+    f.close()
+    return key
+
+def parseAddress(address):
+    host, port = address.rsplit(":", 1)
+    return (host, int(port))
+
+########################## Main program #####################################
+if __name__ == "__main__":
+
+    # ===========================================
+    # Argument parser
+    # ===========================================
+    parser = optparse.OptionParser(usage='usage: %prog [opts] serve|work', version='%prog 1.0')
+    parser.add_option('-i', '--inputDir', action='store', type=str, dest='inputDir', default="") #Directory of the latino files to be processed
+    parser.add_option('-q', '--query', action='store', type=str, dest='query', default="*") #String to be matched when searching for the files (without the nanoLatino prefix)
+    parser.add_option('-o', '--outputDir', action='store', type=str, dest='outputDir', default="/eos/user/c/cprieels/work/TopPlusDMRunIILegacyRootfiles/") #Output directory where to keep the output files
+    parser.add_option('-O', '--options', action='store', type=str, dest='options', default="") #Additional options given to createTrees.py for each chunk (e.g. "--recoCache cache/ --timingBranches")
+    parser.add_option('-s', '--stateFile', action='store', type=str, dest='stateFile', default="workQueue.json") #File where the state of the queue is kept
+    parser.add_option('-a', '--address', action='store', type=str, dest='address', default="") #host:port of the coordinator, the workers use the state file directly if empty
+    parser.add_option('-k', '--keyFile', action='store', type=str, dest='keyFile', default="") #File of the key authenticating the workers (state file + .key by default), created by the coordinator
+    parser.add_option('--minChunk', action='store', type=int, dest='minChunk', default=1000) #Smallest number of events given to a worker
+    parser.add_option('--maxChunk', action='store', type=int, dest='maxChunk', default=100000) #Largest number of events given to a worker
+    parser.add_option('--maxAttempts', action='store', type=int, dest='maxAttempts', default=3) #Number of times a chunk is tried before being given up
+    parser.add_option('--leaseTime', action='store', type=float, dest='leaseTime', default=900.) #Seconds after which a chunk not renewed by its worker (renewing it every minute) is given to another worker
+    parser.add_option('-l', '--localWorkers', action='store', type=int, dest='localWorkers', default=0) #Workers started on this machine by the coordinator
+    parser.add_option('-w', '--condorWorkers', action='store', type=int, dest='condorWorkers', default=0) #Worker job scripts written in sh/ for condor
+    parser.add_option('-c', '--cmssw', action='store', type=str, dest='cmssw', default="/afs/cern.ch/user/c/cprieels/work/public/TopPlusDMRunIILegacy/CMSSW_10_4_0/") #CMSSW release of the condor workers
+    parser.add_option('--name', action='store', type=str, dest='name', default="") #Name of this worker (host and process id by default)
+    parser.add_option('-r', '--restart', action='store_true', dest='restart') #Start a new queue even if the state file exists
+    parser.add_option('-v', '--verbose', action='store_true', dest='verbose')
+    (opts, args) = parser.parse_args()
+
+    if len(args) != 1 or args[0] not in ["serve", "work"]:
+        parser.error("Either serve (coordinator) or work (worker) has to be given")
+    baseDir = os.getcwd() + "/"
+    keyFile = opts.keyFile if opts.keyFile != "" else keyPath(opts.stateFile)
+
+    if args[0] == "work":
+        if opts.address != "" and not os.path.exists(keyFile):
+            parser.error("The key file " + keyFile + " written by the coordinator is needed to reach it")
+        backend = ServerQueue(parseAddress(opts.address), readKey(keyFile)) if opts.address != "" else FileQueue(opts.stateFile)
+        work(backend, opts.name if opts.name != "" else socket.gethostname() + ":" + str(os.getpid()))
+        sys.exit(0)
+
+    #Coordinator: create the queue, unless resuming an existing one
+    if opts.restart or not os.path.exists(opts.stateFile):
+        if opts.inputDir == "":
+            parser.error("The input directory has to be given to create a new queue")
+        import fnmatch
+        filenames = sorted(fnmatch.filter(os.listdir(opts.inputDir), 'nanoLatino*' + opts.query + '*.root'))
+        metadata = fileIndex.FileIndex().scan([opts.inputDir + filename for filename in filenames])
+        files = []
+        for filename in filenames:
+            if not fileIndex.hasTree(metadata[opts.inputDir + filename]) or metadata[opts.inputDir + filename]["entries"] == 0:
+                print("  --> " + filename + " can not be read or has no event, it is skipped.")
+                continue
+            files.append((filename, metadata[opts.inputDir + filename]["entries"], metadata[opts.inputDir + filename]["clusters"]))
+        saveState(opts.stateFile, newQueue(opts.inputDir, opts.outputDir, baseDir, files, opts.options, opts.minChunk, opts.maxChunk, opts.maxAttempts, opts.leaseTime))
+        print("New queue of " + str(len(files)) + " file(s) written in " + opts.stateFile)
+    else:
+        print("Resuming the queue of " + opts.stateFile)
+
+    if opts.verbose:
+        print("=================================================")
+        print("OPTIONS USED:")
+        print("Input directory: " + str(opts.inputDir))
+        print("Output directory: " + str(opts.outputDir))
+        print("createTrees.py options: " + str(opts.options))
+        print("Chunks: " + str(opts.minChunk) + " to " + str(opts.maxChunk) + " events, " + str(opts.maxAttempts) + " attempts, lease of " + str(opts.leaseTime) + " s")
+        print("Coordinator: " + (opts.address if opts.address != "" else "none, shared state file"))
+        print("Workers: " + str(opts.localWorkers) + " local, " + str(opts.condorWorkers) + " condor")
+        print("=================================================")
+
+    #A new key for each coordinator, never given on the command line (nor in the worker scripts)
+    if opts.address != "":
+        authkey = createKey(keyFile)
+
+    workerCommand = os.path.abspath(__file__) + " work -s " + os.path.abspath(opts.stateFile) + " -k " + os.path.abspath(keyFile)
+    if opts.address != "":
+        workerCommand = workerCommand + " -a " + opts.address
+
+    try:
+        os.makedirs('sh')
+    except:
+        pass #Directory already exists, this is fine
+    for i in range(opts.condorWorkers):
+        template = templateCONDOR.replace('CMSSWRELEASE', opts.cmssw).replace('EXENAME', workerCommand + " --name condor" + str(i))
+        f = open('sh/send_worker' + str(i) + '.sh', 'w')
+        f.write(template)
+        f.close()
+        os.chmod('sh/send_worker' + str(i) + '.sh', 0o755)
+    if opts.condorWorkers > 0:
+        print(str(opts.condorWorkers) + " worker job(s) written in sh/, to be submitted with condorjob.tcl.")
+
+    workers = [subprocess.Popen([sys.executable] + workerCommand.split() + ["--name", "local" + str(i)]) for i in range(opts.localWorkers)]
+
+    if opts.address != "":
+        queue = serve(opts.stateFile, parseAddress(opts.address), authkey)
+    else: #The workers share the state file, only wait for them
+        for worker in workers:
+            worker.wait()
+        queue = loadState(opts.stateFile)
+        print(summary(queue))
+
+    for worker in workers:
+        worker.wait()
+
+    failed = [filename for filename, inputFile in queue["files"].items() if not inputFile["merged"]]
+    if len(failed) > 0:
+        print(str(len(failed)) + " file(s) could not be fully processed or merged: " + ", ".join(sorted(failed)))
+        sys.exit(1)
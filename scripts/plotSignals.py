@@ -1,5 +1,9 @@
 from ROOT import TCanvas, TLegend, TChain, TFile, TH1F
-import fnmatch, os
+import fnmatch, os, sys
+
+#Dataset catalog and staging cache of the neuralNetwork directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "neuralNetwork"))
+import datasetCatalog, stagingCache
 
 #=============================================================================
 #SETUP
@@ -10,8 +14,14 @@ variable = ["PuppiMET_pt", 100, 0, 500, "Puppi MET [GeV]"] #Variable name, bins,
 #variable = ["nbJet", 6, 0, 6, "Loose deepCSV b-jets"] 
 #variable = ["mblt", 16, 20, 350, "mblt [GeV]"] 
 
-signalDir = "/eos/user/c/cprieels/work/TopPlusDMRunIILegacyRootfiles/Autumn18_102X_nAODv6_Full2018v6/MCl1loose2018v6__MCCorr2018v6__l2loose__l2tightOR2018v6/"
+year = 2018
+catalogFile = "" #JSON file overriding the directories of the dataset catalog (see datasetCatalog.py)
+stageDir = "" #Local directory where the signal trees are copied, so that the following plots read them from the local disk (not staged if empty)
+stageSize = 20. #Size in GB of the staging directory
+catalog = datasetCatalog.DatasetCatalog(catalogFile)
+signalDir = catalog.directory(year, "trees", "signal")
 #signalDir = "/eos/user/c/cprieels/work/TopPlusDMRunIILegacyRootfiles/"
+staging = stagingCache.StagingCache(stageDir, stageSize) if stageDir != "" else None
 category = "pseudoscalar"
 trailer = "*"
 #cuts = "mt2ll > 100 && (Lepton_pdgId[0] * Lepton_pdgId[1] == -11*13 || (mll < 76 || mll > 106))"
@@ -69,8 +79,8 @@ for f, fileDict in enumerate(files):
     print('Now considering mass point... ' + massPoint)
 
     signalChain = TChain("Events")
-    for actualFile in fnmatch.filter(os.listdir(signalDir), 'nanoLatino*' + filename + '*'):
-        signalChain.AddFile(signalDir+actualFile)
+    for actualFile in catalog.files(year, "trees", "signal", filename):
+        signalChain.AddFile(staging.stage(signalDir+actualFile) if staging is not None else signalDir+actualFile)
         
     histname = 'hist_'+str(f)
     signalHist = TH1F(histname, 'Mass points distribution', variable[1], variable[2], variable[3])